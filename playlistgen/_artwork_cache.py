@@ -0,0 +1,204 @@
+import attr
+import concurrent.futures
+import hashlib
+import os
+import pathlib
+import subprocess
+import threading
+import time
+
+SIZES = (64, 128, 256, 512)
+MISSING_MARKER = 'missing'
+FAILED_SUFFIX = '.failed'
+THUMBNAIL_CONTENT_TYPE = 'image/jpeg'
+
+extensions = {
+    'image/bmp': 'bmp',
+    'image/gif': 'gif',
+    'image/jpeg': 'jpg',
+    'image/jp2': 'jp2',
+    'image/png': 'png',
+    'image/tiff': 'tiff',
+}
+content_types_by_extension = {v: k for k, v in extensions.items()}
+
+
+class UnsupportedArtwork(Exception):
+    pass
+
+
+@attr.s(frozen=True)
+class CachedArtwork:
+    path = attr.ib()
+    content_type = attr.ib()
+    etag = attr.ib()
+
+    def read(self):
+        return self.path.read_bytes()
+
+
+def _write_atomically(path, data):
+    tmp = path.with_name('.{}.tmp'.format(path.name))
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def resize(source, dest, size):
+    tmp = dest.with_name('.tmp-' + dest.name)
+    subprocess.run(
+        ['sips', '-Z', str(size), '-s', 'format', 'jpeg', str(source), '--out', str(tmp)],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    os.replace(tmp, dest)
+
+
+@attr.s
+class ArtworkCache:
+    """
+    Album artwork on disk, keyed by album persistent ID, with thumbnails.
+
+    The original image is pulled out of the library once; thumbnails at each
+    of sizes are then made in a background pool. File names carry a digest
+    of the original, which doubles as the ETag.
+
+    An album without artwork, or a thumbnail that couldn't be made, is
+    remembered with a marker file; it's tried again once the marker is
+    older than missing_ttl or failed_ttl seconds.
+    """
+
+    root = attr.ib(converter=pathlib.Path)
+    sizes = attr.ib(default=SIZES)
+    max_workers = attr.ib(default=2)
+    resize_timeout = attr.ib(default=10)
+    missing_ttl = attr.ib(default=86400)
+    failed_ttl = attr.ib(default=3600)
+    _executor = attr.ib(default=None)
+    _pending = attr.ib(factory=dict)
+    _lock = attr.ib(factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='artwork')
+
+    def _is_marked(self, marker, ttl):
+        try:
+            return time.time() - marker.stat().st_mtime < ttl
+        except FileNotFoundError:
+            return False
+
+    def _album_dir(self, album_pid):
+        return self.root / album_pid[-2:] / album_pid
+
+    def _cached_original(self, directory):
+        for path in directory.glob('original-*'):
+            digest = path.stem.partition('-')[2]
+            content_type = content_types_by_extension.get(path.suffix[1:])
+            if content_type is not None:
+                return CachedArtwork(path=path, content_type=content_type, etag=digest)
+        return None
+
+    def original(self, album_pid, track, content_types):
+        directory = self._album_dir(album_pid)
+        ret = self._cached_original(directory)
+        if ret is not None or self._is_marked(directory / MISSING_MARKER, self.missing_ttl):
+            return ret
+        directory.mkdir(parents=True, exist_ok=True)
+        artwork = track.artwork()
+        if artwork is None:
+            (directory / MISSING_MARKER).touch()
+            return None
+        content_type = content_types.get(artwork.imageDataFormat())
+        if content_type is None:
+            raise UnsupportedArtwork(album_pid)
+        data = bytes(artwork.imageData().bytes())
+        digest = hashlib.sha1(data).hexdigest()[:20]
+        path = directory / 'original-{}.{}'.format(digest, extensions[content_type])
+        _write_atomically(path, data)
+        ret = CachedArtwork(path=path, content_type=content_type, etag=digest)
+        self._schedule(ret)
+        return ret
+
+    def _thumbnail_path(self, original, size):
+        return original.path.with_name('{}-{}.jpg'.format(size, original.etag))
+
+    def _failed_marker(self, dest):
+        return dest.with_name(dest.name + FAILED_SUFFIX)
+
+    def _schedule(self, original):
+        ret = {}
+        submitted = {}
+        with self._lock:
+            for size in self.sizes:
+                dest = self._thumbnail_path(original, size)
+                future = self._pending.get(dest)
+                if future is None:
+                    if dest.exists() or self._is_marked(
+                            self._failed_marker(dest), self.failed_ttl):
+                        continue
+                    future = self._pending[dest] = submitted[dest] = self._executor.submit(
+                        resize, original.path, dest, size)
+                ret[size] = future
+        # outside the lock: a future that's already done runs its callback here
+        for dest, future in submitted.items():
+            future.add_done_callback(
+                lambda future, dest=dest: self._finished(dest, future))
+        return ret
+
+    def _finished(self, dest, future):
+        with self._lock:
+            self._pending.pop(dest, None)
+        if not future.cancelled() and future.exception() is not None:
+            self._failed_marker(dest).touch()
+
+    def get(self, album_pid, track, content_types, size=None):
+        """
+        The cached artwork for an album, as a thumbnail if size is one of
+        sizes, or None if the album has no artwork.
+
+        Falls back to the original if the thumbnail can't be made.
+        """
+
+        original = self.original(album_pid, track, content_types)
+        if original is None or size not in self.sizes:
+            return original
+        path = self._thumbnail_path(original, size)
+        if not path.exists():
+            future = self._schedule(original).get(size)
+            try:
+                if future is not None:
+                    future.result(timeout=self.resize_timeout)
+            except (OSError, subprocess.SubprocessError, concurrent.futures.TimeoutError):
+                return original
+            if not path.exists():
+                # failed recently enough not to be tried again yet
+                return original
+        return CachedArtwork(
+            path=path, content_type=THUMBNAIL_CONTENT_TYPE,
+            etag='{}-{}'.format(original.etag, size))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def multipart_bundle(parts):
+    """
+    Encode (content id, CachedArtwork) pairs as a multipart/mixed body.
+
+    Returns the body, the boundary and an ETag covering every part.
+    """
+
+    etag = hashlib.sha1(
+        ' '.join('{}={}'.format(cid, a.etag) for cid, a in parts).encode()).hexdigest()
+    boundary = 'artwork-{}'.format(etag)
+    chunks = []
+    for content_id, artwork in parts:
+        data = artwork.read()
+        chunks.append(
+            '--{}\r\nContent-Type: {}\r\nContent-ID: <{}>\r\nETag: "{}"\r\n'
+            'Content-Length: {}\r\n\r\n'.format(
+                boundary, artwork.content_type, content_id, artwork.etag, len(data)
+            ).encode())
+        chunks.append(data)
+        chunks.append(b'\r\n')
+    chunks.append('--{}--\r\n'.format(boundary).encode())
+    return b''.join(chunks), boundary, etag
@@ -0,0 +1,76 @@
+import attr
+import collections
+import threading
+import time
+
+
+@attr.s(frozen=True)
+class _Entry:
+    value = attr.ib()
+    size = attr.ib()
+    created = attr.ib()
+
+
+@attr.s
+class PreparedCriteriaCache:
+    """
+    Prepared criteria, least recently used first out.
+
+    Entries are charged by a size function; once the total goes over
+    max_size, the oldest are dropped. Entries older than max_age are rebuilt,
+    since some criteria (like score-unrecent) fold the current time into
+    what they prepare.
+    """
+
+    size_of = attr.ib()
+    max_size = attr.ib(default=2000000)
+    max_age = attr.ib(default=3600)
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+    _entries = attr.ib(factory=collections.OrderedDict)
+    _size = attr.ib(default=0)
+    _lock = attr.ib(factory=threading.Lock)
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created > self.max_age:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+
+    def get(self, key, build):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+        value = build()
+        entry = _Entry(value=value, size=self.size_of(value), created=time.monotonic())
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += entry.size
+            while self._size > self.max_size and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
@@ -0,0 +1,336 @@
+import attr
+import gzip
+import json
+import pathlib
+import re
+import xml.etree.ElementTree as ET
+
+API_URL = 'https://api.discogs.com'
+SITE_URL = 'https://www.discogs.com'
+
+# search() keywords that narrow to one full-text column
+FIELD_COLUMNS = {
+    'title': 'title',
+    'release_title': 'title',
+    'artist': 'artist',
+}
+
+SEARCH_TYPES = {
+    'master': 'masters',
+    'release': 'releases',
+    'artist': 'artists',
+}
+
+
+def _open(path):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_records(path):
+    """
+    Yield (root tag, element) for each top-level record of a dump file.
+
+    Each record is dropped from the tree once the next one is asked for, so
+    memory stays flat however big the dump is.
+    """
+
+    root = None
+    depth = 0
+    with _open(path) as f:
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                yield root.tag, elem
+                root.clear()
+
+
+def _text(elem, path, default=''):
+    child = elem.find(path)
+    if child is None or child.text is None:
+        return default
+    return child.text.strip()
+
+
+def _texts(elem, path):
+    return [e.text.strip() for e in elem.iterfind(path) if e.text]
+
+
+def _int(s):
+    try:
+        return int(s)
+    except (TypeError, ValueError):
+        return None
+
+
+def _year(s):
+    m = re.match(r'\d{4}', s or '')
+    return int(m.group()) if m else 0
+
+
+def _artists(elem, base_url):
+    ret = []
+    for a in elem.iterfind('artists/artist'):
+        id = _int(_text(a, 'id'))
+        ret.append({
+            'id': id,
+            'name': _text(a, 'name'),
+            'anv': _text(a, 'anv'),
+            'join': _text(a, 'join'),
+            'role': _text(a, 'role'),
+            'tracks': _text(a, 'tracks'),
+            'resource_url': f'{base_url}/artists/{id}',
+        })
+    return ret
+
+
+def artist_credit(artists):
+    return ' '.join(filter(None, (
+        part for a in artists for part in (a['anv'] or a['name'], a['join'])))).strip()
+
+
+def _tracklist(elem):
+    return [{
+        'position': _text(t, 'position'),
+        'type_': 'track',
+        'title': _text(t, 'title'),
+        'duration': _text(t, 'duration'),
+    } for t in elem.iterfind('tracklist/track')]
+
+
+def master_data(elem, base_url):
+    id = int(elem.get('id'))
+    main_release = _int(_text(elem, 'main_release'))
+    return {
+        'id': id,
+        'title': _text(elem, 'title'),
+        'artists': _artists(elem, base_url),
+        'main_release': main_release,
+        'main_release_url': f'{base_url}/releases/{main_release}',
+        'year': _year(_text(elem, 'year')),
+        'genres': _texts(elem, 'genres/genre'),
+        'styles': _texts(elem, 'styles/style'),
+        'tracklist': _tracklist(elem),
+        'data_quality': _text(elem, 'data_quality'),
+        'resource_url': f'{base_url}/masters/{id}',
+        'uri': f'{SITE_URL}/master/{id}',
+    }
+
+
+def release_data(elem, base_url):
+    id = int(elem.get('id'))
+    ret = {
+        'id': id,
+        'status': elem.get('status'),
+        'title': _text(elem, 'title'),
+        'artists': _artists(elem, base_url),
+        'labels': [{
+            'id': _int(label.get('id')),
+            'name': label.get('name'),
+            'catno': label.get('catno'),
+        } for label in elem.iterfind('labels/label')],
+        'formats': [{
+            'name': fmt.get('name'),
+            'qty': fmt.get('qty'),
+            'descriptions': _texts(fmt, 'descriptions/description'),
+        } for fmt in elem.iterfind('formats/format')],
+        'country': _text(elem, 'country'),
+        'released': _text(elem, 'released'),
+        'year': _year(_text(elem, 'released')),
+        'genres': _texts(elem, 'genres/genre'),
+        'styles': _texts(elem, 'styles/style'),
+        'tracklist': _tracklist(elem),
+        'data_quality': _text(elem, 'data_quality'),
+        'resource_url': f'{base_url}/releases/{id}',
+        'uri': f'{SITE_URL}/release/{id}',
+    }
+    master_id = _int(_text(elem, 'master_id'))
+    if master_id is not None:
+        ret['master_id'] = master_id
+        ret['master_url'] = f'{base_url}/masters/{master_id}'
+    return ret
+
+
+def artist_data(elem, base_url):
+    id = int(_text(elem, 'id'))
+    name = _text(elem, 'name')
+    return {
+        'id': id,
+        'type': 'artist',
+        'title': name,
+        'name': name,
+        'realname': _text(elem, 'realname'),
+        'profile': _text(elem, 'profile'),
+        'namevariations': _texts(elem, 'namevariations/name'),
+        'aliases': [{
+            'id': _int(a.get('id')),
+            'name': a.text,
+            'resource_url': f'{base_url}/artists/{a.get("id")}',
+        } for a in elem.iterfind('aliases/name')],
+        'data_quality': _text(elem, 'data_quality'),
+        'resource_url': f'{base_url}/artists/{id}',
+        'uri': f'{SITE_URL}/artist/{id}',
+    }
+
+
+def _titled_row(data):
+    return data['title'], artist_credit(data['artists'])
+
+
+def _artist_row(data):
+    return data['name'], ' '.join([data['realname'], *data['namevariations']])
+
+
+KINDS = {
+    'masters': (master_data, _titled_row),
+    'releases': (release_data, _titled_row),
+    'artists': (artist_data, _artist_row),
+}
+
+
+def _tokens(s):
+    return re.findall(r'\w+', (s or '').lower())
+
+
+def fts_query(q=None, **fields):
+    """
+    An FTS5 query matching every word of q anywhere and of each field in
+    its own column.
+    """
+
+    terms = ['"{}"'.format(t) for t in _tokens(q)]
+    for field, value in fields.items():
+        column = FIELD_COLUMNS[field]
+        terms.extend('{}:"{}"'.format(column, t) for t in _tokens(value))
+    return ' '.join(terms) or None
+
+
+@attr.s(frozen=True)
+class LocalResult:
+    """
+    A search result answered without the API, already as complete as it
+    gets; refresh() has nothing to fetch.
+    """
+
+    id = attr.ib()
+    data = attr.ib()
+
+    def refresh(self):
+        pass
+
+
+@attr.s
+class Catalog:
+    """
+    Masters, releases and artists from the monthly discogs XML dumps, in
+    sqlite with full-text indexes over titles and artist names.
+
+    Records are stored in the shape the API returns them, with resource URLs
+    under base_url, so rows made from either look the same.
+    """
+
+    db = attr.ib()
+    base_url = attr.ib(default=API_URL)
+    batch_size = attr.ib(default=5000)
+    result_limit = attr.ib(default=10)
+
+    def ensure_tables(self):
+        for kind in KINDS:
+            self.db.query(f"""
+                create table if not exists dump_{kind} (
+                    id integer primary key, title text, artist text, data text)
+            """)
+            self.db.query(f"""
+                create virtual table if not exists dump_{kind}_fts using fts5 (
+                    title, artist, content='dump_{kind}', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2')
+            """)
+        self.db.query("""
+            create table if not exists dump_imports (
+                path text primary key, size integer, mtime float,
+                kind text, records integer)
+        """)
+
+    def _is_loaded(self, path, stat):
+        for row in self.db.query("""
+            select size, mtime from dump_imports where path = :path
+        """, path=str(path)):
+            return row['size'] == stat.st_size and row['mtime'] == stat.st_mtime
+        return False
+
+    def _insert(self, kind, rows):
+        with self.db:
+            self.db.query(f"""
+                insert or replace into dump_{kind} (id, title, artist, data)
+                values (:id, :title, :artist, :data)
+            """, rows)
+
+    def load(self, path, bar=None):
+        """
+        Load one dump file, unless this same file was loaded already.
+
+        Returns how many records were read.
+        """
+
+        path = pathlib.Path(path).resolve()
+        stat = path.stat()
+        if self._is_loaded(path, stat):
+            return 0
+        kind = None
+        count = 0
+        rows = []
+        for root_tag, elem in iter_records(path):
+            if root_tag not in KINDS:
+                raise ValueError('not a discogs dump', str(path), root_tag)
+            kind = root_tag
+            to_data, to_row = KINDS[kind]
+            data = to_data(elem, self.base_url)
+            title, artist = to_row(data)
+            rows.append(dict(
+                id=data['id'], title=title, artist=artist, data=json.dumps(data)))
+            if len(rows) >= self.batch_size:
+                self._insert(kind, rows)
+                rows = []
+            count += 1
+            if bar is not None:
+                bar.update()
+        if kind is None:
+            return 0
+        if rows:
+            self._insert(kind, rows)
+        with self.db:
+            self.db.query(f"""
+                insert into dump_{kind}_fts (dump_{kind}_fts) values ('rebuild')
+            """)
+            self.db.query("""
+                insert or replace into dump_imports (path, size, mtime, kind, records)
+                values (:path, :size, :mtime, :kind, :records)
+            """, path=str(path), size=stat.st_size, mtime=stat.st_mtime,
+                kind=kind, records=count)
+        return count
+
+    def search(self, q=None, type='release', **fields):
+        """
+        Answer a discogs database search from the catalog, best match first.
+        """
+
+        kind = SEARCH_TYPES[type]
+        match = fts_query(q, **fields)
+        if match is None:
+            return []
+        return [
+            LocalResult(id=row['id'], data=json.loads(row['data']))
+            for row in self.db.query(f"""
+                select d.id, d.data
+                from dump_{kind}_fts f
+                join dump_{kind} d on d.id = f.rowid
+                where dump_{kind}_fts match :match
+                order by f.rank
+                limit :limit
+            """, match=match, limit=self.result_limit)]
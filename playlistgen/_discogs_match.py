@@ -1,14 +1,22 @@
 import arrow
 import attr
 import click
+import concurrent.futures
 import dataset
 import discogs_client
-import os
+import json
+import pathlib
+import random
+import sqlalchemy
+import threading
 import time
 from contextlib import contextmanager
 from tqdm import tqdm
 
-from .playlistgen import ppis
+from ._discogs_dump import API_URL, Catalog, LocalResult
+from ._fuzzy_index import CandidateIndex
+from ._http_cache import CachingFetcher, ResponseCache
+from .playlistgen import album_track_position, ppis
 
 
 def log(s, **fmt):
@@ -29,154 +37,640 @@ class Grouping:
             return options.pop()
 
 
+@attr.s(frozen=True)
+class GroupingIndex:
+    """
+    Songs grouped by album and by artist, in album track order.
+
+    Groupings are shared, so their track lists are tuples.
+    """
+
+    generation = attr.ib()
+    albums = attr.ib()
+    artists = attr.ib()
+
+    @classmethod
+    def from_songs(cls, songs, generation):
+        albums = {}
+        artists = {}
+        for t in songs:
+            for group, groupings in [(t.album(), albums), (t.artist(), artists)]:
+                pid = ppis(group)
+                grouping = groupings.get(pid)
+                if grouping is None:
+                    grouping = groupings[pid] = Grouping(pid, group)
+                grouping.tracks.append(t)
+        for groupings in [albums, artists]:
+            for grouping in groupings.values():
+                grouping.tracks = tuple(sorted(grouping.tracks, key=album_track_position))
+        return cls(generation=generation, albums=albums, artists=artists)
+
+
+@attr.s
+class TokenBucket:
+    """
+    Requests allowed per minute, shared by every fetching thread.
+
+    Tokens come back continuously at rate per minute. Discogs reports how
+    much of its moving one-minute window is left, which caps what the bucket
+    thinks it has, less a reserve; a 429 pauses everyone at once.
+    """
+
+    rate = attr.ib(default=60)
+    reserve = attr.ib(default=2)
+    tokens = attr.ib(default=None)
+    _paused_until = attr.ib(default=0)
+    _updated = attr.ib(factory=time.monotonic)
+    _cond = attr.ib(factory=threading.Condition)
+
+    def __attrs_post_init__(self):
+        if self.tokens is None:
+            self.tokens = self.rate
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.rate, self.tokens + (now - self._updated) * self.rate / 60)
+        self._updated = now
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) * 60 / self.rate
+                self._cond.wait(wait)
+
+    def observe(self, limit=None, remaining=None):
+        with self._cond:
+            self._refill(time.monotonic())
+            if limit:
+                self.rate = limit
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining - self.reserve)
+
+    def pause(self, seconds):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self.tokens = min(self.tokens, 0)
+            self._cond.notify_all()
+
+
+class HeaderFetcher(discogs_client.fetchers.UserTokenRequestsFetcher):
+    """
+    Keeps the headers of each thread's last response, since the rate limit
+    attributes the fetcher sets are shared by every thread.
+    """
+
+    def __init__(self, user_token):
+        super().__init__(user_token)
+        self._local = threading.local()
+
+    def request(self, *a, **kw):
+        resp = super().request(*a, **kw)
+        self._local.headers = resp.headers
+        return resp
+
+    @property
+    def response_headers(self):
+        return getattr(self._local, 'headers', {})
+
+
 @attr.s
 class RateLimiter:
+    """
+    Wraps a discogs fetcher so every request first takes a token from a
+    shared bucket.
+
+    A 429 pauses the bucket for as long as its Retry-After says, or
+    backoff_seconds without one.
+    """
+
     fetcher = attr.ib()
+    bucket = attr.ib(factory=TokenBucket)
+    backoff_seconds = attr.ib(default=25)
     bar = attr.ib(default=None)
 
     @property
-    def rate_limit(self):
-        return int(self.fetcher.rate_limit)
+    def response_headers(self):
+        return self.fetcher.response_headers
 
-    @property
-    def rate_limit_used(self):
-        return int(getattr(self.fetcher, 'rate_limit_used', 0))
+    def _header(self, name):
+        value = self.response_headers.get(name)
+        return None if value is None else int(value)
+
+    def _retry_after(self):
+        try:
+            return max(0, int(self.response_headers.get('Retry-After')))
+        except (TypeError, ValueError):
+            return self.backoff_seconds
 
     @property
     def rate_limit_remaining(self):
-        return int(getattr(self.fetcher, 'rate_limit_remaining', -1))
-
-    def seconds_per(self, n_requests):
-        return (n_requests * 60) / self.rate_limit
+        ret = self._header('X-Discogs-Ratelimit-Remaining')
+        return -1 if ret is None else ret
 
     def fetch(self, client, method, url, data=None, headers=None, json=True):
         while True:
-            before = self.rate_limit_used
+            self.bucket.acquire()
             content, status_code = self.fetcher.fetch(
                 client, method, url, data, headers, json)
+            self.bucket.observe(
+                limit=self._header('X-Discogs-Ratelimit'),
+                remaining=self._header('X-Discogs-Ratelimit-Remaining'))
             if self.bar is not None:
                 self.bar.set_description(f'rate limit at {self.rate_limit_remaining}')
 
             if status_code == 429:
-                log('hit a 429; sleeping')
-                time.sleep(25)
+                seconds = self._retry_after()
+                log('hit a 429; everyone waits {seconds}s', seconds=seconds)
+                self.bucket.pause(seconds)
                 continue
-
-            after = self.rate_limit_used
-            total_used = after - before
-            if self.seconds_per(self.rate_limit_remaining) < 25:
-                log('rate limit too low; sleeping')
-                time.sleep(5)
-            elif total_used > 0:
-                seconds_to_wait = self.seconds_per(total_used)
-                time.sleep(seconds_to_wait)
             return content, status_code
 
 
+def mark_done(db, done):
+    """
+    Journal (phase, entity) pairs as done as of now.
+    """
+
+    fetched_at = time.time()
+    db.query("""
+        insert or replace into match_journal (phase, entity, state, fetched_at)
+        values (:phase, :entity, 'done', :fetched_at)
+    """, [dict(phase=phase, entity=str(entity), fetched_at=fetched_at)
+          for phase, entity in done])
+
+
+def not_fresh(entity):
+    """
+    A where clause for entities whose :phase isn't journaled as done since
+    :fresh_after.
+    """
+
+    return f"""not exists (
+        select 1 from match_journal
+        where phase = :phase and entity = cast({entity} as text)
+            and state = 'done' and fetched_at >= :fresh_after)"""
+
+
+@attr.s
+class BatchWriter:
+    """
+    Buffers rows for one table and writes them batch_size at a time, each
+    batch in one transaction.
+
+    With keys, rows update existing ones by those keys instead of inserting.
+    Entities added as done are journaled in the same transaction as their
+    rows, so an interrupted run picks up after the last batch written.
+    """
+
+    db = attr.ib()
+    table = attr.ib()
+    types = attr.ib(factory=dict)
+    keys = attr.ib(default=None)
+    batch_size = attr.ib(default=500)
+    _rows = attr.ib(factory=list)
+    _done = attr.ib(factory=list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def add(self, rows, done=None):
+        self._rows.extend(rows)
+        if done is not None:
+            self._done.append(done)
+        if len(self._rows) + len(self._done) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows and not self._done:
+            return
+        rows, self._rows = self._rows, []
+        done, self._done = self._done, []
+        with self.db:
+            if rows and self.keys is None:
+                self.table.insert_many(rows, chunk_size=len(rows), types=self.types)
+            elif rows:
+                self.table.update_many(
+                    rows, self.keys, chunk_size=len(rows), types=self.types)
+            if done:
+                mark_done(self.db, done)
+
+
 class Ambiguous(Exception):
     pass
 
 
-def big_prime(n):
-    start = int.from_bytes(os.urandom((n // 8) + 1), sys.byteorder)
-    start &= (2 ** n) - 1
-    start |= 1 << (n - 1)
-    return int(gmpy_cffi.next_prime(start))
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('pragma journal_mode=wal')
+    cursor.execute('pragma synchronous=normal')
+    cursor.close()
+
+
+def connect(url='sqlite:///discogs.db', pool_size=8):
+    """
+    A dataset connection that threads can share.
+
+    dataset already gives each thread its own connection; for SQLite, those
+    come from a pool and run in WAL mode so readers don't block on a writer.
+    """
+
+    if not url.startswith('sqlite'):
+        return dataset.connect(url)
+    db = dataset.connect(url, engine_kwargs=dict(
+        poolclass=sqlalchemy.pool.QueuePool, pool_size=pool_size,
+        connect_args=dict(check_same_thread=False, timeout=30)))
+    sqlalchemy.event.listen(db.engine, 'connect', _sqlite_pragmas)
+    return db
+
+
+URL_COLUMNS = ('resource_url', 'master_url')
+
+
+def url_columns(data):
+    return {column: data.get(column) for column in URL_COLUMNS}
+
+
+def _materialize_urls(db):
+    for table in ['album_discogs', 'artist_album_discogs']:
+        db.query(f"""
+            update {table}
+            set resource_url = json_extract(discogs_data, '$.resource_url'),
+                master_url = json_extract(discogs_data, '$.master_url')
+            where discogs_data is not null
+        """)
+
+
+def _assign_random_keys(db):
+    # sqlite's random() is a signed 64-bit integer; map it onto [0, 1)
+    db.query("""
+        update album_discogs
+        set random_key = random() / 18446744073709551616.0 + 0.5
+        where random_key is null
+    """)
+
+
+MIGRATIONS = [
+    (1, _materialize_urls),
+    (2, _assign_random_keys),
+]
 
 
 @attr.s
 class Matcher:
+    """
+    The discogs client is only made when something needs it, so reading
+    the database works with no network at all.
+
+    Fetches run on up to concurrency threads, all drawing on one token
+    bucket; base_url points the client somewhere other than discogs. GETs
+    are answered from response_cache when it has them fresh. With a
+    catalog, album and artist searches are answered from data dumps instead
+    of the API.
+
+    Before searching for an album, refresh_albums proposes the artist albums
+    already fetched that score at least local_threshold against it; None
+    always searches.
+
+    Each phase journals the entities it has finished; those finished less
+    than refresh_after seconds ago are skipped next time.
+    """
+
     tracks = attr.ib()
-    client = attr.ib()
-    _rate_limiter = attr.ib()
     db = attr.ib()
+    base_url = attr.ib(default=None)
+    concurrency = attr.ib(default=4)
+    response_cache = attr.ib(default=None)
+    catalog = attr.ib(default=None)
+    local_threshold = attr.ib(default=0.8)
+    refresh_after = attr.ib(default=30 * 86400)
+    _caching_fetcher = attr.ib(default=None)
+    _client = attr.ib(default=None)
+    _rate_limiter = attr.ib(default=None)
+    _client_lock = attr.ib(factory=threading.Lock)
+    _grouping = attr.ib(default=None)
+    _grouping_lock = attr.ib(factory=threading.Lock)
 
     @classmethod
-    def from_tracks(cls, tracks):
-        d = discogs_client.Client(
-            'playlistgen/0.1', user_token=tracks.discogs_token)
-        d._fetcher = rate_limiter = RateLimiter(d._fetcher)
-        click.echo('whoami: {!r}'.format(d.identity()))
-        db = dataset.connect('sqlite:///discogs.db')
-        return cls(tracks=tracks, client=d, rate_limiter=rate_limiter, db=db)
+    def from_tracks(cls, tracks, db_url='sqlite:///discogs.db',
+                    cache_url='sqlite:///discogs-cache.db', cache_max_age=None,
+                    dump_url=None, **kw):
+        response_cache = None
+        if cache_url is not None:
+            response_cache = ResponseCache(connect(cache_url))
+            if cache_max_age is not None:
+                response_cache.max_age = cache_max_age
+        catalog = None
+        if dump_url is not None:
+            base_url = (kw.get('base_url') or API_URL).rstrip('/')
+            catalog = Catalog(connect(dump_url), base_url=base_url)
+        return cls(
+            tracks=tracks, db=connect(db_url), response_cache=response_cache,
+            catalog=catalog, **kw)
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                d = discogs_client.Client('playlistgen/0.1')
+                if self.base_url is not None:
+                    d._base_url = self.base_url.rstrip('/')
+                d._fetcher = HeaderFetcher(self.tracks.discogs_token)
+                # 429s are handled by the rate limiter, for every thread at once
+                d.backoff_enabled = False
+                d._fetcher = self._rate_limiter = RateLimiter(d._fetcher)
+                if self.response_cache is not None:
+                    self.response_cache.ensure_tables()
+                    d._fetcher = self._caching_fetcher = CachingFetcher(
+                        d._fetcher, self.response_cache, d._base_url)
+                self._client = d
+            return self._client
+
+    @property
+    def rate_limiter(self):
+        self.client
+        return self._rate_limiter
+
+    @property
+    def grouping(self):
+        with self._grouping_lock:
+            generation = self.tracks.library_generation
+            if self._grouping is None or self._grouping.generation != generation:
+                self._grouping = GroupingIndex.from_songs(self.tracks.all_songs, generation)
+            return self._grouping
+
+    def search(self, *a, **kw):
+        if self.catalog is not None:
+            return self.catalog.search(*a, **kw)
+        return self.client.search(*a, **kw)
+
+    def load_dumps(self, paths):
+        self.catalog.ensure_tables()
+        for path in paths:
+            with tqdm(unit='record', desc=pathlib.Path(path).name) as bar:
+                if not self.catalog.load(path, bar):
+                    log('{path} already loaded', path=path)
 
     @contextmanager
     def using_bar(self, bar):
-        prev, self._rate_limiter.bar = self._rate_limiter.bar, bar
+        layers = [self.rate_limiter]
+        if self._caching_fetcher is not None:
+            layers.append(self._caching_fetcher)
+        prevs = [layer.bar for layer in layers]
+        for layer in layers:
+            layer.bar = bar
         with bar:
             yield bar
-        self._rate_limiter.bar = prev
+        for layer, prev in zip(layers, prevs):
+            layer.bar = prev
+
+    def fetch_all(self, items, fetch, bar):
+        """
+        Run fetch over items on the thread pool, yielding (item, result) as
+        each finishes.
+
+        Only fetch runs off this thread; write results where they're yielded.
+        """
+
+        pool = concurrent.futures.ThreadPoolExecutor(
+            self.concurrency, thread_name_prefix='discogs')
+        try:
+            futures = {pool.submit(fetch, item): item for item in items}
+            for future in concurrent.futures.as_completed(futures):
+                bar.update()
+                yield futures[future], future.result()
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
 
     def ensure_tables(self):
         self.db.create_table('albums', 'album_pid', self.db.types.text)
-        self.db.create_table('album_discogs')
+        album_discogs = self.db.create_table('album_discogs')
         self.db.create_table('artists', 'artist_pid', self.db.types.text)
         self.db.create_table('artist_discogs')
-        self.db.create_table('artist_album_discogs')
-
-    def group_by(self, attr_name):
-        ret = {}
-        for t in self.tracks.all_songs:
-            group = getattr(t, attr_name)()
-            pid = ppis(group)
-            grouping = ret.get(pid)
-            if grouping is None:
-                grouping = ret[pid] = Grouping(pid, group)
-            grouping.tracks.append(t)
-        return ret
-
-    def find_all_albums(self):
-        albums = {}
-        for t in self.tracks.all_songs:
-            album = t.album()
-            albums[album.persistentID()] = album
-        return albums
+        artist_album_discogs = self.db.create_table('artist_album_discogs')
+        album_discogs.create_column('album_pid', self.db.types.text)
+        album_discogs.create_column('discogs_id', self.db.types.integer)
+        album_discogs.create_column('discogs_data', self.db.types.json)
+        album_discogs.create_column(
+            'confirmed', self.db.types.boolean, nullable=False, server_default='0')
+        album_discogs.create_column('random_key', self.db.types.float)
+        artist_album_discogs.create_column('discogs_data', self.db.types.json)
+        artist_discogs.create_column('artist_pid', self.db.types.text)
+        artist_discogs.create_column('discogs_id', self.db.types.integer)
+        artist_discogs.create_column('discogs_data', self.db.types.json)
+        for table in [album_discogs, artist_album_discogs]:
+            for column in URL_COLUMNS:
+                table.create_column(column, self.db.types.text)
+        self.migrate()
+        # confirmed albums match by master_url, or resource_url if they have
+        # no master; sqlite won't look up through coalesce(), so one index each
+        self.db.query("""
+            create index if not exists album_discogs_confirmed_master_url
+            on album_discogs (master_url)
+            where confirmed and discogs_id is not null
+        """)
+        self.db.query("""
+            create index if not exists album_discogs_confirmed_resource_url
+            on album_discogs (resource_url)
+            where confirmed and discogs_id is not null and master_url is null
+        """)
+        self.db.query("""
+            create table if not exists match_journal (
+                phase text not null,
+                entity text not null,
+                state text not null,
+                fetched_at float not null,
+                primary key (phase, entity))
+        """)
+        self.db.query("""
+            create view if not exists artists_from_albums as
+            select album_discogs.album_pid,
+                json_extract(artist.value, '$.id') as discogs_artist_id,
+                json_extract(artist.value, '$.name') as artist_name
+            from album_discogs, json_each(album_discogs.discogs_data, '$.artists') as artist
+            where album_discogs.confirmed
+        """)
+        self.db.query("""
+            create index if not exists album_discogs_unconfirmed_random_key
+            on album_discogs (random_key)
+            where not confirmed
+        """)
+        for table, column in [
+                ('album_discogs', 'album_pid'),
+                ('album_discogs', 'discogs_id'),
+                ('album_discogs', 'resource_url'),
+                ('artist_discogs', 'artist_pid'),
+                ('artist_discogs', 'discogs_id'),
+                ('artist_album_discogs', 'resource_url')]:
+            self.db.query(f"""
+                create index if not exists {table}_{column}
+                on {table} ({column})
+            """)
+
+    def migrate(self):
+        """
+        Bring an existing database up to date, once, tracking progress in
+        sqlite's user_version.
+        """
+
+        [row] = self.db.query('pragma user_version')
+        version = row['user_version']
+        for target, migration in MIGRATIONS:
+            if version >= target:
+                continue
+            with self.db:
+                migration(self.db)
+                self.db.query('pragma user_version = {:d}'.format(target))
+            version = target
 
-    def upsert_album(self, album_group):
+    def writer(self, table_name, **kw):
+        return BatchWriter(self.db, self.db.load_table(table_name), types={
+            'discogs_data': self.db.types.json,
+        }, **kw)
+
+    def upsert_all(self, table_name, key, rows):
+        """
+        Upsert rows by key in batches, telling inserts from updates with one
+        query up front instead of one per row.
+        """
+
+        known = {r[key]: r for r in self.db.query(f'select * from {table_name}')}
+        with self.writer(table_name) as inserts, \
+                self.writer(table_name, keys=[key]) as updates:
+            for row in rows:
+                stored = known.get(row[key])
+                if stored is None:
+                    inserts.add([row])
+                elif any(stored.get(k) != v for k, v in row.items()):
+                    updates.add([row])
+                known[row[key]] = row
+
+    def _album_row(self, album_group):
         album = album_group.group
-        self.db.load_table('albums').upsert({
+        return {
             'album_pid': album_group.pid,
             'title': album.title(),
             'artist': album.albumArtist() or album_group.find_likely_artist(),
-        }, ['album_pid'])
+        }
+
+    def upsert_albums(self, album_groups):
+        self.upsert_all('albums', 'album_pid', map(self._album_row, album_groups))
+
+    @property
+    def fresh_after(self):
+        return time.time() - self.refresh_after
 
     def refetch_albums(self):
-        data_table = self.db.load_table('album_discogs')
-        to_load = list(self.db.query("""
+        to_load = list(self.db.query(f"""
             select id, discogs_id, album_pid from album_discogs
-            where discogs_id is not null
-        """))
-        with self.using_bar(tqdm(to_load, unit='album')) as bar:
-            for album in bar:
-                self._refetch_album(data_table, album)
-
-    def _refetch_album(self, data_table, album):
+            where discogs_id is not null and {not_fresh('id')}
+        """, phase='refetch', fresh_after=self.fresh_after))
+        with self.using_bar(tqdm(total=len(to_load), unit='album')) as bar, \
+                self.writer('album_discogs', keys=['id']) as writer:
+            for album, row in self.fetch_all(to_load, self._refetch_album, bar):
+                writer.add([row] if row is not None else [], done=('refetch', album['id']))
+
+    def _refetch_album(self, album):
         master = self.client.master(album['discogs_id'])
         try:
             master.refresh()
         except discogs_client.exceptions.HTTPError as e:
             if e.status_code != 404:
                 raise
-            return
-        data_table.upsert({
+            return None
+        return {
             'id': album['id'],
             'album_pid': album['album_pid'],
             'discogs_id': master.id,
             'discogs_data': master.data,
-        }, keys=['id'], types={
-            'discogs_data': self.db.types.json,
-        })
+            **url_columns(master.data),
+        }
+
+    def candidate_index(self):
+        """
+        Every artist album fetched so far, one entry per master (or release,
+        if it has no master).
+        """
+
+        index = CandidateIndex()
+        for row in self.db.query("""
+            select id,
+                coalesce(master_url, resource_url) as key,
+                json_extract(discogs_data, '$.title') as title,
+                (select group_concat(json_extract(value, '$.name'), ' ')
+                 from json_each(discogs_data, '$.artists')) as artist
+            from artist_album_discogs
+            where resource_url is not null
+        """):
+            index.add(row['key'], row['title'], row['artist'], payload=row['id'])
+        return index
+
+    def _local_results(self, index, album):
+        candidates = [
+            c for c in index.query(album['title'], album['artist'])
+            if c.score >= self.local_threshold]
+        ret = []
+        for c in candidates:
+            for row in self.db.query("""
+                select discogs_data from artist_album_discogs where id = :id
+            """, id=c.entry.payload):
+                data = json.loads(row['discogs_data'])
+                ret.append(LocalResult(id=data['id'], data=data))
+        return ret
+
+    def evaluate_candidate_index(self, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9)):
+        """
+        Precision and recall of the candidate index's best guess, against
+        albums whose match was confirmed by hand.
+        """
+
+        index = self.candidate_index()
+        confirmed = list(self.db.query("""
+            select albums.title, albums.artist,
+                coalesce(album_discogs.master_url, album_discogs.resource_url) as key
+            from album_discogs
+            join albums using (album_pid)
+            where album_discogs.confirmed and album_discogs.discogs_id is not null
+        """))
+        best = []
+        for row in tqdm(confirmed, unit='album'):
+            candidates = index.query(row['title'], row['artist'], limit=1)
+            if candidates:
+                best.append((candidates[0], row['key']))
+        click.echo(f'{len(index)} candidates, {len(confirmed)} confirmed albums')
+        for threshold in thresholds:
+            proposed = [(c, key) for c, key in best if c.score >= threshold]
+            correct = sum(c.entry.key == key for c, key in proposed)
+            precision = correct / len(proposed) if proposed else 0
+            recall = correct / len(confirmed) if confirmed else 0
+            click.echo(
+                f'>= {threshold:.2f}: proposed {len(proposed)}, '
+                f'precision {precision:.3f}, recall {recall:.3f}')
 
     def refresh_albums(self):
-        data_table = self.db.load_table('album_discogs')
-        to_load = list(self.db.query("""
+        to_load = list(self.db.query(f"""
             select albums.* from albums
             left join album_discogs using (album_pid)
-            where album_discogs.id is null
-        """))
-        with self.using_bar(tqdm(to_load, unit='album')) as bar:
-            for album in bar:
-                self._refresh_album(data_table, album)
+            where album_discogs.id is null and {not_fresh('albums.album_pid')}
+        """, phase='albums', fresh_after=self.fresh_after))
+        index = None
+        if self.local_threshold is not None:
+            index = self.candidate_index()
+        with self.using_bar(tqdm(total=len(to_load), unit='album')) as bar, \
+                self.writer('album_discogs') as writer:
+            for album, rows in self.fetch_all(
+                    to_load, lambda album: self._refresh_album(album, index), bar):
+                writer.add(rows, done=('albums', album['album_pid']))
 
     def _refresh_album_searches(self, album):
         if not album['title']:
@@ -191,94 +685,99 @@ class Matcher:
         yield dict(q=name, type='master')
         yield dict(q=name, type='release')
 
-    def _refresh_album(self, data_table, album):
+    def _refresh_album(self, album, index=None):
         results = []
-        for kw in self._refresh_album_searches(album):
-            results = self.client.search(**kw)
-            if len(results) > 0:
-                break
+        if index is not None and album['title']:
+            results = self._local_results(index, album)
+        if not results:
+            for kw in self._refresh_album_searches(album):
+                results = self.search(**kw)
+                if len(results) > 0:
+                    break
         base = {
             'album_pid': album['album_pid'],
         }
         if len(results) == 0:
-            data_table.insert(base)
-        else:
-            for r in results:
-                r.refresh()
-                data_table.insert({
-                    **base,
-                    'discogs_id': r.id,
-                    'discogs_data': r.data,
-                }, types={
-                    'discogs_data': self.db.types.json,
-                })
+            return [{**base, 'random_key': random.random()}]
+        rows = []
+        for r in results:
+            r.refresh()
+            rows.append({
+                **base,
+                'discogs_id': r.id,
+                'discogs_data': r.data,
+                'random_key': random.random(),
+                **url_columns(r.data),
+            })
+        return rows
 
     def refresh_artist_albums(self):
-        data_table = self.db.load_table('artist_album_discogs')
-        to_load = list(self.db.query("""
+        to_load = list(self.db.query(f"""
             select discogs_artist_id, artist_name
             from artists_from_albums
+            where {not_fresh('discogs_artist_id')}
             group by 1, 2
-        """))
-        with tqdm(to_load, unit='artist') as bar:
-            for row in bar:
-                bar.set_description(row['artist_name'])
-                self._refresh_artist_albums(
-                    data_table, row['discogs_artist_id'])
-
-    def _refresh_artist_albums(self, data_table, id):
+        """, phase='artist_albums', fresh_after=self.fresh_after))
+        ids = [row['discogs_artist_id'] for row in to_load]
+        # workers only read this; it grows here, as rows are written
+        known_urls = {row['resource_url'] for row in self.db.query("""
+            select resource_url from artist_album_discogs
+            where resource_url is not null
+        """)}
+        with self.using_bar(tqdm(total=len(ids), unit='artist')) as bar, \
+                self.writer('artist_album_discogs') as writer:
+            for id, rows in self.fetch_all(
+                    ids, lambda id: self._refresh_artist_albums(known_urls, id), bar):
+                # two artists on the same release both fetch it
+                rows = [r for r in rows if r['resource_url'] not in known_urls]
+                known_urls.update(r['resource_url'] for r in rows)
+                writer.add(rows, done=('artist_albums', id))
+
+    def _refresh_artist_albums(self, known_urls, id):
+        rows = []
         try:
             releases = self.client.artist(id).releases
-        except discogs_client.exceptions.HTTPError as e:
-            if e.status_code != 404:
-                raise
-            return
-        with self.using_bar(tqdm(releases, leave=False, unit='album')) as bar:
-            for release in bar:
-                if data_table.count(resource_url=release.data['resource_url']) > 0:
+            for release in releases:
+                if release.data['resource_url'] in known_urls:
                     continue
                 release.refresh()
                 if not any(a['id'] == id for a in release.data['artists']):
-                    return
-                data_table.insert({
+                    break
+                rows.append({
                     'discogs_data': release.data,
-                    'resource_url': release.data['resource_url'],
-                }, types={
-                    'discogs_data': self.db.types.json,
+                    **url_columns(release.data),
                 })
+        except discogs_client.exceptions.HTTPError as e:
+            if e.status_code != 404:
+                raise
+        return rows
 
     def refresh_artists(self):
-        data_table = self.db.load_table('artist_discogs')
-        to_load = list(self.db.query("""
+        to_load = list(self.db.query(f"""
             select artists.* from artists
             left join artist_discogs using (artist_pid)
-            where artist_discogs.id is null
-        """))
-        bar = tqdm(to_load, unit='artist')
-        for artist in bar:
-            with self.rate_limited():
-                self._refresh_artist(data_table, artist)
-            bar.set_description(f'rate limit at {self.rate_limiter.rate_limit_remaining}')
-
-    def _refresh_artist(self, data_table, artist):
+            where artist_discogs.id is null and {not_fresh('artists.artist_pid')}
+        """, phase='artists', fresh_after=self.fresh_after))
+        with self.using_bar(tqdm(total=len(to_load), unit='artist')) as bar, \
+                self.writer('artist_discogs') as writer:
+            for artist, rows in self.fetch_all(to_load, self._refresh_artist, bar):
+                writer.add(rows, done=('artists', artist['artist_pid']))
+
+    def _refresh_artist(self, artist):
         if artist['name']:
-            results = self.client.search(artist['name'], type='artist')
+            results = self.search(artist['name'], type='artist')
         else:
             results = []
         base = {
             'artist_pid': artist['artist_pid'],
         }
         if len(results) == 0:
-            data_table.insert(base)
-        else:
-            for r in results:
-                data_table.insert({
-                    **base,
-                    'discogs_id': r.id,
-                    'discogs_data': r.data,
-                }, types={
-                    'discogs_data': self.db.types.json,
-                })
+            return [base]
+        return [{
+            **base,
+            'discogs_id': r.id,
+            'discogs_data': r.data,
+        } for r in results]
 
     def match_album(self, album):
         table = self.db.load_table('albums')
@@ -309,18 +808,14 @@ class Matcher:
                 })
                 yield master
 
-    def find_all_artists(self):
-        artists = {}
-        for t in self.tracks.all_songs:
-            artist = t.artist()
-            artists[artist.persistentID()] = artist
-        return artists
-
-    def upsert_artist(self, artist_group):
-        self.db.load_table('artists').upsert({
+    def _artist_row(self, artist_group):
+        return {
             'artist_pid': artist_group.pid,
             'name': artist_group.group.name(),
-        }, ['artist_pid'])
+        }
+
+    def upsert_artists(self, artist_groups):
+        self.upsert_all('artists', 'artist_pid', map(self._artist_row, artist_groups))
 
     def match_artist(self, artist):
         table = self.db.load_table('artists')
@@ -347,37 +842,60 @@ class Matcher:
                 })
                 yield artist
 
-    def random_unconfirmed_albums(self):
-        prime = big_prime(2)
-        return self.db.query("""
-            select *,
-                (albums.rowid*albums.rowid
-                 *albums.rowid*albums.rowid*albums.rowid
-                ) % :prime modp
-            from album_discogs
-            join albums using (album_pid)
-            where not album_discogs.confirmed
-                and modp < :prime / 10
-            order by modp
-            limit 25
-        """, prime=prime)
-
+    def random_unconfirmed_albums(self, n=25):
+        """
+        n unconfirmed albums from a random point in random_key order,
+        wrapping around to the start if the end comes first.
+        """
 
-def run(tracks):
-    m = Matcher.from_tracks(tracks)
+        return self.db.query("""
+            select * from (
+                select * from album_discogs
+                join albums using (album_pid)
+                where not album_discogs.confirmed
+                    and album_discogs.random_key >= :start
+                order by album_discogs.random_key
+                limit :n
+            )
+            union all
+            select * from (
+                select * from album_discogs
+                join albums using (album_pid)
+                where not album_discogs.confirmed
+                    and album_discogs.random_key < :start
+                order by album_discogs.random_key
+                limit :n
+            )
+            limit :n
+        """, start=random.random(), n=n)
+
+
+def run(tracks, base_url=None, concurrency=4, cache_max_age=None, dump_paths=(),
+        local_threshold=0.8, evaluate_local=False, refresh_after=None):
+    """
+    Run every phase, skipping what the journal says is done and fresh.
+
+    With dump_paths, only the phases the dumps can answer run, offline.
+    The API client is only authenticated by the first phase that needs it.
+    """
+
+    m = Matcher.from_tracks(
+        tracks, base_url=base_url, concurrency=concurrency,
+        cache_max_age=cache_max_age,
+        dump_url='sqlite:///discogs-dump.db' if dump_paths else None,
+        local_threshold=local_threshold)
+    if refresh_after is not None:
+        m.refresh_after = refresh_after
     m.ensure_tables()
-    #m.refetch_albums()
-    #m.refresh_artists()
-    m.refresh_artist_albums()
-    return
+    if evaluate_local:
+        m.evaluate_candidate_index()
+        return
+    if dump_paths:
+        m.load_dumps(dump_paths)
+    m.upsert_albums(m.grouping.albums.values())
+    m.upsert_artists(m.grouping.artists.values())
     m.refresh_albums()
-    for album in tqdm(m.group_by('album').values()):
-        m.upsert_album(album)
-    for artist in tqdm(m.group_by('artist').values()):
-        m.upsert_artist(artist)
-    # for album in tqdm(m.find_all_albums().values()):
-    #     with m.rate_limited():
-    #         masters = list(m.match_album(album))
-    # for artist in tqdm(m.find_all_artists().values()):
-    #     with m.rate_limited():
-    #         artists = list(m.match_artist(artist))
+    m.refresh_artists()
+    if not dump_paths:
+        m.refresh_artist_albums()
+        m.refetch_albums()
@@ -0,0 +1,109 @@
+import attr
+import collections
+import itertools
+import simplejson
+import threading
+import time
+
+
+def message_type(message):
+    return message.get('action_type', message.get('message_type'))
+
+
+@attr.s
+class MessageLog:
+    """
+    A bounded eliot destination that readers can wait on and resume from a
+    cursor.
+
+    Each message gets a sequence number; a cursor is the sequence number of
+    the next message a reader hasn't seen yet. Once capacity is reached, the
+    oldest messages are dropped, so a reader that falls far enough behind
+    resumes from the oldest message still held. A cursor past the end can
+    only have come from before a restart, and reads from the start too.
+    """
+
+    capacity = attr.ib(default=10000)
+    _entries = attr.ib(default=None)
+    _next_seq = attr.ib(default=0)
+    _changed = attr.ib(factory=threading.Condition)
+
+    def __attrs_post_init__(self):
+        self._entries = collections.deque(maxlen=self.capacity)
+
+    def write(self, message):
+        with self._changed:
+            self._entries.append(message)
+            self._next_seq += 1
+            self._changed.notify_all()
+
+    @property
+    def cursor(self):
+        with self._changed:
+            return self._next_seq
+
+    @property
+    def messages(self):
+        with self._changed:
+            return list(self._entries)
+
+    def reset(self):
+        with self._changed:
+            self._entries.clear()
+
+    def _clamp(self, cursor):
+        return 0 if cursor > self._next_seq else cursor
+
+    def _since(self, cursor, types):
+        cursor = self._clamp(cursor)
+        first_seq = self._next_seq - len(self._entries)
+        ret = itertools.islice(self._entries, max(0, cursor - first_seq), None)
+        if types:
+            ret = (m for m in ret if message_type(m) in types)
+        return self._next_seq, list(ret)
+
+    def since(self, cursor, types=None):
+        with self._changed:
+            return self._since(cursor, types)
+
+    def wait_since(self, cursor, timeout, types=None):
+        with self._changed:
+            cursor = self._clamp(cursor)
+            self._changed.wait_for(lambda: self._next_seq > cursor, timeout)
+            return self._since(cursor, types)
+
+    def take(self, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: self._entries, timeout)
+            ret = list(self._entries)
+            self._entries.clear()
+            return ret
+
+    def event_stream(self, cursor, types=None, serialize=simplejson.dumps,
+                     duration=60, keepalive=15):
+        """
+        Yield server-sent events for messages from cursor onward.
+
+        The stream ends after duration seconds; EventSource clients reconnect
+        with Last-Event-ID and pick up where they left off.
+        """
+
+        # an id up front, so a client reconnecting before any message still
+        # resumes from here
+        yield 'retry: 1000\nid: {}\n\n'.format(cursor).encode()
+        deadline = time.monotonic() + duration
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            prev_cursor = cursor
+            cursor, messages = self.wait_since(
+                cursor, min(keepalive, remaining), types=types)
+            if messages:
+                yield 'id: {}\ndata: {}\n\n'.format(
+                    cursor, serialize(messages)).encode()
+            elif cursor == prev_cursor:
+                yield b': keepalive\n\n'
+            else:
+                # only messages of other types; move the client past them
+                yield 'id: {}\n\n'.format(cursor).encode()
@@ -0,0 +1,106 @@
+import attr
+import collections
+import re
+import unicodedata
+
+_BRACKETED = re.compile(r'\s*[\(\[][^\)\]]*[\)\]]')
+_NON_WORD = re.compile(r'\W+')
+
+
+def normalize(s):
+    """
+    Lowercase, without accents, bracketed asides ("(Remastered)", discogs'
+    "(2)") or punctuation, and without a leading "the".
+    """
+
+    s = unicodedata.normalize('NFKD', s or '')
+    s = ''.join(c for c in s if not unicodedata.combining(c)).lower()
+    s = _BRACKETED.sub('', s)
+    s = _NON_WORD.sub(' ', s).strip()
+    if s.startswith('the '):
+        s = s[4:]
+    return s
+
+
+def ngrams(s, n=3):
+    s = ' {} '.format(s)
+    return frozenset(s[i:i + n] for i in range(len(s) - n + 1))
+
+
+def dice(a, b):
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+@attr.s(frozen=True)
+class Entry:
+    key = attr.ib()
+    title = attr.ib()
+    artist = attr.ib()
+    payload = attr.ib()
+
+
+@attr.s(frozen=True)
+class Candidate:
+    score = attr.ib()
+    entry = attr.ib()
+
+
+@attr.s
+class CandidateIndex:
+    """
+    Title and artist n-grams of known discogs records, for proposing
+    matches without a search.
+
+    Entries that share a title n-gram with the query are counted up; the
+    best few by count are scored on title and artist similarity together.
+    """
+
+    n = attr.ib(default=3)
+    title_weight = attr.ib(default=0.7)
+    shortlist = attr.ib(default=50)
+    _entries = attr.ib(factory=list)
+    _keys = attr.ib(factory=set)
+    _postings = attr.ib(factory=lambda: collections.defaultdict(list))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, title, artist, payload=None):
+        """
+        Index one record; a key that's already indexed is skipped.
+        """
+
+        if key in self._keys:
+            return
+        self._keys.add(key)
+        entry = Entry(
+            key=key,
+            title=ngrams(normalize(title), self.n),
+            artist=ngrams(normalize(artist), self.n),
+            payload=payload)
+        e = len(self._entries)
+        self._entries.append(entry)
+        for gram in entry.title:
+            self._postings[gram].append(e)
+
+    def score(self, entry, title, artist):
+        title_score = dice(entry.title, title)
+        if not artist:
+            return title_score
+        return (self.title_weight * title_score
+                + (1 - self.title_weight) * dice(entry.artist, artist))
+
+    def query(self, title, artist=None, limit=5):
+        title = ngrams(normalize(title), self.n)
+        artist = ngrams(normalize(artist), self.n) if artist else None
+        counts = collections.Counter()
+        for gram in title:
+            counts.update(self._postings.get(gram, ()))
+        ret = []
+        for e, _ in counts.most_common(self.shortlist):
+            entry = self._entries[e]
+            ret.append(Candidate(score=self.score(entry, title, artist), entry=entry))
+        ret.sort(key=lambda c: c.score, reverse=True)
+        return ret[:limit]
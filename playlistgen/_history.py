@@ -0,0 +1,181 @@
+import attr
+import dataset
+import datetime
+
+# history written before rows were keyed by backend was all AppleScript's
+DEFAULT_BACKEND = 'applescript'
+
+
+def _name_key(name):
+    return '\n'.join(name)
+
+
+def _key_name(key):
+    return tuple(key.split('\n'))
+
+
+@attr.s(frozen=True)
+class HistoricalSelection:
+    id = attr.ib()
+    name = attr.ib()
+    playlist_id = attr.ib()
+    saved_at = attr.ib()
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            id=row['id'],
+            name=_key_name(row['playlist_name']),
+            playlist_id=row['playlist_id'],
+            saved_at=datetime.datetime.fromisoformat(row['saved_at']),
+        )
+
+
+@attr.s
+class SelectionHistory:
+    db = attr.ib()
+
+    @classmethod
+    def from_url(cls, url):
+        ret = cls(db=dataset.connect(url))
+        ret.ensure_tables()
+        return ret
+
+    def _columns(self, table):
+        return {r['name'] for r in self.db.query(f'pragma table_info({table})')}
+
+    def _add_backend_columns(self):
+        with self.db as tx:
+            tx.query('alter table destinations rename to destinations_unkeyed')
+            self._create_destinations(tx)
+            tx.query("""
+                insert into destinations (destination)
+                select destination from destinations_unkeyed
+            """)
+            tx.query('drop table destinations_unkeyed')
+            tx.query(f"""
+                alter table selections
+                add column backend text not null default '{DEFAULT_BACKEND}'
+            """)
+            tx.query('drop index if exists selections_destination_idx')
+
+    def _create_destinations(self, db):
+        db.query(f"""
+            create table if not exists destinations (
+                destination text not null,
+                backend text not null default '{DEFAULT_BACKEND}',
+                primary key (destination, backend)
+            )
+        """)
+
+    def ensure_tables(self):
+        columns = self._columns('destinations')
+        if columns and 'backend' not in columns:
+            self._add_backend_columns()
+        self._create_destinations(self.db)
+        self.db.query(f"""
+            create table if not exists selections (
+                id integer primary key,
+                destination text not null,
+                backend text not null default '{DEFAULT_BACKEND}',
+                playlist_name text not null,
+                playlist_id text,
+                saved_at text not null,
+                current boolean not null default true
+            )
+        """)
+        self.db.query("""
+            create index if not exists selections_destination_backend_idx
+            on selections (destination, backend, current, saved_at)
+        """)
+        self.db.query("""
+            create table if not exists selection_tracks (
+                selection_id integer not null references selections (id),
+                position integer not null,
+                track_pid text not null
+            )
+        """)
+        self.db.query("""
+            create index if not exists selection_tracks_selection_idx
+            on selection_tracks (selection_id)
+        """)
+
+    def has_destination(self, destination, backend=DEFAULT_BACKEND):
+        rows = self.db.query("""
+            select 1 from destinations
+            where destination = :destination
+                and backend = :backend
+        """, destination=destination, backend=backend)
+        return any(True for _ in rows)
+
+    def add_destination(self, destination, backend=DEFAULT_BACKEND):
+        self.db.query("""
+            insert or ignore into destinations (destination, backend)
+            values (:destination, :backend)
+        """, destination=destination, backend=backend)
+
+    def record(self, destination, name, playlist_id, track_pids, saved_at=None,
+               backend=DEFAULT_BACKEND):
+        if saved_at is None:
+            saved_at = datetime.datetime.now()
+        with self.db as tx:
+            tx.query("""
+                insert or ignore into destinations (destination, backend)
+                values (:destination, :backend)
+            """, destination=destination, backend=backend)
+            tx.query("""
+                update selections
+                set current = false
+                where destination = :destination
+                    and backend = :backend
+                    and playlist_name = :playlist_name
+                    and current
+            """, destination=destination, backend=backend, playlist_name=_name_key(name))
+            selection_id = tx['selections'].insert({
+                'destination': destination,
+                'backend': backend,
+                'playlist_name': _name_key(name),
+                'playlist_id': playlist_id,
+                'saved_at': saved_at.isoformat(),
+                'current': True,
+            })
+            tx['selection_tracks'].insert_many([{
+                'selection_id': selection_id,
+                'position': e,
+                'track_pid': pid,
+            } for e, pid in enumerate(track_pids)])
+        return selection_id
+
+    def current_selections(self, destination, backend=DEFAULT_BACKEND):
+        rows = self.db.query("""
+            select id, playlist_name, playlist_id, saved_at
+            from selections
+            where destination = :destination
+                and backend = :backend
+                and current
+            order by saved_at
+        """, destination=destination, backend=backend)
+        return [HistoricalSelection.from_row(r) for r in rows]
+
+    def current_track_pids(self, destination, backend=DEFAULT_BACKEND, exclude=()):
+        params = {'exclude{}'.format(e): id for e, id in enumerate(exclude)}
+        rows = self.db.query("""
+            select distinct track_pid
+            from selections s
+            join selection_tracks st on st.selection_id = s.id
+            where s.destination = :destination
+                and s.backend = :backend
+                and s.current
+                and s.id not in ({})
+        """.format(', '.join(':' + k for k in params)),
+            destination=destination, backend=backend, **params)
+        return {r['track_pid'] for r in rows}
+
+    def forget(self, selections):
+        with self.db as tx:
+            for s in selections:
+                tx.query("""
+                    update selections
+                    set current = false
+                    where id = :id
+                """, id=s.id)
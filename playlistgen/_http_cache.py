@@ -0,0 +1,136 @@
+import attr
+import re
+import threading
+import time
+
+# discogs resources worth caching: masters, releases and artists, and their
+# releases or versions; not searches or anything about the user
+CACHEABLE_PATH = re.compile(
+    r'^/(masters|releases|artists)/\d+(/(releases|versions))?/?(\?|$)')
+
+
+@attr.s(frozen=True)
+class CachedResponse:
+    url = attr.ib()
+    body = attr.ib()
+    etag = attr.ib()
+    last_modified = attr.ib()
+    fetched_at = attr.ib()
+
+
+@attr.s
+class ResponseCache:
+    """
+    GET response bodies by URL, with the validators needed to ask whether
+    they've changed.
+
+    Anything fetched less than max_age seconds ago is fresh; max_age_by_path
+    overrides that for URLs whose path starts with a given prefix.
+    """
+
+    db = attr.ib()
+    max_age = attr.ib(default=30 * 86400)
+    max_age_by_path = attr.ib(factory=dict)
+
+    def ensure_tables(self):
+        table = self.db.create_table('responses', 'url', self.db.types.text)
+        table.create_column('body', self.db.types.text)
+        table.create_column('etag', self.db.types.text)
+        table.create_column('last_modified', self.db.types.text)
+        table.create_column('fetched_at', self.db.types.float)
+
+    def max_age_for(self, path):
+        for prefix, max_age in self.max_age_by_path.items():
+            if path.startswith(prefix):
+                return max_age
+        return self.max_age
+
+    def is_fresh(self, entry, path):
+        return time.time() - entry.fetched_at < self.max_age_for(path)
+
+    def lookup(self, url):
+        for row in self.db.query("""
+            select url, body, etag, last_modified, fetched_at
+            from responses where url = :url
+        """, url=url):
+            return CachedResponse(**row)
+        return None
+
+    def store(self, url, body, etag=None, last_modified=None):
+        self.db.query("""
+            insert into responses (url, body, etag, last_modified, fetched_at)
+            values (:url, :body, :etag, :last_modified, :fetched_at)
+            on conflict (url) do update set
+                body = excluded.body,
+                etag = excluded.etag,
+                last_modified = excluded.last_modified,
+                fetched_at = excluded.fetched_at
+        """, url=url, body=body, etag=etag, last_modified=last_modified,
+            fetched_at=time.time())
+
+    def touch(self, url):
+        self.db.query("""
+            update responses set fetched_at = :fetched_at where url = :url
+        """, url=url, fetched_at=time.time())
+
+
+@attr.s
+class CachingFetcher:
+    """
+    Wraps a discogs fetcher, answering fresh GETs from a ResponseCache and
+    revalidating stale ones with If-None-Match/If-Modified-Since.
+
+    Only GETs of paths matching cacheable go through the cache; everything
+    else is passed straight on.
+
+    The wrapped fetcher needs response_headers: the headers of the last
+    response on this thread.
+    """
+
+    fetcher = attr.ib()
+    cache = attr.ib()
+    base_url = attr.ib()
+    bar = attr.ib(default=None)
+    cacheable = attr.ib(default=CACHEABLE_PATH)
+    hits = attr.ib(default=0)
+    revalidated = attr.ib(default=0)
+    misses = attr.ib(default=0)
+    _lock = attr.ib(factory=threading.Lock)
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        if self.bar is not None:
+            self.bar.set_postfix(
+                hits=self.hits, revalidated=self.revalidated, misses=self.misses,
+                refresh=False)
+
+    def fetch(self, client, method, url, data=None, headers=None, json=True):
+        path = url[len(self.base_url):] if url.startswith(self.base_url) else url
+        if method != 'GET' or data or not self.cacheable.match(path):
+            return self.fetcher.fetch(client, method, url, data, headers, json)
+        entry = self.cache.lookup(url)
+        if entry is not None and self.cache.is_fresh(entry, path):
+            self._count('hits')
+            return entry.body.encode(), 200
+
+        headers = dict(headers or {})
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        content, status_code = self.fetcher.fetch(
+            client, method, url, data, headers, json)
+        if status_code == 304 and entry is not None:
+            self.cache.touch(url)
+            self._count('revalidated')
+            return entry.body.encode(), 200
+        self._count('misses')
+        if status_code == 200:
+            response_headers = self.fetcher.response_headers
+            self.cache.store(
+                url, content.decode(),
+                etag=response_headers.get('ETag'),
+                last_modified=response_headers.get('Last-Modified'))
+        return content, status_code
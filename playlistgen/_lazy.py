@@ -0,0 +1,110 @@
+import attr
+import contextlib
+import eliot
+import functools
+import threading
+
+WARMUP_ACTION = eliot.ActionType(
+    'plg:warmup',
+    eliot.fields(steps=list),
+    eliot.fields(),
+    'library and index structures are being built ahead of requests',
+)
+
+WARMUP_STEP_ACTION = eliot.ActionType(
+    'plg:warmup:step',
+    eliot.fields(step=str),
+    eliot.fields(),
+    'one warmup step is running',
+)
+
+
+# where each instance keeps its locked_reify locks, by attribute name
+_LOCKS = '_locked_reify_locks'
+
+
+def _lock_for(inst, name):
+    # setdefault is atomic, so threads racing here end up with the same lock
+    locks = inst.__dict__.setdefault(_LOCKS, {})
+    return locks.setdefault(name, threading.RLock())
+
+
+class locked_reify:
+    """
+    Like pyramid's reify, but computed only once even when several threads
+    ask at the same time.
+
+    The value is cached in the instance dict, so once it's there no lock is
+    taken again. Locks are per instance, so copies don't wait on each other.
+    """
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        functools.update_wrapper(self, wrapped)
+
+    def __get__(self, inst, objtype=None):
+        if inst is None:
+            return self
+        name = self.wrapped.__name__
+        with _lock_for(inst, name):
+            try:
+                return inst.__dict__[name]
+            except KeyError:
+                pass
+            val = self.wrapped(inst)
+            inst.__dict__[name] = val
+            return val
+
+
+@contextlib.contextmanager
+def forgetting(inst, names):
+    """
+    Drop the reified values of names from inst, holding their locks until
+    the block exits so nothing recomputes them from what's being replaced.
+
+    List names dependents first, the order nested computations take the
+    locks in.
+    """
+
+    with contextlib.ExitStack() as stack:
+        for name in names:
+            stack.enter_context(_lock_for(inst, name))
+        for name in names:
+            inst.__dict__.pop(name, None)
+        yield
+
+
+@attr.s
+class Warmup:
+    """
+    Runs (name, callable) steps once in a background thread; requests wait
+    on it.
+    """
+
+    steps = attr.ib()
+    error = attr.ib(default=None)
+    _ready = attr.ib(factory=threading.Event)
+    _thread = attr.ib(default=None)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='warmup', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with WARMUP_ACTION(steps=[name for name, _ in self.steps]):
+                for name, step in self.steps:
+                    with WARMUP_STEP_ACTION(step=name):
+                        step()
+        except Exception as e:
+            # requests will build what's missing themselves, and fail there
+            self.error = e
+        finally:
+            self._ready.set()
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout):
+        return self._ready.wait(timeout)
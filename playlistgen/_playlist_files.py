@@ -0,0 +1,277 @@
+import attr
+import contextlib
+import os
+import pathlib
+import tempfile
+import urllib.parse
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from zope.interface import Attribute, Interface, implementer
+
+from ._playlist_sync import (
+    AddTracks, BatchResult, CreatePlaylist, RemoveTracks, RenameTracks,
+    UnsupportedOperation)
+
+PID_PREFIX = '#PLAYLISTGEN-PID:'
+PID_URN = 'urn:playlistgen:track:'
+XSPF_NS = {'x': 'http://xspf.org/ns/0/'}
+
+
+class IPlaylistWriter(Interface):
+    history_key = Attribute('Which playlists selection history rows refer to.')
+
+    def write_playlist(names, tracks):
+        pass
+
+    def list_playlists():
+        pass
+
+    def delete_playlists(playlist_ids):
+        pass
+
+    def read_entries(playlist_id):
+        pass
+
+    def run_batch(operations):
+        pass
+
+
+@attr.s(frozen=True)
+class PlaylistEntry:
+    path = attr.ib()
+    seconds = attr.ib()
+    title = attr.ib()
+    artist = attr.ib()
+    album = attr.ib()
+    pid = attr.ib(default=None)
+
+    @classmethod
+    def from_track(cls, track):
+        location = track.location()
+        if location is None:
+            return None
+        return cls(
+            path=pathlib.Path(os.fsdecode(location.fileSystemRepresentation())),
+            seconds=track.totalTime() / 1000,
+            title=track.title() or '',
+            artist=track.artist().name() or '',
+            album=track.album().title() or '',
+            pid=format(track.persistentID(), 'x'),
+        )
+
+
+def m3u8_lines(name, entries):
+    yield '#EXTM3U\n'
+    yield '#PLAYLIST:{}\n'.format(name)
+    for entry in entries:
+        yield '#EXTINF:{:.0f},{} - {}\n'.format(entry.seconds, entry.artist, entry.title)
+        yield '#EXTART:{}\n'.format(entry.artist)
+        yield '#EXTALB:{}\n'.format(entry.album)
+        if entry.pid is not None:
+            yield '{}{}\n'.format(PID_PREFIX, entry.pid)
+        yield '{}\n'.format(entry.path)
+
+
+def read_m3u8(path):
+    ret = []
+    info = {}
+    with open(path, encoding='utf-8') as infile:
+        for line in infile:
+            line = line.rstrip('\n')
+            if line.startswith('#EXTINF:'):
+                seconds, _, rest = line[len('#EXTINF:'):].partition(',')
+                info = {'seconds': float(seconds), 'display': rest}
+            elif line.startswith('#EXTART:'):
+                info['artist'] = line[len('#EXTART:'):]
+            elif line.startswith('#EXTALB:'):
+                info['album'] = line[len('#EXTALB:'):]
+            elif line.startswith(PID_PREFIX):
+                info['pid'] = line[len(PID_PREFIX):]
+            elif line and not line.startswith('#'):
+                artist = info.get('artist', '')
+                title = info.get('display', '')
+                if title.startswith(artist + ' - '):
+                    title = title[len(artist) + 3:]
+                ret.append(PlaylistEntry(
+                    path=pathlib.Path(line), seconds=info.get('seconds', 0),
+                    title=title, artist=artist, album=info.get('album', ''),
+                    pid=info.get('pid')))
+                info = {}
+    return ret
+
+
+def xspf_lines(name, entries):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+    yield '  <title>{}</title>\n'.format(escape(name))
+    yield '  <trackList>\n'
+    for entry in entries:
+        yield '    <track>\n'
+        yield '      <location>{}</location>\n'.format(escape(entry.path.as_uri()))
+        yield '      <title>{}</title>\n'.format(escape(entry.title))
+        yield '      <creator>{}</creator>\n'.format(escape(entry.artist))
+        yield '      <album>{}</album>\n'.format(escape(entry.album))
+        yield '      <duration>{:.0f}</duration>\n'.format(entry.seconds * 1000)
+        if entry.pid is not None:
+            yield '      <identifier>{}{}</identifier>\n'.format(PID_URN, entry.pid)
+        yield '    </track>\n'
+    yield '  </trackList>\n'
+    yield '</playlist>\n'
+
+
+def read_xspf(path):
+    ret = []
+    for track in ET.parse(path).iterfind('x:trackList/x:track', XSPF_NS):
+        def text(tag):
+            return track.findtext('x:' + tag, '', XSPF_NS)
+        pid = text('identifier')
+        ret.append(PlaylistEntry(
+            path=pathlib.Path(urllib.parse.unquote(urllib.parse.urlsplit(text('location')).path)),
+            seconds=float(text('duration') or 0) / 1000,
+            title=text('title'), artist=text('creator'), album=text('album'),
+            pid=pid[len(PID_URN):] if pid.startswith(PID_URN) else None))
+    return ret
+
+
+formats = {
+    'm3u8': m3u8_lines,
+    'xspf': xspf_lines,
+}
+
+readers = {
+    'm3u8': read_m3u8,
+    'xspf': read_xspf,
+}
+
+
+@contextlib.contextmanager
+def atomic_writer(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.' + path.name, suffix='.tmp')
+    try:
+        with open(fd, 'w', encoding='utf-8') as outfile:
+            yield outfile
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp)
+        raise
+
+
+@implementer(IPlaylistWriter)
+@attr.s
+class FileBackend:
+    """
+    Playlists as files under root; a playlist's ID is its path relative to
+    root.
+
+    Adding tracks needs tracks_by_id, called for a mapping of persistent ID
+    to track.
+    """
+
+    root = attr.ib(converter=pathlib.Path)
+    format = attr.ib(default='m3u8')
+    tracks_by_id = attr.ib(default=None)
+    skipped = attr.ib(default=0)
+
+    def path_for(self, names):
+        *container, name = names
+        return self.root.joinpath(*container, '{}.{}'.format(name, self.format))
+
+    @property
+    def history_key(self):
+        return 'file:{}:{}'.format(self.format, self.root.resolve())
+
+    def playlist_id(self, names):
+        return str(self.path_for(names).relative_to(self.root))
+
+    def _entries(self, tracks):
+        for t in tracks:
+            entry = PlaylistEntry.from_track(t)
+            if entry is None:
+                self.skipped += 1
+                continue
+            yield entry
+
+    def _write(self, path, name, entries):
+        with atomic_writer(path) as outfile:
+            outfile.writelines(formats[self.format](name, entries))
+
+    def write_playlist(self, names, tracks):
+        path = self.path_for(names)
+        self._write(path, names[-1], self._entries(tracks))
+        return str(path.relative_to(self.root))
+
+    def read_entries(self, playlist_id):
+        path = self.root / playlist_id
+        if not path.exists():
+            return []
+        return readers[self.format](path)
+
+    def _rewrite(self, playlist_id, entries):
+        path = self.root / playlist_id
+        self._write(path, path.stem, entries)
+
+    def _run_one(self, operation):
+        if isinstance(operation, CreatePlaylist):
+            playlist_id = self.playlist_id(operation.names)
+            if not (self.root / playlist_id).exists():
+                self._rewrite(playlist_id, [])
+            return playlist_id
+        elif isinstance(operation, RenameTracks):
+            renames = dict(operation.renames)
+            for playlist_id in self.list_playlists().values():
+                entries = self.read_entries(playlist_id)
+                if any(e.pid in renames for e in entries):
+                    self._rewrite(playlist_id, [
+                        attr.evolve(e, title=renames[e.pid]) if e.pid in renames else e
+                        for e in entries])
+            return None
+        entries = self.read_entries(operation.playlist_id)
+        if isinstance(operation, AddTracks):
+            tracks_by_id = self.tracks_by_id()
+            existing = {e.pid for e in entries}
+            for pid in operation.tracks:
+                if not operation.dupes and pid in existing:
+                    continue
+                entry = PlaylistEntry.from_track(tracks_by_id[pid])
+                if entry is None:
+                    self.skipped += 1
+                    continue
+                entries.append(entry)
+                existing.add(pid)
+        elif isinstance(operation, RemoveTracks):
+            to_remove = set(operation.tracks)
+            entries = [e for e in entries if e.pid not in to_remove]
+        else:
+            raise UnsupportedOperation(operation)
+        self._rewrite(operation.playlist_id, entries)
+
+    def run_batch(self, operations):
+        ret = []
+        for operation in operations:
+            try:
+                value = self._run_one(operation)
+            except (KeyError, OSError, UnsupportedOperation) as e:
+                ret.append(BatchResult(operation, False, error=[repr(e), -1728]))
+            else:
+                ret.append(BatchResult(operation, True, value=value))
+        return ret
+
+    def list_playlists(self):
+        ret = {}
+        for path in self.root.rglob('*.{}'.format(self.format)):
+            relative = path.relative_to(self.root)
+            ret[relative.parent.parts + (relative.stem,)] = str(relative)
+        return ret
+
+    def delete_playlists(self, playlist_ids):
+        errors = []
+        for playlist_id in playlist_ids:
+            try:
+                (self.root / playlist_id).unlink()
+            except OSError as e:
+                errors.append([playlist_id, e.strerror, e.errno])
+        return errors
@@ -0,0 +1,501 @@
+import attr
+import click
+import collections
+import difflib
+import eliot
+import itertools
+import time
+from zope.interface import Attribute, Interface, implementer
+
+
+SYNC_PLAYLIST_ACTION = eliot.ActionType(
+    'plg:sync_playlist',
+    eliot.fields(name=list, current=int, desired=int),
+    eliot.fields(removals=int, insertions=int, moves=int),
+    'a playlist is being brought up to date',
+)
+
+SYNC_CHUNK_ACTION = eliot.ActionType(
+    'plg:sync_playlist:chunk',
+    eliot.fields(offset=int, size=int, of_n=int),
+    eliot.fields(elapsed=float, committed=int),
+    'one chunk of playlist operations is being applied',
+)
+
+BATCH_ACTION = eliot.ActionType(
+    'plg:playlist_batch',
+    eliot.fields(operations=list),
+    eliot.fields(failures=int),
+    'a batch of playlist mutations is being run',
+)
+
+
+class BackendTimeout(Exception):
+    pass
+
+
+class UnsupportedOperation(Exception):
+    pass
+
+
+@attr.s(frozen=True)
+class Remove:
+    index = attr.ib()
+
+
+@attr.s(frozen=True)
+class Insert:
+    index = attr.ib()
+    track = attr.ib()
+
+
+@attr.s(frozen=True)
+class Move:
+    source = attr.ib()
+    dest = attr.ib()
+
+
+@attr.s(frozen=True)
+class AddTracks:
+    op = 'add'
+    playlist_id = attr.ib()
+    tracks = attr.ib(converter=tuple)
+    dupes = attr.ib(default=False)
+
+    def as_script_args(self):
+        return [self.op, self.playlist_id, list(self.tracks), self.dupes]
+
+
+@attr.s(frozen=True)
+class RemoveTracks:
+    op = 'remove'
+    playlist_id = attr.ib()
+    tracks = attr.ib(converter=tuple)
+
+    def as_script_args(self):
+        return [self.op, self.playlist_id, list(self.tracks)]
+
+
+@attr.s(frozen=True)
+class RenameTracks:
+    op = 'rename'
+    renames = attr.ib(converter=tuple)
+
+    def as_script_args(self):
+        return [self.op, [list(pair) for pair in self.renames]]
+
+
+@attr.s(frozen=True)
+class CreatePlaylist:
+    op = 'create'
+    names = attr.ib(converter=tuple)
+
+    def as_script_args(self):
+        return [self.op, list(self.names)]
+
+
+@attr.s(frozen=True)
+class BatchResult:
+    operation = attr.ib()
+    ok = attr.ib()
+    value = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+    def as_json(self):
+        return {
+            'op': self.operation.op,
+            'ok': self.ok,
+            'value': self.value,
+            'error': self.error,
+        }
+
+
+@attr.s
+class PlaylistBatch:
+    operations = attr.ib(factory=list)
+
+    def _append(self, operation):
+        self.operations.append(operation)
+        return operation
+
+    def add(self, playlist_id, tracks, dupes=False):
+        return self._append(AddTracks(playlist_id, tracks, dupes))
+
+    def remove(self, playlist_id, tracks):
+        return self._append(RemoveTracks(playlist_id, tracks))
+
+    def rename(self, renames):
+        return self._append(RenameTracks(renames))
+
+    def create(self, names):
+        return self._append(CreatePlaylist(names))
+
+    def run(self, backend):
+        if not self.operations:
+            return []
+        with BATCH_ACTION(operations=[o.op for o in self.operations]) as action:
+            results = backend.run_batch(self.operations)
+            action.add_success_fields(failures=sum(not r.ok for r in results))
+        return results
+
+
+def apply_operations(tracks, operations):
+    ret = list(tracks)
+    for op in operations:
+        if isinstance(op, Remove):
+            del ret[op.index]
+        elif isinstance(op, Insert):
+            ret.insert(op.index, op.track)
+        elif isinstance(op, Move):
+            ret.insert(op.dest, ret.pop(op.source))
+        else:
+            raise UnsupportedOperation(op)
+    return ret
+
+
+def diff_tracks(current, desired):
+    """
+    Compute removals, insertions and moves turning current into desired.
+    """
+
+    matcher = difflib.SequenceMatcher(None, current, desired, autojunk=False)
+    kept_current = {}
+    kept_desired = set()
+    for block in matcher.get_matching_blocks():
+        for n in range(block.size):
+            kept_current[block.a + n] = block.b + n
+            kept_desired.add(block.b + n)
+
+    needed = collections.Counter(
+        t for j, t in enumerate(desired) if j not in kept_desired)
+    kept = collections.deque()
+    spares = {}
+    removed = []
+    sim = []
+    for i, t in enumerate(current):
+        token = t, i
+        if i in kept_current:
+            kept.append(token)
+        elif needed[t] > 0:
+            needed[t] -= 1
+            spares.setdefault(t, collections.deque()).append(token)
+        else:
+            removed.append(i)
+            continue
+        sim.append(token)
+    operations = [Remove(i) for i in reversed(removed)]
+
+    counter = itertools.count(len(current))
+    prev = None
+    for j, t in enumerate(desired):
+        if j in kept_desired:
+            prev = kept.popleft()
+            continue
+        pool = spares.get(t)
+        if pool:
+            token = pool.popleft()
+            source = sim.index(token)
+            del sim[source]
+        else:
+            token = source = None
+        dest = 0 if prev is None else sim.index(prev) + 1
+        if token is None:
+            token = t, next(counter)
+            operations.append(Insert(dest, t))
+        elif source != dest:
+            operations.append(Move(source, dest))
+        sim.insert(dest, token)
+        prev = token
+    return operations
+
+
+def append_diff(current, desired):
+    """
+    Compute removals and appends turning current into desired.
+
+    This suits backends which can only delete at a position and add at the
+    end: the longest prefix of desired found in order in current is kept.
+    """
+
+    keep = set()
+    k = 0
+    for i, t in enumerate(current):
+        if k < len(desired) and t == desired[k]:
+            keep.add(i)
+            k += 1
+    operations = [Remove(i) for i in reversed(range(len(current))) if i not in keep]
+    operations.extend(
+        Insert(n, t) for n, t in enumerate(desired[k:], start=k))
+    return operations
+
+
+def count_operations(operations):
+    counts = collections.Counter(type(op) for op in operations)
+    return dict(
+        removals=counts[Remove], insertions=counts[Insert], moves=counts[Move])
+
+
+class IPlaylistBackend(Interface):
+    history_key = Attribute('Which playlists selection history rows refer to.')
+
+    def read_playlist(names):
+        pass
+
+    def diff(current, desired):
+        pass
+
+    def apply(playlist_id, operations):
+        pass
+
+    def delete_playlists(playlist_ids):
+        pass
+
+    def run_batch(operations):
+        pass
+
+
+def normalize_id(pid):
+    return format(int(pid, 16), 'x')
+
+
+@implementer(IPlaylistBackend)
+@attr.s
+class AppleScriptBackend:
+    history_key = 'applescript'
+    scripts = attr.ib()
+
+    def _call(self, name, *args):
+        # only here, so the rest of this module works without macOS
+        import applescript
+        try:
+            return self.scripts.call(name, *args)
+        except applescript.ScriptError as e:
+            # "AppleEvent timed out."
+            if e.number == -1712:
+                raise BackendTimeout(name) from e
+            raise
+
+    def read_playlist(self, names):
+        playlist_id, track_ids = self._call('playlist_track_ids', list(names))
+        return normalize_id(playlist_id), [normalize_id(t) for t in track_ids]
+
+    def diff(self, current, desired):
+        # Music can't reorder a playlist's tracks (its move command only
+        # moves playlists), so Move and mid-playlist Insert can't be sent
+        return append_diff(current, desired)
+
+    def _lower(self, operations):
+        for op in operations:
+            if isinstance(op, Remove):
+                yield ['remove', op.index + 1]
+            elif isinstance(op, Insert):
+                yield ['append', op.track]
+            else:
+                raise UnsupportedOperation(op)
+
+    def apply(self, playlist_id, operations):
+        if operations:
+            self._call('sync_tracks', playlist_id, list(self._lower(operations)))
+
+    def delete_playlists(self, playlist_ids):
+        return self._call('delete_playlists', list(playlist_ids))
+
+    def run_batch(self, operations):
+        raw_results = self._call(
+            'run_batch', [o.as_script_args() for o in operations])
+        ret = []
+        for operation, (ok, *rest) in zip(operations, raw_results):
+            if ok:
+                value = rest[0] if rest else None
+                if isinstance(operation, CreatePlaylist):
+                    value = normalize_id(value)
+                ret.append(BatchResult(operation, True, value=value))
+            else:
+                message, number = rest
+                ret.append(BatchResult(operation, False, error=[message, number]))
+        return ret
+
+
+@implementer(IPlaylistBackend)
+@attr.s
+class RecordingBackend:
+    history_key = 'recording'
+    playlists = attr.ib(factory=dict)
+    names = attr.ib(factory=dict)
+    track_names = attr.ib(factory=dict)
+    calls = attr.ib(factory=list)
+    _ids = attr.ib(factory=lambda: itertools.count(1))
+
+    def read_playlist(self, names):
+        names = tuple(names)
+        self.calls.append(('read_playlist', names))
+        playlist_id = self.names.get(names)
+        if playlist_id is None:
+            playlist_id = self.names[names] = format(next(self._ids), 'x')
+            self.playlists[playlist_id] = []
+        return playlist_id, list(self.playlists[playlist_id])
+
+    def diff(self, current, desired):
+        # the same diff AppleScriptBackend sends, so syncs play out the same
+        return append_diff(current, desired)
+
+    def apply(self, playlist_id, operations):
+        self.calls.append(('apply', playlist_id, list(operations)))
+        self.playlists[playlist_id] = apply_operations(
+            self.playlists[playlist_id], operations)
+
+    def delete_playlists(self, playlist_ids):
+        self.calls.append(('delete_playlists', list(playlist_ids)))
+        errors = []
+        for playlist_id in playlist_ids:
+            if self.playlists.pop(playlist_id, None) is None:
+                errors.append([playlist_id, 'no such playlist', -1728])
+        self.names = {
+            k: v for k, v in self.names.items() if v in self.playlists}
+        return errors
+
+    def _run_one(self, operation):
+        if isinstance(operation, CreatePlaylist):
+            playlist_id, _ = self.read_playlist(operation.names)
+            return playlist_id
+        elif isinstance(operation, RenameTracks):
+            self.track_names.update(operation.renames)
+            return None
+        elif operation.playlist_id not in self.playlists:
+            raise KeyError(operation.playlist_id)
+        tracks = self.playlists[operation.playlist_id]
+        if isinstance(operation, AddTracks):
+            for t in operation.tracks:
+                if operation.dupes or t not in tracks:
+                    tracks.append(t)
+        elif isinstance(operation, RemoveTracks):
+            to_remove = set(operation.tracks)
+            tracks[:] = [t for t in tracks if t not in to_remove]
+        else:
+            raise UnsupportedOperation(operation)
+
+    def run_batch(self, operations):
+        self.calls.append(('run_batch', list(operations)))
+        ret = []
+        for operation in operations:
+            try:
+                value = self._run_one(operation)
+            except (KeyError, UnsupportedOperation) as e:
+                ret.append(BatchResult(operation, False, error=[repr(e), -1728]))
+            else:
+                ret.append(BatchResult(operation, True, value=value))
+        return ret
+
+
+@implementer(IPlaylistBackend)
+@attr.s
+class TimeoutBackend:
+    """
+    Wrap a backend so that applying too many operations at once times out.
+
+    Like a timed-out AppleEvent, the first max_operations of them still go
+    through before the timeout is raised.
+    """
+
+    backend = attr.ib()
+    max_operations = attr.ib()
+    timeouts = attr.ib(default=0)
+
+    @property
+    def history_key(self):
+        return self.backend.history_key
+
+    def read_playlist(self, names):
+        return self.backend.read_playlist(names)
+
+    def diff(self, current, desired):
+        return self.backend.diff(current, desired)
+
+    def apply(self, playlist_id, operations):
+        if len(operations) > self.max_operations:
+            self.timeouts += 1
+            self.backend.apply(playlist_id, operations[:self.max_operations])
+            raise BackendTimeout('apply')
+        self.backend.apply(playlist_id, operations)
+
+    def delete_playlists(self, playlist_ids):
+        return self.backend.delete_playlists(playlist_ids)
+
+    def run_batch(self, operations):
+        return self.backend.run_batch(operations)
+
+
+@attr.s
+class ChunkSizer:
+    size = attr.ib(default=50)
+    minimum = attr.ib(default=1)
+    maximum = attr.ib(default=2000)
+    target_seconds = attr.ib(default=5.0)
+
+    def _clamp(self, size):
+        return max(self.minimum, min(self.maximum, size))
+
+    def observe(self, n_operations, elapsed):
+        if n_operations < self.size:
+            # a short last chunk says little about how big chunks can be
+            return
+        if elapsed <= 0:
+            ideal = self.size * 2
+        else:
+            ideal = int(n_operations * self.target_seconds / elapsed)
+        self.size = self._clamp(min(ideal, self.size * 2))
+
+    def timed_out(self, n_operations):
+        # never grow back to a size that's already timed out
+        self.maximum = max(self.minimum, min(self.maximum, n_operations * 3 // 4))
+        self.size = self._clamp(n_operations // 2)
+
+
+def sync_playlist(backend, names, desired, sizer=None, attempts=5):
+    """
+    Bring a playlist up to date in chunks, resuming after timeouts.
+
+    After a timeout the playlist is read back: if the timed-out chunk had no
+    effect, the sync continues from the last committed chunk; otherwise the
+    remaining operations are diffed again from what's actually there.
+    """
+
+    if sizer is None:
+        sizer = ChunkSizer()
+    desired = list(desired)
+    playlist_id, current = backend.read_playlist(names)
+    with SYNC_PLAYLIST_ACTION(
+            name=list(names), current=len(current), desired=len(desired)) as action:
+        operations = backend.diff(current, desired)
+        counts = count_operations(operations)
+        committed = 0
+        failures = 0
+        while committed < len(operations):
+            chunk = operations[committed:committed + sizer.size]
+            try:
+                with SYNC_CHUNK_ACTION(
+                        offset=committed, size=len(chunk), of_n=len(operations)) as chunk_action:
+                    start = time.monotonic()
+                    backend.apply(playlist_id, chunk)
+                    elapsed = time.monotonic() - start
+                    chunk_action.add_success_fields(
+                        elapsed=elapsed, committed=committed + len(chunk))
+            except BackendTimeout:
+                failures += 1
+                if failures >= attempts:
+                    raise
+                click.echo('.. chunk of {} at {}/{} timed out'.format(
+                    len(chunk), committed, len(operations)))
+                sizer.timed_out(len(chunk))
+                playlist_id, actual = backend.read_playlist(names)
+                if actual != current:
+                    current = actual
+                    operations = backend.diff(current, desired)
+                    committed = 0
+                continue
+            failures = 0
+            current = apply_operations(current, chunk)
+            committed += len(chunk)
+            sizer.observe(len(chunk), elapsed)
+        action.add_success_fields(**counts)
+    return playlist_id
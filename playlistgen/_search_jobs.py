@@ -0,0 +1,133 @@
+import attr
+import collections
+import concurrent.futures
+import threading
+import uuid
+
+
+class SearchCancelled(Exception):
+    pass
+
+
+@attr.s
+class SearchJob:
+    key = attr.ib()
+    id = attr.ib(factory=lambda: uuid.uuid4().hex)
+    future = attr.ib(default=None)
+    n = attr.ib(default=0)
+    of_n = attr.ib(default=0)
+    best_score = attr.ib(default=None)
+    _cancelled = attr.ib(factory=threading.Event)
+    _changed = attr.ib(factory=threading.Condition)
+
+    def report(self, n, of_n, best_score):
+        if self._cancelled.is_set():
+            raise SearchCancelled(self.id)
+        with self._changed:
+            self.n, self.of_n = n + 1, of_n
+            if best_score is not None:
+                self.best_score = best_score
+            self._changed.notify_all()
+
+    def cancel(self):
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+        self._wake()
+
+    def _wake(self, _future=None):
+        with self._changed:
+            self._changed.notify_all()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    @property
+    def status(self):
+        if self.cancelled:
+            return 'cancelled'
+        elif not self.done:
+            return 'running' if self.n > 0 else 'queued'
+        elif self.future.exception() is not None:
+            return 'failed'
+        else:
+            return 'done'
+
+    def as_json(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'n': self.n,
+            'of_n': self.of_n,
+            'best_score': self.best_score,
+        }
+
+    def wait_for_change(self, seen, timeout):
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.n != seen or self.done or self.cancelled, timeout)
+            return self.n
+
+
+@attr.s
+class SearchJobQueue:
+    max_workers = attr.ib(default=2)
+    keep_finished = attr.ib(default=50)
+    _executor = attr.ib(default=None)
+    _jobs = attr.ib(factory=collections.OrderedDict)
+    _in_flight = attr.ib(factory=dict)
+    _lock = attr.ib(factory=threading.Lock)
+
+    def __attrs_post_init__(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='search')
+
+    def submit(self, key, func):
+        """
+        Run func(job) in the pool, or join an identical in-flight job.
+
+        Returns the job and whether it was shared.
+        """
+
+        with self._lock:
+            job = self._in_flight.get(key)
+            if job is not None and not job.done and not job.cancelled:
+                return job, True
+            job = SearchJob(key=key)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+            self._evict()
+            job.future = self._executor.submit(func, job)
+        job.future.add_done_callback(job._wake)
+        job.future.add_done_callback(lambda _: self._finished(job))
+        return job, False
+
+    def _finished(self, job):
+        with self._lock:
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+
+    def _evict(self):
+        finished = [j for j in self._jobs.values() if j.done or j.cancelled]
+        for job in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job.id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if self._in_flight.get(job.key) is job:
+                del self._in_flight[job.key]
+        job.cancel()
+        return job
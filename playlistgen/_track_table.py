@@ -0,0 +1,308 @@
+import attr
+import concurrent.futures
+import Foundation
+import multiprocessing
+import numpy
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+from . import _search_jobs
+
+COLUMNS = {
+    'persistent_ids': 'uint64',
+    'total_times': 'float64',
+    'album_codes': 'int32',
+    'album_artist_codes': 'int32',
+    # seconds since the NSDate reference date, or NaN for no date
+    'last_played_dates': 'float64',
+    'skip_dates': 'float64',
+    'added_dates': 'float64',
+}
+
+
+def _date_column_value(date):
+    if date is None:
+        return numpy.nan
+    return date.timeIntervalSinceReferenceDate()
+
+
+class _Vocabulary:
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value):
+        ret = self._codes.get(value)
+        if ret is None:
+            ret = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return ret
+
+
+@attr.s(frozen=True)
+class TableDescriptor:
+    segments = attr.ib()
+    length = attr.ib()
+    album_pids = attr.ib()
+    album_artists = attr.ib()
+
+
+@attr.s
+class TrackTable:
+    """
+    Columnar copy of the track data searches need, shareable across processes.
+    """
+
+    columns = attr.ib()
+    album_pids = attr.ib()
+    album_artists = attr.ib()
+    _segments = attr.ib(factory=list)
+
+    @classmethod
+    def from_tracks(cls, tracks):
+        albums = _Vocabulary()
+        album_artists = _Vocabulary()
+        columns = {
+            name: numpy.zeros(len(tracks), dtype=dtype)
+            for name, dtype in COLUMNS.items()}
+        for e, t in enumerate(tracks):
+            album = t.album()
+            columns['persistent_ids'][e] = t.persistentID()
+            columns['total_times'][e] = t.totalTime()
+            columns['album_codes'][e] = albums.code(album.persistentID())
+            columns['album_artist_codes'][e] = album_artists.code(album.artist().name())
+            columns['last_played_dates'][e] = _date_column_value(t.lastPlayedDate())
+            columns['skip_dates'][e] = _date_column_value(t.skipDate())
+            columns['added_dates'][e] = _date_column_value(t.addedDate())
+        return cls(
+            columns=columns, album_pids=albums.values,
+            album_artists=album_artists.values)
+
+    def __len__(self):
+        return len(self.columns['persistent_ids'])
+
+    def share(self):
+        segments = {}
+        for name, column in self.columns.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(1, column.nbytes))
+            shared = numpy.ndarray(column.shape, dtype=column.dtype, buffer=shm.buf)
+            shared[:] = column
+            self.columns[name] = shared
+            self._segments.append(shm)
+            segments[name] = shm.name
+        return TableDescriptor(
+            segments=segments, length=len(self),
+            album_pids=self.album_pids, album_artists=self.album_artists)
+
+    @classmethod
+    def attach(cls, descriptor):
+        columns = {}
+        segments = []
+        for name, shm_name in descriptor.segments.items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            segments.append(shm)
+            columns[name] = numpy.ndarray(
+                (descriptor.length,), dtype=COLUMNS[name], buffer=shm.buf)
+        return cls(
+            columns=columns, album_pids=descriptor.album_pids,
+            album_artists=descriptor.album_artists, segments=segments)
+
+    def close(self, unlink=False):
+        for shm in self._segments:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        self._segments = []
+
+    def rows(self):
+        return [TableTrack(self, e) for e in range(len(self))]
+
+    def rows_by_pid(self):
+        return {
+            format(int(pid), 'x'): e
+            for e, pid in enumerate(self.columns['persistent_ids'])}
+
+    def pids_of(self, rows):
+        return [format(int(pid), 'x') for pid in self.columns['persistent_ids'][rows]]
+
+
+@attr.s(frozen=True)
+class _TableArtist:
+    _name = attr.ib()
+
+    def name(self):
+        return self._name
+
+
+@attr.s(frozen=True)
+class _TableAlbum:
+    _table = attr.ib()
+    _row = attr.ib()
+
+    def persistentID(self):
+        return self._table.album_pids[self._table.columns['album_codes'][self._row]]
+
+    def artist(self):
+        artist_code = self._table.columns['album_artist_codes'][self._row]
+        return _TableArtist(self._table.album_artists[artist_code])
+
+
+@attr.s(frozen=True, eq=False)
+class TableTrack:
+    """
+    Stands in for an ITLibMediaItem, answering from a TrackTable row.
+
+    Only the accessors that criteria use are provided.
+    """
+
+    _table = attr.ib()
+    row = attr.ib()
+
+    def persistentID(self):
+        return int(self._table.columns['persistent_ids'][self.row])
+
+    def totalTime(self):
+        return self._table.columns['total_times'][self.row]
+
+    def album(self):
+        return _TableAlbum(self._table, self.row)
+
+    def _date(self, name):
+        value = self._table.columns[name][self.row]
+        if numpy.isnan(value):
+            return None
+        return Foundation.NSDate.dateWithTimeIntervalSinceReferenceDate_(float(value))
+
+    def lastPlayedDate(self):
+        return self._date('last_played_dates')
+
+    def skipDate(self):
+        return self._date('skip_dates')
+
+    def addedDate(self):
+        return self._date('added_dates')
+
+
+@attr.s(frozen=True)
+class SearchResult:
+    score = attr.ib()
+    rows = attr.ib()
+    explanations = attr.ib()
+
+
+_worker_table = None
+_worker_rows = None
+_worker_prepared = None
+
+
+def _attach_worker(descriptor):
+    global _worker_table, _worker_rows, _worker_prepared
+    from . import playlistgen
+
+    _worker_table = TrackTable.attach(descriptor)
+    _worker_rows = _worker_table.rows()
+    _worker_prepared = playlistgen.prepared_criteria_cache()
+
+
+def _search_worker(raw_criteria, exclude_rows, params, seed, progress_queue, cancelled):
+    import random
+    from . import playlistgen
+
+    tracklist = [r for r in _worker_rows if r.row not in exclude_rows]
+    context = playlistgen.TrackContext(
+        source_playlists=(), dest_playlist=None, start_playing=False,
+        raw_criteria=list(raw_criteria), rng=random.Random(seed))
+    last_report = 0
+
+    def progress(n, of_n, best_score):
+        nonlocal last_report
+        now = time.monotonic()
+        if now - last_report < 0.1 and n + 1 < of_n:
+            return
+        last_report = now
+        if cancelled is not None and cancelled.is_set():
+            raise _search_jobs.SearchCancelled()
+        if progress_queue is not None:
+            progress_queue.put((n, of_n, best_score))
+
+    selections = playlistgen.search_criteria(
+        context, tracklist=tracklist, progress=progress, prepared=_worker_prepared,
+        **params)
+    return [SearchResult(
+        score=str(s.score),
+        rows=numpy.array([tracklist[i].row for i in s.track_indices], dtype='int32'),
+        explanations=[e.format() for e in s.explanations.collapsed()],
+    ) for s in selections]
+
+
+@attr.s
+class SearchPool:
+    """
+    Runs searches in worker processes attached to a shared TrackTable.
+    """
+
+    tracks = attr.ib()
+    max_workers = attr.ib(default=2)
+    _table = attr.ib(default=None)
+    _rows_by_pid = attr.ib(default=None)
+    _executor = attr.ib(default=None)
+    _manager = attr.ib(default=None)
+    _lock = attr.ib(factory=threading.Lock)
+
+    def start(self):
+        self._ensure_started()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            mp_context = multiprocessing.get_context('spawn')
+            self._table = TrackTable.from_tracks(self.tracks.tracklist)
+            self._rows_by_pid = self._table.rows_by_pid()
+            descriptor = self._table.share()
+            self._manager = mp_context.Manager()
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=mp_context,
+                initializer=_attach_worker, initargs=(descriptor,))
+
+    def search(self, raw_criteria, exclude_pids, params, progress=None):
+        self._ensure_started()
+        exclude_rows = frozenset(
+            self._rows_by_pid[pid] for pid in exclude_pids if pid in self._rows_by_pid)
+        seed = self.tracks.rng.getrandbits(64)
+        if progress is None:
+            progress_queue = cancelled = None
+        else:
+            progress_queue = self._manager.Queue()
+            cancelled = self._manager.Event()
+        future = self._executor.submit(
+            _search_worker, tuple(raw_criteria), exclude_rows, params, seed,
+            progress_queue, cancelled)
+        if progress is not None:
+            self._relay_progress(future, progress_queue, cancelled, progress)
+        return [{
+            'score': r.score,
+            'tracks': self._table.pids_of(r.rows),
+            'explanations': r.explanations,
+        } for r in future.result()]
+
+    def _relay_progress(self, future, progress_queue, cancelled, progress):
+        while not future.done():
+            try:
+                n, of_n, best_score = progress_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                progress(n, of_n, best_score)
+            except _search_jobs.SearchCancelled:
+                cancelled.set()
+                future.cancel()
+                raise
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._manager.shutdown()
+            self._table.close(unlink=True)
@@ -0,0 +1,243 @@
+import attr
+import gzip
+import hashlib
+import threading
+from pyramid.response import Response
+
+from .playlistgen import ppis
+
+
+@attr.s(frozen=True)
+class EncodedBody:
+    body = attr.ib()
+    gzipped = attr.ib()
+    etag = attr.ib()
+
+    @classmethod
+    def from_bytes(cls, body, generation):
+        return cls(
+            body=body,
+            gzipped=gzip.compress(body, compresslevel=6),
+            etag='{}-{}'.format(generation, hashlib.sha1(body).hexdigest()),
+        )
+
+    def response(self, request, content_type='application/json'):
+        response = Response(content_type=content_type, charset=None)
+        response.vary = ('Accept', 'Accept-Encoding')
+        if 'gzip' in request.accept_encoding:
+            response.body = self.gzipped
+            response.content_encoding = 'gzip'
+            response.etag = self.etag + '-gz'
+        else:
+            response.body = self.body
+            response.etag = self.etag
+        response.conditional_response = True
+        return response
+
+
+def json_array_body(key, chunks):
+    return b''.join([b'{"', key.encode(), b'": [', b', '.join(chunks), b']}'])
+
+
+def track_columns(objs):
+    """
+    Column-oriented form of serialized tracks, with albums and artists
+    dictionary-encoded.
+
+    Each track's position in the columns is its ordinal.
+    """
+
+    albums = {}
+    album_columns = {'ppis': [], 'title': []}
+    artists = {}
+    artist_names = []
+    tracks = {
+        'ppis': [], 'album': [], 'artist': [],
+        'title': [], 'trackNumber': [], 'totalTime': []}
+    for obj in objs:
+        album = albums.get(obj['albumPpis'])
+        if album is None:
+            album = albums[obj['albumPpis']] = len(album_columns['ppis'])
+            album_columns['ppis'].append(obj['albumPpis'])
+            album_columns['title'].append(obj['album'])
+        artist = artists.get(obj['artist'])
+        if artist is None:
+            artist = artists[obj['artist']] = len(artist_names)
+            artist_names.append(obj['artist'])
+        tracks['ppis'].append(obj['ppis'])
+        tracks['album'].append(album)
+        tracks['artist'].append(artist)
+        tracks['title'].append(obj['title'])
+        tracks['trackNumber'].append(obj['trackNumber'])
+        tracks['totalTime'].append(obj['totalTime'])
+    return {
+        'count': len(tracks['ppis']),
+        'tracks': tracks,
+        'albums': album_columns,
+        'artists': artist_names,
+    }
+
+
+@attr.s
+class TrackOrdinals:
+    """
+    Maps track ppis to the ordinals of one generation's track columns.
+
+    Tracks outside the columns are numbered on from the end of them and
+    collected in extra, in ordinal order.
+    """
+
+    generation = attr.ib()
+    ordinals = attr.ib()
+    extra = attr.ib(factory=list)
+    _extra_ordinals = attr.ib(factory=dict)
+
+    def encode(self, pids):
+        ret = []
+        for pid in pids:
+            ordinal = self.ordinals.get(pid)
+            if ordinal is None:
+                ordinal = self._extra_ordinals.get(pid)
+            if ordinal is None:
+                ordinal = self._extra_ordinals[pid] = len(self.ordinals) + len(self.extra)
+                self.extra.append(pid)
+            ret.append(ordinal)
+        return ret
+
+
+@attr.s
+class TrackPayloads:
+    """
+    Tracks encoded once per library generation, served as ready-made bodies.
+    """
+
+    tracks = attr.ib()
+    as_json = attr.ib()
+    dumps = attr.ib()
+    max_pages = attr.ib(default=64)
+    _generation = attr.ib(default=None)
+    _encoded = attr.ib(factory=dict)
+    _dicts = attr.ib(factory=list)
+    _order = attr.ib(factory=list)
+    _ordinals = attr.ib(factory=dict)
+    _pages = attr.ib(factory=dict)
+    _columns = attr.ib(default=None)
+    _lock = attr.ib(factory=threading.Lock)
+
+    def serialize(self, track):
+        return self.dumps(self.as_json(track))
+
+    def _refresh(self):
+        generation = self.tracks.library_generation
+        if generation == self._generation:
+            return generation
+        full_tracklist = self.tracks.full_tracklist
+        self._order = [ppis(t) for t in full_tracklist]
+        self._dicts = [self.as_json(t) for t in full_tracklist]
+        self._encoded = {
+            pid: self.dumps(d).encode() for pid, d in zip(self._order, self._dicts)}
+        self._ordinals = {pid: e for e, pid in enumerate(self._order)}
+        self._pages = {}
+        self._columns = None
+        self._generation = generation
+        return generation
+
+    def page(self, offset, count):
+        with self._lock:
+            generation = self._refresh()
+            key = offset, count
+            ret = self._pages.get(key)
+            if ret is None:
+                if len(self._pages) >= self.max_pages:
+                    self._pages.clear()
+                chunks = [self._encoded[pid] for pid in self._order[offset:offset + count]]
+                ret = self._pages[key] = EncodedBody.from_bytes(
+                    json_array_body('tracks', chunks), generation)
+            return ret
+
+    def by_ids(self, tracks):
+        with self._lock:
+            generation = self._refresh()
+            chunks = []
+            for t in tracks:
+                pid = ppis(t)
+                chunk = self._encoded.get(pid)
+                if chunk is None:
+                    chunk = self._encoded[pid] = self.serialize(t).encode()
+                chunks.append(chunk)
+            return EncodedBody.from_bytes(json_array_body('tracks', chunks), generation)
+
+    def columns(self):
+        with self._lock:
+            generation = self._refresh()
+            if self._columns is None:
+                body = dict(
+                    track_columns(self._dicts),
+                    format='columns', generation=generation)
+                self._columns = EncodedBody.from_bytes(
+                    self.dumps(body).encode(), generation)
+            return self._columns
+
+    def ordinals(self):
+        with self._lock:
+            generation = self._refresh()
+            return TrackOrdinals(generation=generation, ordinals=self._ordinals)
+
+
+@attr.s(frozen=True)
+class CachedPlaylist:
+    track_ids = attr.ib()
+    children = attr.ib()
+
+
+@attr.s
+class PlaylistCache:
+    """
+    What /_api/playlists says about each playlist, by nested name.
+
+    Entries last until their playlist is invalidated or the library
+    generation changes.
+    """
+
+    tracks = attr.ib()
+    _generation = attr.ib(default=None)
+    _epoch = attr.ib(default=0)
+    _entries = attr.ib(factory=dict)
+    _lock = attr.ib(factory=threading.Lock)
+
+    def _refresh(self):
+        generation = self.tracks.library_generation
+        if generation != self._generation:
+            self._entries = {}
+            self._generation = generation
+            self._epoch += 1
+        return self._epoch
+
+    def _build(self, name):
+        track_ids = [ppis(t) for t in self.tracks.nested_playlist(name).items()]
+        try:
+            children = self.tracks.playlist_children(name)
+        except KeyError:
+            children = {}
+        return CachedPlaylist(
+            track_ids=track_ids,
+            children=[self.tracks.nested_name_for(pl) for pl in children.values()])
+
+    def get(self, name):
+        with self._lock:
+            epoch = self._refresh()
+            ret = self._entries.get(name)
+        if ret is not None:
+            return ret
+        ret = self._build(name)
+        with self._lock:
+            # don't keep what an invalidation raced past
+            if self._refresh() == epoch:
+                self._entries[name] = ret
+        return ret
+
+    def invalidate(self, names):
+        with self._lock:
+            self._epoch += 1
+            for name in names:
+                self._entries.pop(name, None)
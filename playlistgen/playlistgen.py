@@ -9,6 +9,7 @@ import datetime
 import eliot
 import Foundation
 import functools
+import hashlib
 import heapq
 import iTunesLibrary
 import io
@@ -25,7 +26,10 @@ import tqdm
 from pyramid.decorator import reify
 from zope.interface import Interface, implementer
 
-from . import _album_shuffle, _criteria_parser
+from . import (
+    _album_shuffle, _criteria_cache, _criteria_parser, _history, _playlist_files,
+    _playlist_sync)
+from ._lazy import forgetting, locked_reify
 
 zeroth = operator.itemgetter(0)
 
@@ -63,13 +67,6 @@ SAVE_PLAYLIST_ACTION = eliot.ActionType(
     'saving a playlist is being attempted',
 )
 
-SAVE_PLAYLIST_ITER_ACTION = eliot.ActionType(
-    'plg:save_selection:iter',
-    eliot.fields(attempt=int, of_n=int),
-    eliot.fields(done=bool),
-    'one attempt at calling into applescript',
-)
-
 DELETE_OLD_PLAYLISTS_ACTION = eliot.ActionType(
     'plg:delete_old_playlists',
     eliot.fields(which=list),
@@ -78,6 +75,14 @@ DELETE_OLD_PLAYLISTS_ACTION = eliot.ActionType(
 )
 
 
+# reified from the library snapshot, dependents first
+LIBRARY_DERIVED = (
+    'tracklist', 'full_tracklist', '_trackset', 'playlists_by_nested_name',
+    '_playlist_hierarchy', 'playlists_by_name', 'playlists_by_id', 'albums_by_id',
+    'tracks_by_id', 'all_songs', 'library',
+)
+
+
 @attr.s
 class TrackContext(object):
     source_playlists = attr.ib()
@@ -88,50 +93,137 @@ class TrackContext(object):
     dry_run = attr.ib(default=False)
     remove_previous = attr.ib(default=True)
     discogs_token = attr.ib(default=None)
-
-    @reify
-    def dest_playlist(self):
+    history_db = attr.ib(default='sqlite:///history.db')
+    playlist_dir = attr.ib(default=None)
+    playlist_format = attr.ib(default='m3u8')
+    _backend = attr.ib(default=None)
+    library_generation = attr.ib(default=0)
+
+    def bump_library_generation(self):
+        # the library is a snapshot, so take a fresh one
+        with forgetting(self, LIBRARY_DERIVED):
+            self.library_generation += 1
+
+    @locked_reify
+    def backend(self):
+        if self._backend is not None:
+            return self._backend
+        elif self.playlist_dir is not None:
+            return _playlist_files.FileBackend(
+                self.playlist_dir, self.playlist_format,
+                tracks_by_id=lambda: self.tracks_by_id)
+        return _playlist_sync.AppleScriptBackend(scripts)
+
+    @locked_reify
+    def _dest_spec(self):
         dest = self._dest_playlist
         if dest is None:
             raise NoDestination()
         elif '=' not in dest:
             dest = 'single=' + dest
-        ret = parse_criterion(dest).make_from_map(CRITERIA)
-        playlist_map = self.playlists_by_nested_name
-        to_delete = list(ret.filter_pruned(playlist_map.keys()))
+        return dest
+
+    @locked_reify
+    def history(self):
+        return _history.SelectionHistory.from_url(self.history_db)
+
+    @locked_reify
+    def dest_playlist(self):
+        ret = parse_criterion(self._dest_spec).make_from_map(CRITERIA)
+        if not self.history.has_destination(self._dest_spec, self.backend.history_key):
+            self._backfill_history(ret)
+        return ret
+
+    def _old_selections(self):
+        current = {
+            s.name: s
+            for s in self.history.current_selections(self._dest_spec, self.backend.history_key)}
+        return [
+            current[name]
+            for name in self.dest_playlist.prune_dated(
+                (s.saved_at, s.name) for s in current.values())]
+
+    def delete_old_playlists(self):
+        to_delete = self._old_selections()
         if to_delete:
             click.echo('Deleting {} old playlists.'.format(len(to_delete)))
+            names = [s.name for s in to_delete]
             if self.dry_run:
-                click.echo('  .. not actually deleting: {!r}'.format(to_delete))
+                click.echo('  .. not actually deleting: {!r}'.format(names))
             else:
-                ppis_to_delete = [ppis(playlist_map[name]) for name in to_delete]
-                with DELETE_OLD_PLAYLISTS_ACTION(which=to_delete) as action:
-                    script_errors = scripts.call('delete_playlists', ppis_to_delete)
+                with DELETE_OLD_PLAYLISTS_ACTION(which=names) as action:
+                    script_errors = self.backend.delete_playlists(
+                        [s.playlist_id for s in to_delete])
                     action.add_success_fields(errors=applescript_as_json(script_errors))
+                self.history.forget(to_delete)
+
+    def _backfill_history(self, dest):
+        click.echo('Recording previous selections for {!r}.'.format(self._dest_spec))
+        if _playlist_files.IPlaylistWriter.providedBy(self.backend):
+            written = self.backend.list_playlists()
+            pids_by_path = None
+            for date, name in dest.dated_matching(written.keys()):
+                entries = self.backend.read_entries(written[name])
+                if pids_by_path is None and any(e.pid is None for e in entries):
+                    # written before files carried persistent IDs
+                    pids_by_path = self._pids_by_path()
+                pids = [e.pid or pids_by_path.get(e.path) for e in entries]
+                self.history.record(
+                    self._dest_spec, name, written[name], [pid for pid in pids if pid],
+                    saved_at=date, backend=self.backend.history_key)
+            self.history.add_destination(self._dest_spec, self.backend.history_key)
+            return
+
+        playlist_map = self.playlists_by_nested_name
+        for date, name in dest.dated_matching(playlist_map.keys()):
+            playlist = playlist_map[name]
+            self.history.record(
+                self._dest_spec, name, ppis(playlist),
+                [ppis(t) for t in playlist.items()], saved_at=date,
+                backend=self.backend.history_key)
+        self.history.add_destination(self._dest_spec, self.backend.history_key)
+
+    def _pids_by_path(self):
+        ret = {}
+        for t in self.all_songs:
+            entry = _playlist_files.PlaylistEntry.from_track(t)
+            if entry is not None:
+                ret[entry.path] = entry.pid
         return ret
 
-    @reify
+    @locked_reify
     def library(self):
         itl, error = iTunesLibrary.ITLibrary.libraryWithAPIVersion_error_('1.0', None)
         if error is not None:
             raise RuntimeError('not sure what to do with', error)
         return itl
 
-    @reify
+    @locked_reify
     def all_songs(self):
         return [
             t for t in self.library.allMediaItems()
             if t.mediaKind() == iTunesLibrary.ITLibMediaItemMediaKindSong
         ]
 
-    @reify
+    @locked_reify
+    def tracks_by_id(self):
+        return {ppis(t): t for t in self.all_songs}
+
+    @locked_reify
+    def albums_by_id(self):
+        ret = {}
+        for t in self.all_songs:
+            ret.setdefault(ppis(t.album()), t)
+        return ret
+
+    @locked_reify
     def playlists_by_id(self):
         ret = {}
         for pl in self.library.allPlaylists():
             ret[pl.persistentID()] = pl
         return ret
 
-    @reify
+    @locked_reify
     def playlists_by_name(self):
         ret = {}
         for pl in self.library.allPlaylists():
@@ -146,14 +238,14 @@ class TrackContext(object):
             cur = self.playlists_by_id.get(cur.parentID())
         return tuple(reversed(ret))
 
-    @reify
+    @locked_reify
     def playlists_by_nested_name(self):
         ret = {}
         for pl in self.library.allPlaylists():
             ret[self.nested_name_for(pl)] = pl
         return ret
 
-    @reify
+    @locked_reify
     def _playlist_hierarchy(self):
         ret = {}
         for pl in self.library.allPlaylists():
@@ -167,11 +259,16 @@ class TrackContext(object):
             node = children[name].persistentID()
         return self._playlist_hierarchy[node]
 
+    def backend_playlist_id(self, playlist):
+        if _playlist_files.IPlaylistWriter.providedBy(self.backend):
+            return self.backend.playlist_id(self.nested_name_for(playlist))
+        return ppis(playlist)
+
     def nested_playlist(self, names):
         *container, name = names
         return self.playlist_children(container)[name]
 
-    @reify
+    @locked_reify
     def _trackset(self):
         click.echo('Pulling tracks from {!r}.'.format(self.source_playlists))
         ret = set()
@@ -179,21 +276,22 @@ class TrackContext(object):
             ret.update(self.playlists_by_name[name].items())
         return ret
 
-    @reify
+    @locked_reify
     def full_tracklist(self):
         return sorted(self._trackset, key=by_album)
 
-    @reify
+    @locked_reify
     def tracklist(self):
         ret = self._trackset
         try:
             if self.remove_previous:
-                ret.difference_update(self.prev_selection())
+                prev = self.prev_selection_ids()
+                ret = {t for t in ret if ppis(t) not in prev}
         except NoDestination:
             pass
         return sorted(ret, key=by_album)
 
-    @reify
+    @locked_reify
     def criteria(self):
         ret = [c.make_from_map(CRITERIA) for c in self.raw_criteria]
         if not any(IReducerCriterion.providedBy(c) for c in ret):
@@ -204,16 +302,30 @@ class TrackContext(object):
         if self._dest_playlist is None:
             self._dest_playlist = name
 
+    # selections due to be deleted don't count as previous ones, even though
+    # they're only deleted when the next one is saved
+    def previous_selections(self):
+        old = set(self._old_selections())
+        return [
+            s for s in self.history.current_selections(self._dest_spec, self.backend.history_key)
+            if s not in old]
+
+    def prev_selection_ids(self):
+        return self.history.current_track_pids(
+            self._dest_spec, self.backend.history_key,
+            exclude=[s.id for s in self._old_selections()])
+
     def prev_selection(self):
-        playlist_map = self.playlists_by_nested_name
-        matching = self.dest_playlist.filter_matching(playlist_map.keys())
-        ret = set()
-        for name in matching:
-            ret.update(playlist_map[name].items())
-        return ret
+        tracks_by_id = self.tracks_by_id
+        return {
+            tracks_by_id[pid]
+            for pid in self.prev_selection_ids()
+            if pid in tracks_by_id}
 
     def save_selection(self, selection):
-        persistent_tracks = list(selection.track_persistent_ids)
+        track_objs = list(selection.track_objs)
+        persistent_tracks = [ppis(t) for t in track_objs]
+        self.delete_old_playlists()
         splut = self.dest_playlist.next()
         with SAVE_PLAYLIST_ACTION(name=splut):
             click.echo('Putting {} tracks into {!r}.'.format(
@@ -221,26 +333,26 @@ class TrackContext(object):
             if self.dry_run:
                 click.echo('  .. not actually committing the playlist though')
                 return
-            self._save_selection_loop(splut, persistent_tracks)
+            if _playlist_files.IPlaylistWriter.providedBy(self.backend):
+                playlist_id = self.backend.write_playlist(splut, track_objs)
+            else:
+                playlist_id = self._save_selection_loop(splut, persistent_tracks)
+            self.history.record(
+                self._dest_spec, splut, playlist_id, persistent_tracks,
+                backend=self.backend.history_key)
+            self.bump_library_generation()
             click.echo('  .. done')
 
+    @locked_reify
+    def chunk_sizer(self):
+        return _playlist_sync.ChunkSizer()
+
     def _save_selection_loop(self, splut, persistent_tracks):
-        for n in range(5):
-            with SAVE_PLAYLIST_ITER_ACTION(attempt=n, of_n=5) as action:
-                try:
-                    scripts.call(
-                        'fill_tracks', splut, persistent_tracks, self.start_playing)
-                except applescript.ScriptError as e:
-                    # "AppleEvent timed out."
-                    if e.number != -1712:
-                        raise
-                    e_ = e
-                    action.add_success_fields(done=False)
-                else:
-                    action.add_success_fields(done=True)
-                    return
-                click.echo('.. attempt {} timed out'.format(n))
-        raise SaveFailed(splut) from e_
+        try:
+            return _playlist_sync.sync_playlist(
+                self.backend, splut, persistent_tracks, sizer=self.chunk_sizer)
+        except _playlist_sync.BackendTimeout as e:
+            raise SaveFailed(splut) from e
 
     def search_with_criteria(self, **kw):
         return search_criteria(self, **kw)
@@ -288,6 +400,11 @@ class ISelectorCriterion(ICriterion):
         pass
 
 
+class IStatefulCriterion(ICriterion):
+    def for_search():
+        pass
+
+
 class IReducerCriterion(ICriterion):
     def reduce(context):
         pass
@@ -303,10 +420,80 @@ class IPlaylistCriterion(ICriterion):
     def filter_pruned(playlists):
         pass
 
+    def dated_matching(playlists):
+        pass
+
+    def prune_dated(dated):
+        pass
+
     def next():
         pass
 
 
+def for_search_all(criteria):
+    """
+    Copies of prepared criteria for one search: prepared data is shared, but
+    per-search state (like score-unrecent's running tally) starts fresh.
+    """
+
+    if not any(IStatefulCriterion.providedBy(c) for c in criteria):
+        return criteria
+    return [c.for_search() if IStatefulCriterion.providedBy(c) else c for c in criteria]
+
+
+def prepared_size(obj):
+    """
+    Roughly how many entries a prepared criterion holds.
+    """
+
+    if ICriterion.providedBy(obj):
+        return 1 + sum(prepared_size(getattr(obj, a.name)) for a in attr.fields(type(obj)))
+    elif isinstance(obj, dict):
+        return len(obj) + sum(prepared_size(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        return len(obj) + sum(prepared_size(v) for v in obj)
+    return 0
+
+
+def tracklist_fingerprint(tracklist):
+    digest = hashlib.sha1()
+    for t in tracklist:
+        digest.update(ppis(t).encode())
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def prepare_criteria(tracks, tracklist, track_map, cache=None):
+    """
+    The context's criteria, prepared over track_map.
+
+    With a cache, each criterion is looked up by its text, the tracklist and
+    the library generation, and only prepared on a miss.
+    """
+
+    if cache is None:
+        for t in tracks.criteria:
+            t.prepare(track_map)
+        return tracks.criteria
+
+    fingerprint = tracklist_fingerprint(tracklist)
+    ret = []
+    for raw in tracks.raw_criteria:
+        def build(raw=raw):
+            criterion = raw.make_from_map(CRITERIA)
+            criterion.prepare(track_map)
+            return criterion
+        key = repr(raw), fingerprint, tracks.library_generation
+        ret.append(cache.get(key, build))
+    if not any(IReducerCriterion.providedBy(c) for c in ret):
+        ret.append(CriterionProduct())
+    return for_search_all(ret)
+
+
+def prepared_criteria_cache(**kw):
+    return _criteria_cache.PreparedCriteriaCache(size_of=prepared_size, **kw)
+
+
 score_selection_ufunc = numpy.frompyfunc(
     lambda a, b: a.score(b.track_indices), 2, 1)
 score_format_ufunc = numpy.frompyfunc(
@@ -477,7 +664,7 @@ class CriterionUniform(object):
         yield rng.choice(tuple(track_ids))
 
 
-@implementer(ISelectorCriterion)
+@implementer(ISelectorCriterion, IStatefulCriterion)
 @attr.s
 class CriterionAlbumSelector(object):
     name = 'album-selection'
@@ -509,6 +696,10 @@ class CriterionAlbumSelector(object):
         for album in singleton_albums:
             singleton_tracks.update(self._albums.pop(album))
 
+    def for_search(self):
+        return attr.evolve(
+            self, albums_as_criteria=for_search_all(self._albums_as_criteria))
+
     def select(self, rng, track_ids):
         album = rng.choice(self._albums_as_criteria)
         yield from album.select(rng, track_ids)
@@ -531,7 +722,7 @@ class CriterionPickFrom(object):
             yield rng.choice(pick_from)
 
 
-@implementer(ISelectorCriterion)
+@implementer(ISelectorCriterion, IStatefulCriterion)
 @attr.s
 class CriterionArtistSelector(object):
     name = 'artist-selection'
@@ -553,12 +744,16 @@ class CriterionArtistSelector(object):
             subcriterion.prepare(artist_tracks)
             self._artists_as_criteria.append(subcriterion)
 
+    def for_search(self):
+        return attr.evolve(
+            self, artists_as_criteria=for_search_all(self._artists_as_criteria))
+
     def select(self, rng, track_ids):
         artist = rng.choice(self._artists_as_criteria)
         yield from artist.select(rng, track_ids)
 
 
-@implementer(ISelectorCriterion)
+@implementer(ISelectorCriterion, IStatefulCriterion)
 @attr.s
 class CriterionScoreUnrecent:
     name = 'score-unrecent'
@@ -571,6 +766,9 @@ class CriterionScoreUnrecent:
         self._scores = list(
             unrecent_score_tracks(track_map, self.bias_recent_adds, self.unrecentness_days))
 
+    def for_search(self):
+        return attr.evolve(self, cumulative=0)
+
     def select(self, rng, track_ids):
         if not self._scores:
             return
@@ -736,6 +934,13 @@ class CriterionSinglePlaylist:
     def filter_pruned(self, playlists):
         return set()
 
+    def dated_matching(self, playlists):
+        for name in self.filter_matching(playlists):
+            yield datetime.datetime.now(), name
+
+    def prune_dated(self, dated):
+        return set()
+
     def next(self):
         return self.dest
 
@@ -753,7 +958,7 @@ class CriterionStrftime:
         *container, pattern = self._pattern.splitlines()
         return container, pattern
 
-    def _filter_matching(self, playlists):
+    def dated_matching(self, playlists):
         container, pattern = self._splut_pattern
         for name in playlists:
             *c, n = name
@@ -763,16 +968,19 @@ class CriterionStrftime:
             yield playlist_date, name
 
     def filter_matching(self, playlists):
-        return {name for _, name in self._filter_matching(playlists)}
+        return {name for _, name in self.dated_matching(playlists)}
 
     def filter_pruned(self, playlists):
+        return self.prune_dated(self.dated_matching(playlists))
+
+    def prune_dated(self, dated):
         if self.keep_last_days is not None:
-            min_date = datetime.datetime.now() - self.keep_last_days
-            for date, name in self._filter_matching(playlists):
+            min_date = datetime.datetime.now() - datetime.timedelta(days=self.keep_last_days)
+            for date, name in dated:
                 if date < min_date:
                     yield name
         elif self.keep_last_count is not None:
-            matching = sorted(self._filter_matching(playlists))
+            matching = sorted(dated)
             for _, name in matching[:-self.keep_last_count]:
                 yield name
 
@@ -933,7 +1141,7 @@ RECENT_WINNER_MESSAGE = eliot.MessageType(
 )
 
 
-def search_criteria(tracks, tracklist=None, pull_prev=None, keep=None, n_options=None, iterations=None, mercy=None):
+def search_criteria(tracks, tracklist=None, pull_prev=None, keep=None, n_options=None, iterations=None, mercy=None, progress=None, prepared=None):
     rng = tracks.rng
     pull_prev = pull_prev or 25
     keep = keep or 125
@@ -944,21 +1152,22 @@ def search_criteria(tracks, tracklist=None, pull_prev=None, keep=None, n_options
         tracklist = tracks.tracklist
     track_map = dict(enumerate(tracklist))
     all_indices = frozenset(track_map)
-    for t in tracks.criteria:
-        t.prepare(track_map)
-    scorers = [t for t in tracks.criteria if IScorerCriterion.providedBy(t)]
+    criteria = prepare_criteria(tracks, tracklist, track_map, cache=prepared)
+    scorers = [t for t in criteria if IScorerCriterion.providedBy(t)]
     score_tracks = functools.partial(Selection.from_criteria, tracklist, scorers)
-    selectors = [t for t in tracks.criteria if ISelectorCriterion.providedBy(t)]
-    reducers = [t for t in tracks.criteria if IReducerCriterion.providedBy(t)]
+    selectors = [t for t in criteria if ISelectorCriterion.providedBy(t)]
+    reducers = [t for t in criteria if IReducerCriterion.providedBy(t)]
     if len(reducers) != 1:
         raise ValueError('need exactly 1 reducer')
     [reducer] = reducers
     results = []
+    best = None
 
     def safe_sample(pool, n):
         return rng.sample(pool, min(len(pool), n))
 
     def prune():
+        nonlocal best
         with PRUNE_ACTION(starting_n_results=len(results)) as action:
             results_by_track_sets = {frozenset(s.track_indices): s for s in results}
             selections = list(results_by_track_sets.values())
@@ -973,10 +1182,21 @@ def search_criteria(tracks, tracklist=None, pull_prev=None, keep=None, n_options
             )
             results[:] = select_by_iterations(results)
             del results[keep:]
+            if results:
+                best = results[0]
             action.add_success_fields(
                 ending_n_results=len(results),
             )
 
+    def format_score(selection):
+        # as the results will be, though reduced alone rather than among them
+        if isinstance(selection.score, ReducedScore):
+            return str(selection.score)
+        context = ReducerContext.from_parts(tracklist, scorers, [selection])
+        explanations = Explanations()
+        [[[r]]] = explanations.collect(reducer.reduce(context))
+        return str(ReducedScore(explanations, 0, r, selection.score, reducer))
+
     def an_option(prev):
         relevant_indices = all_indices.difference(prev.track_indices)
         if selectors:
@@ -989,6 +1209,7 @@ def search_criteria(tracks, tracklist=None, pull_prev=None, keep=None, n_options
 
     previous = [score_tracks(())] * pull_prev
     readds = 0
+    reported = best_score = None
 
     with SEARCH_ACTION():
         for n in tqdm.trange(iterations):
@@ -1005,6 +1226,8 @@ def search_criteria(tracks, tracklist=None, pull_prev=None, keep=None, n_options
                     VIABLE_MESSAGE.log(candidates=len(options))
                     results.append(rng.choice(options).with_iteration(n))
                     readds = 0
+                    if best is None or results[-1].score > best.score:
+                        best = results[-1]
                 else:
                     results.append(prev_selection.with_explanation(
                         'readded after beating all {n_options} of its successors',
@@ -1018,6 +1241,10 @@ def search_criteria(tracks, tracklist=None, pull_prev=None, keep=None, n_options
 
                 winner = results[-1]
                 RECENT_WINNER_MESSAGE.log(modified_in=winner.modified_in)
+                if progress is not None:
+                    if best is not None and best.score is not reported:
+                        reported, best_score = best.score, format_score(best)
+                    progress(n, iterations, best_score)
 
         prune()
 
@@ -1044,6 +1271,7 @@ CRITERIA = {cls.name: cls for cls in [
 parse_criterion = functools.partial(
     _criteria_parser.parse, valid_names=CRITERIA.keys())
 parse_criterion.__name__ = 'criterion'
+cached_parse_criterion = functools.lru_cache(maxsize=256)(parse_criterion)
 
 
 def unrecent_score_tracks(track_map, bias_recent_adds, unrecentness_days):
@@ -1056,6 +1284,9 @@ def unrecent_score_tracks(track_map, bias_recent_adds, unrecentness_days):
             if d is not None)
         return nsnow.timeIntervalSinceDate_(when)
 
+    def added_delta_for(t):
+        return nsnow.timeIntervalSinceDate_(t.addedDate())
+
     unrecentness = unrecentness_days * 60 * 60 * 24
     tracklist = [(delta_for(t), e, t) for e, t in track_map.items()]
     tracklist.sort(key=zeroth)
@@ -1065,7 +1296,7 @@ def unrecent_score_tracks(track_map, bias_recent_adds, unrecentness_days):
     def score(delta, track):
         score = delta ** 0.5
         if bias_recent_adds:
-            score /= nsnow.timeIntervalSinceDate_(track.addedDate()) ** 0.5
+            score /= added_delta_for(track) ** 0.5
         return score
 
     tracklist = [(score(played, track), e, track) for played, e, track in tracklist]
@@ -1156,6 +1387,13 @@ def search_and_choose(f):
               help="remove previously-selected tracks")
 @click.option('-t', '--discogs-token', metavar='TOKEN', envvar='DISCOGS_TOKEN',
               help='Discogs user token.')
+@click.option('--playlist-dir', metavar='DIR',
+              type=click.Path(file_okay=False, dir_okay=True, writable=True),
+              help='Write playlist files here instead of into Music.')
+@click.option('--playlist-format', type=click.Choice(['m3u8', 'xspf']),
+              default='m3u8', help='Format of written playlist files.')
+@click.option('--history-db', metavar='URL', default='sqlite:///history.db',
+              help='Database recording previously-saved selections.')
 @click.option('--eliot-logfile', type=click.File('a'))
 def main(ctx, source_playlist, criterion, debug, eliot_logfile, **kw):
     """
@@ -1210,25 +1448,55 @@ def daily_unrecent(tracks):
 @main.command()
 @click.pass_obj
 @click.option('--listen', default='[::1]:0', metavar='HOST')
+@click.option('--search-concurrency', default=2, metavar='N',
+              help='searches to run at once')
+@click.option('--search-processes', default=2, metavar='N',
+              help='worker processes for searches; 0 searches in-thread')
+@click.option('--artwork-cache', default='artwork-cache', metavar='DIR',
+              help='where album artwork and its thumbnails are kept')
 @click.argument('argv', nargs=-1)
-def web(tracks, listen, argv):
+def web(tracks, listen, search_concurrency, search_processes, artwork_cache, argv):
     """
     Do it in a browser.
     """
 
     from . import playlistweb
-    playlistweb.run(tracks, listen, argv)
+    playlistweb.run(
+        tracks, listen, argv, search_concurrency=search_concurrency,
+        search_processes=search_processes, artwork_cache_dir=artwork_cache)
 
 
 @main.command()
 @click.pass_obj
-def match(tracks):
+@click.option('--discogs-url', default=None, metavar='URL',
+              help='discogs API to talk to, in place of api.discogs.com')
+@click.option('--concurrency', default=4, metavar='N',
+              help='discogs requests to keep in flight')
+@click.option('--cache-max-age', default=30.0, metavar='DAYS',
+              help='reuse cached discogs responses younger than this')
+@click.option('--from-dump', 'dump_paths', multiple=True, metavar='PATH',
+              type=click.Path(exists=True, dir_okay=False),
+              help='match offline against a discogs XML data dump (repeatable)')
+@click.option('--local-threshold', default=0.8, metavar='SCORE',
+              help='take fetched artist albums scoring this well instead of searching')
+@click.option('--evaluate-local', is_flag=True,
+              help='report how local matching does against confirmed albums')
+@click.option('--refresh-after', default=30.0, metavar='DAYS',
+              help='fetch again what was last fetched longer ago than this')
+def match(tracks, discogs_url, concurrency, cache_max_age, dump_paths,
+          local_threshold, evaluate_local, refresh_after):
     """
     Match against discogs.
+
+    Runs every phase; an interrupted run picks up where it stopped.
     """
 
     from . import _discogs_match
-    _discogs_match.run(tracks)
+    _discogs_match.run(
+        tracks, base_url=discogs_url, concurrency=concurrency,
+        cache_max_age=cache_max_age * 86400, dump_paths=dump_paths,
+        local_threshold=local_threshold, evaluate_local=evaluate_local,
+        refresh_after=refresh_after * 86400)
 
 
 @main.command()
@@ -14,20 +14,23 @@ import numpy
 import random
 import simplejson
 import sys
-import time
 import waitress
 import webbrowser
 from cornice import Service
 from cornice.validators import marshmallow_validator
 from marshmallow import Schema, ValidationError, fields, validate
 from pyramid.config import Configurator
-from pyramid.httpexceptions import HTTPException, HTTPFound, HTTPNotFound, HTTPNotImplemented
+from pyramid.httpexceptions import (
+    HTTPBadRequest, HTTPException, HTTPFound, HTTPNotFound, HTTPNotImplemented,
+    HTTPServiceUnavailable)
 from pyramid.request import Request
 from pyramid.response import Response
 from pyramid.renderers import JSON
 from pyramid.view import view_config
 
-from . import playlistgen
+from . import (
+    _artwork_cache, _discogs_match, _event_log, _lazy, _playlist_sync, _search_jobs,
+    _track_table, _web_cache, playlistgen)
 from .playlistgen import ppis
 
 log = logging.getLogger(__name__)
@@ -113,16 +116,27 @@ def serialize_itunes(obj, *a, **kw):
     return simplejson.dumps(itunes_as_json(obj), *a, **kw)
 
 
-def track_methods(tracks, argv):
-    tracks_by_id = {ppis(t): t for t in tracks.all_songs}
+COLUMNS_CONTENT_TYPE = 'application/vnd.playlistgen.columns+json'
+
+
+class FormatQuerySchema(Schema):
+    format = fields.String(validate=validate.OneOf(['objects', 'columns']))
+
+
+def _wants_columns(request):
+    requested = request.validated.get('querystring', {}).get('format')
+    if requested is not None:
+        return requested == 'columns'
+    offers = request.accept.acceptable_offers(['application/json', COLUMNS_CONTENT_TYPE])
+    return bool(offers) and offers[0][0] == COLUMNS_CONTENT_TYPE
+
 
+def track_methods(tracks, argv):
     def configurate(config):
         config.add_request_method(lambda _: argv, name='web_argv', reify=True)
         config.add_request_method(lambda _: tracks, name='tracks', reify=True)
-        config.add_request_method(lambda _: tracks_by_id, name='tracks_by_id', reify=True)
-        config.add_request_method(
-            lambda _: _discogs_match.Matcher.from_tracks(tracks),
-            name='discogs_matcher', reify=True)
+        config.add_request_method(lambda _: tracks.tracks_by_id, name='tracks_by_id', reify=True)
+        config.add_request_method(lambda _: tracks.albums_by_id, name='albums_by_id', reify=True)
 
     return configurate
 
@@ -146,20 +160,41 @@ def web_argv(request):
     }
 
 
+def _message_cursor(request, default='0'):
+    try:
+        return int(request.GET.get('since', default))
+    except ValueError:
+        raise HTTPBadRequest()
+
+
+def _message_types(request):
+    return frozenset(request.GET.getall('type')) or None
+
+
 @view_config(route_name='messages', renderer='json')
 def messages(request):
-    return {'eliot': request.eliot_messages.messages}
+    cursor, messages = request.eliot_messages.since(
+        _message_cursor(request), types=_message_types(request))
+    return {'eliot': messages, 'cursor': cursor}
 
 
 @view_config(route_name='get_reset_messages', renderer='json', request_method='POST')
 def get_reset_messages(request):
-    ret = []
-    for n in range(125):
-        ret = request.eliot_messages.messages
-        if not ret:
-            time.sleep(0.25)
-    request.eliot_messages.reset()
-    return {'eliot': ret}
+    return {'eliot': request.eliot_messages.take(timeout=31)}
+
+
+@view_config(route_name='messages_stream')
+def messages_stream(request):
+    # a new stream starts from now; a reconnecting one from where it left off
+    cursor = _message_cursor(
+        request, default=request.headers.get(
+            'Last-Event-ID', request.eliot_messages.cursor))
+    response = Response(
+        app_iter=request.eliot_messages.event_stream(
+            cursor, types=_message_types(request), serialize=serialize_itunes),
+        content_type='text/event-stream')
+    response.cache_control = 'no-cache'
+    return response
 
 
 artwork_content_types = {
@@ -172,28 +207,84 @@ artwork_content_types = {
 }
 
 
+ARTWORK_CACHE_CONTROL = 'public, max-age=86400'
+
+
+def _artwork_size(request):
+    try:
+        return int(request.params['size'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _cached_artwork(request, album_pid, track):
+    return request.artwork_cache.get(
+        album_pid, track, artwork_content_types, size=_artwork_size(request))
+
+
+def _artwork_response(request, body, content_type, etag):
+    response = Response(body=body, content_type=content_type)
+    response.etag = etag
+    response.cache_control = ARTWORK_CACHE_CONTROL
+    response.conditional_response = True
+    return response
+
+
+def _album_artwork_response(request, album_pid, track):
+    try:
+        artwork = _cached_artwork(request, album_pid, track)
+    except _artwork_cache.UnsupportedArtwork:
+        raise HTTPNotImplemented()
+    if artwork is None:
+        raise HTTPNotFound()
+    return _artwork_response(request, artwork.read(), artwork.content_type, artwork.etag)
+
+
 @view_config(route_name='track_artwork')
 def track_artwork(request):
     track = request.tracks_by_id.get(request.matchdict['id'])
     if track is None:
         raise HTTPNotFound()
-    artwork = track.artwork()
-    if artwork is None:
+    return _album_artwork_response(request, ppis(track.album()), track)
+
+
+@view_config(route_name='album_artwork')
+def album_artwork(request):
+    album_pid = request.matchdict['id']
+    track = request.albums_by_id.get(album_pid)
+    if track is None:
         raise HTTPNotFound()
-    content_type = artwork_content_types.get(artwork.imageDataFormat())
-    if content_type is None:
-        raise HTTPNotImplemented()
-    return Response(
-        body=artwork.imageData().bytes(),
-        content_type=content_type)
+    return _album_artwork_response(request, album_pid, track)
+
+
+@view_config(route_name='album_artwork_bundle')
+def album_artwork_bundle(request):
+    """
+    Artwork for a page of albums as one multipart/mixed response, one part
+    per album with its ID as the Content-ID. Albums without artwork are
+    left out.
+    """
+
+    parts = []
+    for album_pid in filter(None, request.params.get('ids', '').split(',')):
+        track = request.albums_by_id.get(album_pid)
+        if track is None:
+            continue
+        try:
+            artwork = _cached_artwork(request, album_pid, track)
+        except _artwork_cache.UnsupportedArtwork:
+            continue
+        if artwork is not None:
+            parts.append((album_pid, artwork))
+    body, boundary, etag = _artwork_cache.multipart_bundle(parts)
+    return _artwork_response(
+        request, body, 'multipart/mixed; boundary="{}"'.format(boundary), etag)
 
 
 @view_config(route_name='unconfirmed_albums', renderer='json')
 def unconfirmed_albums(request):
     m = request.discogs_matcher
-    albums = m.group_by('album')
-    for group in albums.values():
-        group.tracks.sort(key=playlistgen.album_track_position)
+    albums = m.grouping.albums
     rows = list(m.random_unconfirmed_albums())
     for row in rows:
         row['album_discogs_id'] = row.pop('id')
@@ -220,40 +311,23 @@ def pick(d, *keys, **transform):
 @view_config(route_name='all_artist_albums', renderer='json')
 def all_artist_albums(request):
     db = request.discogs_matcher.db
-    db.query("""
-        create temporary table if not exists ad_ids as
-        select rowid,
-            coalesce(
-                json_extract(ad.discogs_data, '$.master_url'),
-                json_extract(ad.discogs_data, '$.resource_url'))
-            resource_url
-        from album_discogs ad
-        where confirmed
-        and discogs_id is not null
-    """)
-    db.query("""
-        create index if not exists ad_ids_resource_idx
-        on ad_ids (resource_url)
-    """)
-    db.query("""
-        create temporary table if not exists aad_ids as
-        select rowid,
-            json_extract(aad.discogs_data, '$.resource_url') resource_url
-        from artist_album_discogs aad
-    """)
-    db.query("""
-        create index if not exists aad_ids_resource_idx
-        on aad_ids (resource_url)
-    """)
     rows = db.query("""
-        select resource_url,
+        select aad.resource_url,
             aad.discogs_data,
-            ad_ids.id is not null matched
-        from aad_ids
-        left join ad_ids using (resource_url)
-        join artist_album_discogs aad on aad_ids.id = aad.id
-        left join album_discogs ad on ad_ids.id = ad.id
-        group by 1
+            exists (
+                select 1 from album_discogs ad
+                where ad.master_url = aad.resource_url
+                    and ad.confirmed
+                    and ad.discogs_id is not null
+            ) or exists (
+                select 1 from album_discogs ad
+                where ad.resource_url = aad.resource_url
+                    and ad.master_url is null
+                    and ad.confirmed
+                    and ad.discogs_id is not null
+            ) matched
+        from artist_album_discogs aad
+        group by aad.resource_url
     """)
     return {'albums': [{
         'discogs_data': pick(
@@ -267,6 +341,11 @@ def all_artist_albums(request):
 
 confirm_service = Service(name='confirm', path='/_api/confirm')
 
+
+class RenameFailed(Exception):
+    pass
+
+
 class ConfirmBodySchema(Schema):
     db_id = fields.Integer(required=True)
     album_pid = fields.String(required=True)
@@ -292,8 +371,12 @@ def confirm(request):
     db = request.discogs_matcher.db
 
     if data['rename']:
-        playlistgen.scripts.call(
-            'rename_tracks', [[ppis(t), n] for t, n in data['rename']])
+        batch = _playlist_sync.PlaylistBatch()
+        batch.rename([(ppis(t), n) for t, n in data['rename']])
+        [result] = batch.run(request.tracks.backend)
+        request.tracks.bump_library_generation()
+        if not result.ok:
+            raise RenameFailed(result.error)
 
     if data['op'] == 'found':
         db.query("""
@@ -307,7 +390,9 @@ def confirm(request):
             update album_discogs
             set confirmed = true,
                 discogs_id = NULL,
-                discogs_data = NULL
+                discogs_data = NULL,
+                resource_url = NULL,
+                master_url = NULL
             where not confirmed
                 and id = :db_id
         """, **data)
@@ -322,12 +407,15 @@ def confirm(request):
             update album_discogs
             set confirmed = true,
                 discogs_id = :discogs_id,
-                discogs_data = :discogs_data
+                discogs_data = :discogs_data,
+                resource_url = :resource_url,
+                master_url = :master_url
             where not confirmed
                 and id = :id
         """,
             discogs_id=data['replace_with']['id'],
             discogs_data=json.dumps(data['replace_with']),
+            **_discogs_match.url_columns(data['replace_with']),
             id=data['db_id'],
         )
 
@@ -353,9 +441,17 @@ class PlaylistsSchema(Schema):
     class Meta:
         unknown = marshmallow.EXCLUDE
 
+    querystring = fields.Nested(FormatQuerySchema)
     body = fields.Nested(PlaylistsBodySchema)
 
 
+class PlaylistsQuerySchema(Schema):
+    class Meta:
+        unknown = marshmallow.EXCLUDE
+
+    querystring = fields.Nested(FormatQuerySchema)
+
+
 def _default_playlists(tracks):
     return [
         pl
@@ -365,54 +461,68 @@ def _default_playlists(tracks):
         and not pl.name().startswith('<')
     ]
 
-def _playlists_response(playlists, tracks, include_previous_selections=False):
-    def _tracks_of(name):
-        return [ppis(t) for t in tracks.nested_playlist(name).items()]
-
-    all_names = set()
+def _playlists_response(playlists, tracks, cache, include_previous_selections=False,
+                        ordinals=None):
     ret = []
-    to_add = set(playlists)
-    while to_add:
-        names_to_add = {tracks.nested_name_for(pl) for pl in to_add}
+    all_names = set()
+    names_to_add = {tracks.nested_name_for(pl) for pl in playlists}
+    while names_to_add:
         all_names.update(names_to_add)
-        to_add = set()
+        children = set()
         for name in names_to_add:
+            cached = cache.get(name)
             ret.append({
                 'name': name,
-                'tracks': _tracks_of(name),
+                'tracks': cached.track_ids,
                 'was_selection': False,
             })
-            try:
-                children = tracks.playlist_children(name)
-            except KeyError:
-                continue
-            to_add.update(children.values())
-        to_add.difference_update(all_names)
+            children.update(cached.children)
+        names_to_add = children - all_names
 
     if include_previous_selections:
         ret.extend(
             {
-                'name': name,
-                'tracks': _tracks_of(name),
+                'name': s.name,
+                'tracks': cache.get(s.name).track_ids,
                 'was_selection': True,
             }
-            for name in tracks.dest_playlist.filter_matching(
-                tracks.playlists_by_nested_name.keys()))
+            for s in tracks.previous_selections()
+            if s.name in tracks.playlists_by_nested_name)
+
+    if ordinals is None:
+        return {
+            'playlists': ret,
+        }
 
+    for pl in ret:
+        pl['tracks'] = ordinals.encode(pl['tracks'])
     return {
+        'format': 'columns',
+        'generation': ordinals.generation,
         'playlists': ret,
+        'extra': ordinals.extra,
     }
 
 
-@playlists_service.get()
+def _playlist_ordinals(request):
+    if _wants_columns(request):
+        return request.track_payloads.ordinals()
+    return None
+
+
+@playlists_service.get(schema=PlaylistsQuerySchema, validators=(marshmallow_validator,))
 def get_playlists(request):
-    return _playlists_response([], request.tracks)
+    return _playlists_response(
+        [], request.tracks, request.playlist_cache, ordinals=_playlist_ordinals(request))
 
 
 @playlists_service.post(schema=PlaylistsSchema, validators=(marshmallow_validator,))
 def get_specific_playlists(request):
     playlists = list(request.validated['body']['names'])
-    return _playlists_response(playlists, request.tracks, request.validated['body']['include_previous_selections'])
+    return _playlists_response(
+        playlists, request.tracks, request.playlist_cache,
+        request.validated['body']['include_previous_selections'],
+        ordinals=_playlist_ordinals(request))
 
 
 tracks_service = Service(name='tracks', path='/_api/tracks')
@@ -422,6 +532,7 @@ class TracksQuerySchema(Schema):
     offset = fields.Integer(missing=0)
     count = fields.Integer(missing=2500)
     by_id = DelimitedString(',', TrackField)
+    format = fields.String(validate=validate.OneOf(['objects', 'columns']))
 
 
 class TracksSchema(Schema):
@@ -435,11 +546,13 @@ class TracksSchema(Schema):
 def tracks(request):
     parsed = request.validated['querystring']
     if 'by_id' in parsed:
-        tracks = parsed['by_id']
+        encoded = request.track_payloads.by_ids(parsed['by_id'])
+    elif _wants_columns(request):
+        return request.track_payloads.columns().response(
+            request, content_type=COLUMNS_CONTENT_TYPE)
     else:
-        offset = parsed['offset']
-        tracks = request.tracks.full_tracklist[offset : offset + parsed['count']]
-    return {'tracks': tracks}
+        encoded = request.track_payloads.page(parsed['offset'], parsed['count'])
+    return encoded.response(request)
 
 
 shuffle_together_albums_service = Service(
@@ -482,7 +595,7 @@ class TimefillCriteriaBodySchema(Schema):
     iterations = fields.Integer()
     exclude = fields.List(TrackField(), missing=())
     criteria = fields.List(
-        fields.Function(deserialize=lambda s: playlistgen.parse_criterion(s)), missing=())
+        fields.Function(deserialize=lambda s: playlistgen.cached_parse_criterion(s)), missing=())
 
 
 class TimefillCriteriaSchema(Schema):
@@ -492,15 +605,20 @@ class TimefillCriteriaSchema(Schema):
     body = fields.Nested(TimefillCriteriaBodySchema)
 
 
-@timefill_criteria_service.post(schema=TimefillCriteriaSchema, validators=(marshmallow_validator,))
-def timefill_criteria(request):
-    parsed = request.validated['body']
+def _run_timefill(tracks, parsed, search_pool=None, progress=None, prepared=None):
     to_exclude = set(parsed.pop('exclude'))
-    local_tracklist = list(set(request.tracks.tracklist) - to_exclude)
-    raw_criteria = tuple(request.tracks.raw_criteria) + tuple(parsed.pop('criteria'))
-    local_tracks = attr.evolve(request.tracks, raw_criteria=raw_criteria)
+    raw_criteria = tuple(tracks.raw_criteria) + tuple(parsed.pop('criteria'))
+    if search_pool is not None:
+        playlists = search_pool.search(
+            raw_criteria, {ppis(t) for t in to_exclude}, parsed, progress=progress)
+        return {'playlists': playlists}
+
+    # keep tracklist order stable so prepared criteria can be reused
+    local_tracklist = [t for t in tracks.tracklist if t not in to_exclude]
+    local_tracks = attr.evolve(tracks, raw_criteria=raw_criteria)
     selections = playlistgen.search_criteria(
-        local_tracks, tracklist=local_tracklist, **parsed)
+        local_tracks, tracklist=local_tracklist, progress=progress, prepared=prepared,
+        **parsed)
     playlists = [{
         'score': str(s.score),
         'tracks': list(s.track_persistent_ids),
@@ -509,6 +627,73 @@ def timefill_criteria(request):
     return {'playlists': playlists}
 
 
+@timefill_criteria_service.post(schema=TimefillCriteriaSchema, validators=(marshmallow_validator,))
+def timefill_criteria(request):
+    return _run_timefill(
+        request.tracks, request.validated['body'], search_pool=request.search_pool,
+        prepared=request.prepared_criteria)
+
+
+search_jobs_service = Service(name='search_jobs', path='/_api/search-jobs')
+search_job_service = Service(name='search_job', path='/_api/search-jobs/{id}')
+search_job_progress_service = Service(
+    name='search_job_progress', path='/_api/search-jobs/{id}/progress')
+SEARCH_JOB_POLL_SECONDS = 5
+
+
+@search_jobs_service.post(schema=TimefillCriteriaSchema, validators=(marshmallow_validator,))
+def create_search_job(request):
+    parsed = request.validated['body']
+    tracks = request.tracks
+    key = simplejson.dumps(request.json_body, sort_keys=True)
+    search_pool = request.search_pool
+    prepared = request.prepared_criteria
+    job, shared = request.search_jobs.submit(
+        key, lambda job: _run_timefill(
+            tracks, parsed, search_pool=search_pool, progress=job.report,
+            prepared=prepared))
+    return {**job.as_json(), 'shared': shared}
+
+
+def _search_job(request):
+    job = request.search_jobs.get(request.matchdict['id'])
+    if job is None:
+        raise HTTPNotFound()
+    return job
+
+
+@search_job_service.get()
+def get_search_job(request):
+    job = _search_job(request)
+    ret = job.as_json()
+    if ret['status'] == 'done':
+        ret.update(job.future.result())
+    return ret
+
+
+@search_job_service.delete()
+def cancel_search_job(request):
+    job = _search_job(request)
+    request.search_jobs.cancel(job.id)
+    return job.as_json()
+
+
+@search_job_progress_service.get()
+def search_job_progress(request):
+    """
+    Long-poll: answer once the job has moved past iteration `seen`, or after
+    a few seconds regardless, so no server thread is held for a whole search.
+    """
+
+    job = _search_job(request)
+    try:
+        seen = int(request.GET.get('seen', '-1'))
+    except ValueError:
+        raise HTTPBadRequest()
+    job.wait_for_change(seen, timeout=SEARCH_JOB_POLL_SECONDS)
+    return job.as_json()
+
+
 modify_playlists_service = Service(name='modify_playlists', path='/_api/modify-playlists')
 
 
@@ -533,14 +718,22 @@ class ModifyPlaylistsSchema(Schema):
 def modify_playlists(request):
     parsed = request.validated['body']
     all_playlists = []
+    batch = _playlist_sync.PlaylistBatch()
     for mod in parsed['modifications']:
         playlist = mod['name']
         all_playlists.append(playlist)
-        playlistgen.scripts.call(
-            'append_tracks', ppis(playlist), [ppis(t) for t in mod['add']], False)
-        playlistgen.scripts.call(
-            'remove_tracks', ppis(playlist), [ppis(t) for t in mod['remove']])
-    return _playlists_response(all_playlists, request.tracks)
+        if mod['add']:
+            batch.add(
+                request.tracks.backend_playlist_id(playlist), [ppis(t) for t in mod['add']])
+        if mod['remove']:
+            batch.remove(
+                request.tracks.backend_playlist_id(playlist), [ppis(t) for t in mod['remove']])
+    results = batch.run(request.tracks.backend)
+    request.playlist_cache.invalidate(
+        request.tracks.nested_name_for(pl) for pl in all_playlists)
+    ret = _playlists_response(all_playlists, request.tracks, request.playlist_cache)
+    ret['results'] = [r.as_json() for r in results]
+    return ret
 
 
 save_service = Service(name='save', path='/_api/save')
@@ -580,16 +773,79 @@ def api_exception_view(exc, request):
     }
 
 
-def build_app(tracks, argv):
-    eliot_messages = eliot.MemoryLogger()
+# these answer without the library, so they don't wait for warmup
+WARMUP_EXEMPT_PREFIXES = ('/_api/messages', '/_api/argv')
+
+
+def warmup_tween_factory(handler, registry):
+    warmup = registry.settings['warmup']
+    timeout = registry.settings['warmup_timeout']
+
+    def warmup_tween(request):
+        if (request.path.startswith('/_api/')
+                and not request.path.startswith(WARMUP_EXEMPT_PREFIXES)
+                and not warmup.wait(timeout)):
+            return HTTPServiceUnavailable(
+                'still loading the library', headers={'Retry-After': '1'})
+        return handler(request)
+
+    return warmup_tween
+
+
+def warmup_steps(tracks, track_payloads, search_pool, discogs_matcher):
+    ret = [
+        ('library', lambda: tracks.library),
+        ('all_songs', lambda: tracks.all_songs),
+        ('playlists_by_id', lambda: tracks.playlists_by_id),
+        ('playlists_by_name', lambda: tracks.playlists_by_name),
+        ('playlists_by_nested_name', lambda: tracks.playlists_by_nested_name),
+        ('playlist_hierarchy', lambda: tracks._playlist_hierarchy),
+        ('tracks_by_id', lambda: tracks.tracks_by_id),
+        ('albums_by_id', lambda: tracks.albums_by_id),
+        ('tracklist', lambda: tracks.tracklist),
+        ('track_columns', track_payloads.columns),
+        ('discogs_tables', discogs_matcher.ensure_tables),
+        ('discogs_grouping', lambda: discogs_matcher.grouping),
+    ]
+    if search_pool is not None:
+        ret.append(('search_pool', search_pool.start))
+    return ret
+
+
+def build_app(tracks, argv, search_concurrency=2, search_processes=2,
+              artwork_cache_dir='artwork-cache', warmup_timeout=30):
+    eliot_messages = _event_log.MessageLog()
     eliot.add_destinations(eliot_messages.write)
+    search_jobs = _search_jobs.SearchJobQueue(max_workers=search_concurrency)
+    track_payloads = _web_cache.TrackPayloads(tracks, itunes_as_json, simplejson.dumps)
+    artwork_cache = _artwork_cache.ArtworkCache(artwork_cache_dir)
+    playlist_cache = _web_cache.PlaylistCache(tracks)
+    prepared_criteria = playlistgen.prepared_criteria_cache()
+    if search_processes > 0:
+        search_pool = _track_table.SearchPool(tracks, max_workers=search_processes)
+    else:
+        search_pool = None
+
+    discogs_matcher = _discogs_match.Matcher.from_tracks(tracks)
+    warmup = _lazy.Warmup(
+        warmup_steps(tracks, track_payloads, search_pool, discogs_matcher))
 
     from . import playlistweb
-    with Configurator() as config:
+    with Configurator(settings={'warmup': warmup, 'warmup_timeout': warmup_timeout}) as config:
         config.add_request_method(lambda _: eliot_messages, name='eliot_messages', reify=True)
+        config.add_request_method(lambda _: search_jobs, name='search_jobs', reify=True)
+        config.add_request_method(lambda _: search_pool, name='search_pool', reify=True)
+        config.add_request_method(lambda _: track_payloads, name='track_payloads', reify=True)
+        config.add_request_method(lambda _: artwork_cache, name='artwork_cache', reify=True)
+        config.add_request_method(lambda _: playlist_cache, name='playlist_cache', reify=True)
+        config.add_request_method(
+            lambda _: prepared_criteria, name='prepared_criteria', reify=True)
+        config.add_request_method(
+            lambda _: discogs_matcher, name='discogs_matcher', reify=True)
 
         config.include('cornice')
         config.include(track_methods(tracks, argv))
+        config.add_tween('playlistgen.playlistweb.warmup_tween_factory')
         config.add_renderer('json', JSON(serialize_itunes))
         config.scan(playlistweb)
 
@@ -601,16 +857,30 @@ def build_app(tracks, argv):
             config.add_route('web_argv', 'argv')
             config.add_route('messages', 'messages')
             config.add_route('get_reset_messages', 'messages/with-reset')
+            config.add_route('messages_stream', 'messages/stream')
             config.add_route('genius_albums', 'genius-albums')
             config.add_route('track_artwork', 'track/{id}/artwork')
+            config.add_route('album_artwork_bundle', 'album/artwork-bundle')
+            config.add_route('album_artwork', 'album/{id}/artwork')
             config.add_route('unconfirmed_albums', 'unconfirmed/albums')
             config.add_route('all_artist_albums', 'all-artist-albums')
             config.add_exception_view(api_exception_view, renderer='json')
 
         app = config.make_wsgi_app()
+    warmup.start()
     return app
 
 
-def run(tracks, listen, argv):
-    app = build_app(tracks, argv)
-    waitress.serve(app, listen=listen)
+# each open log panel holds a waitress thread with its message stream
+MESSAGE_STREAMS = 4
+
+
+def run(tracks, listen, argv, search_concurrency=2, search_processes=2,
+        artwork_cache_dir='artwork-cache'):
+    app = build_app(
+        tracks, argv, search_concurrency=search_concurrency,
+        search_processes=search_processes, artwork_cache_dir=artwork_cache_dir)
+    # waitress's own 4, plus a thread per message stream and per search job
+    # being long-polled for progress
+    threads = 4 + MESSAGE_STREAMS + search_concurrency
+    waitress.serve(app, listen=listen, threads=threads)
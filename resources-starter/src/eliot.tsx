@@ -3,12 +3,10 @@ import * as React from 'react'
 import { CountUpFrom, DateBetween } from './timer'
 import { List, Map, Record, Set } from 'immutable'
 import { Newtype, iso } from 'newtype-ts'
-import axios, { AxiosResponse } from 'axios'
 
 import BounceLoader from 'react-spinners/BounceLoader'
 import { CustomError } from 'ts-custom-error'
 import { DateTime } from 'luxon'
-import { useQuery } from 'react-query'
 
 export interface Uuid
     extends Newtype<{ readonly Uuid: unique symbol }, string> {}
@@ -364,14 +362,12 @@ export const LogComponent: React.FC<{}> = () => {
         new OpenLog(),
     )
 
-    const lastLog = useQuery(
-        'lastLog',
-        () => axios.post<{ eliot: Task[] }>('/_api/messages/with-reset'),
-        {
-            refetchInterval: 50,
-            onSuccess: ({ data }) => dispatch(data.eliot),
-        },
-    )
+    React.useEffect(() => {
+        const source = new EventSource('/_api/messages/stream')
+        source.onmessage = (ev: MessageEvent<string>) =>
+            dispatch(JSON.parse(ev.data))
+        return () => source.close()
+    }, [])
 
     return (
         <>
@@ -2,9 +2,9 @@ import * as React from 'react'
 
 import { AnimatePresence, motion } from 'framer-motion'
 import { List, Map, Record, Set } from 'immutable'
-import { RawTrack, Track, TrackId } from './types'
-import axios, { AxiosResponse } from 'axios'
-import { useInfiniteQuery, useMutation, useQuery } from 'react-query'
+import { RawTrack, Track, TrackId, isoTrackId } from './types'
+import axios from 'axios'
+import { useMutation, useQuery } from 'react-query'
 
 import { LogComponent } from './eliot'
 import PulseLoader from 'react-spinners/PulseLoader'
@@ -44,7 +44,7 @@ export const ConnectedTrackArtworkComponent: React.FC<{
     const id = props.track.id
     return (
         <img
-            src={`/_api/track/${id}/artwork`}
+            src={`/_api/track/${id}/artwork?size=256`}
             onError={() => trackArtworkMissing(id)}
         />
     )
@@ -57,6 +57,64 @@ export type Playlists = {
     tracks: TrackId[]
     was_selection: boolean
 }[]
+type TrackColumns = {
+    generation: number
+    count: number
+    tracks: {
+        ppis: string[]
+        album: number[]
+        artist: number[]
+        title: string[]
+        trackNumber: number[]
+        totalTime: number[]
+    }
+    albums: { ppis: string[]; title: string[] }
+    artists: string[]
+}
+type PlaylistOrdinals = {
+    generation: number
+    playlists: {
+        name: string[]
+        tracks: number[]
+        was_selection: boolean
+    }[]
+    extra: string[]
+}
+
+const decodeTrackColumns = (columns: TrackColumns): Tracks => {
+    const { tracks, albums, artists } = columns
+    const ret: Tracks = new Array(columns.count)
+    for (let e = 0; e < columns.count; e++) {
+        const album = tracks.album[e]
+        ret[e] = {
+            ppis: tracks.ppis[e],
+            albumPpis: albums.ppis[album],
+            title: tracks.title[e],
+            artist: artists[tracks.artist[e]],
+            album: albums.title[album],
+            trackNumber: tracks.trackNumber[e],
+            totalTime: tracks.totalTime[e],
+        }
+    }
+    return ret
+}
+
+const decodePlaylistOrdinals = (
+    ordinals: PlaylistOrdinals,
+    columns: TrackColumns,
+): Playlists => {
+    const idOf = (ordinal: number) =>
+        isoTrackId.wrap(
+            ordinal < columns.count
+                ? columns.tracks.ppis[ordinal]
+                : ordinals.extra[ordinal - columns.count],
+        )
+    return ordinals.playlists.map((pl) => ({
+        ...pl,
+        tracks: pl.tracks.map(idOf),
+    }))
+}
+
 export const InitialFetchedContext = React.createContext(
     {} as {
         tracks?: Tracks
@@ -133,39 +191,19 @@ type TopProps = {
     initialFetch: InitialFetch
 }
 
-const arePagesFull = (pages: AxiosResponse<{ tracks: {}[] }>[]): boolean =>
-    pages.length > 0 && pages[pages.length - 1].data.tracks.length > 0
-
-var TOO_MANY_SUCCESS = 0
-
 const TopComponent: React.FC<TopProps> = (props) => {
     const { children, initialFetch } = props
 
-    const tracksQuery = useInfiniteQuery(
-        ['tracks@'],
-        ({ pageParam = 0 }) =>
-            axios.get<{ tracks: RawTrack[] }>('/_api/tracks', {
-                params: {
-                    offset: pageParam,
-                },
+    const tracksQuery = useQuery(
+        'tracks@',
+        () =>
+            axios.get<TrackColumns>('/_api/tracks', {
+                params: { format: 'columns' },
             }),
         {
             refetchOnWindowFocus: false,
             refetchOnReconnect: false,
             enabled: initialFetch.tracks !== undefined,
-            getNextPageParam: (lastPage, pages) =>
-                !arePagesFull(pages)
-                    ? List(pages).reduce(
-                          (sum, { data }) => sum + data.tracks.length,
-                          0,
-                      )
-                    : undefined,
-            onSuccess: ({ pages }) => {
-                console.assert(++TOO_MANY_SUCCESS < 10000)
-                if (!arePagesFull(pages)) {
-                    tracksQuery.fetchNextPage()
-                }
-            },
         },
     )
 
@@ -175,12 +213,19 @@ const TopComponent: React.FC<TopProps> = (props) => {
         enabled: initialFetch.argv !== undefined,
     })
 
+    // with the track columns loaded too, playlists come back as ordinals into them
+    const playlistsAsOrdinals = initialFetch.tracks !== undefined
     const playlists = useQuery(
         'playlists',
         () =>
-            axios.post<{ playlists: Playlists }>(
+            axios.post<{ playlists: Playlists } | PlaylistOrdinals>(
                 '/_api/playlists',
                 initialFetch.playlists,
+                {
+                    params: playlistsAsOrdinals
+                        ? { format: 'columns' }
+                        : undefined,
+                },
             ),
         {
             refetchOnWindowFocus: false,
@@ -189,18 +234,47 @@ const TopComponent: React.FC<TopProps> = (props) => {
         },
     )
 
+    const generationsDiffer =
+        playlistsAsOrdinals &&
+        tracksQuery.isSuccess &&
+        playlists.isSuccess &&
+        tracksQuery.data.data.generation !==
+            (playlists.data.data as PlaylistOrdinals).generation
+    React.useEffect(() => {
+        if (generationsDiffer) {
+            tracksQuery.refetch()
+            playlists.refetch()
+        }
+    }, [generationsDiffer])
+
+    const decodedTracks = React.useMemo(
+        () =>
+            tracksQuery.data
+                ? decodeTrackColumns(tracksQuery.data.data)
+                : undefined,
+        [tracksQuery.data],
+    )
+    const decodedPlaylists = React.useMemo(() => {
+        if (!playlists.data) {
+            return undefined
+        } else if (!playlistsAsOrdinals) {
+            return (playlists.data.data as { playlists: Playlists }).playlists
+        } else if (tracksQuery.data) {
+            return decodePlaylistOrdinals(
+                playlists.data.data as PlaylistOrdinals,
+                tracksQuery.data.data,
+            )
+        }
+    }, [playlists.data, tracksQuery.data])
+
     function* loadingDescription(): Generator<{
         description: string
         pending: boolean
     }> {
         if (initialFetch.tracks !== undefined) {
-            const pending =
-                tracksQuery.status === 'loading' || tracksQuery.hasNextPage
             yield {
-                description: pending
-                    ? `${(tracksQuery.data?.pages ?? []).length} pages`
-                    : 'all tracks',
-                pending,
+                description: 'all tracks',
+                pending: tracksQuery.status === 'loading',
             }
         }
         if (initialFetch.argv !== undefined) {
@@ -266,9 +340,9 @@ const TopComponent: React.FC<TopProps> = (props) => {
     var body
     if (
         tracksQuery.isSuccess &&
-        !tracksQuery.hasNextPage &&
         argv.isSuccess &&
-        playlists.isSuccess
+        playlists.isSuccess &&
+        !generationsDiffer
     ) {
         body = (
             <motion.div {...fadeInOut}>
@@ -288,11 +362,9 @@ const TopComponent: React.FC<TopProps> = (props) => {
                 >
                     <InitialFetchedContext.Provider
                         value={{
-                            tracks: List(tracksQuery.data?.pages)
-                                .flatMap(({ data }) => data.tracks)
-                                .toArray(),
+                            tracks: decodedTracks,
                             argv: argv.data?.data,
-                            playlists: playlists.data?.data.playlists,
+                            playlists: decodedPlaylists,
                         }}
                     >
                         {children}
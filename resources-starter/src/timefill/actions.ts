@@ -3,6 +3,7 @@ import {
     Choice,
     ChoiceTrackSelection,
     PlaylistModification,
+    SearchProgress,
     TimefillSelector,
 } from './types'
 import { List, Map, Set } from 'immutable'
@@ -93,6 +94,12 @@ export const runTimefill = createAsyncAction(
     Error
 >()
 
+export const timefillProgress = createAction(
+    'playlistgen/timefill/runTimefill/progress',
+)<{
+    progress: SearchProgress
+}>()
+
 export const modifyPlaylists = createAsyncAction(
     'playlistgen/timefill/modifyPlaylists/request',
     'playlistgen/timefill/modifyPlaylists/success',
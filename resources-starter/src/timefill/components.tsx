@@ -131,9 +131,18 @@ const ChoiceComponent: React.FC<{
     const top = useSelector((top: TimefillSelector) => top)
     const { ambientSelected } = top
     if (choice.loading) {
+        const progress = top.searchProgress
         return (
             <div className="choice loading">
                 <PulseLoader color="darkslateblue" size="0.5em" />
+                {progress && progress.of_n > 0 ? (
+                    <div className="search-progress">
+                        {progress.n} / {progress.of_n}
+                        {progress.best_score
+                            ? ` · best so far ${progress.best_score}`
+                            : ''}
+                    </div>
+                ) : null}
             </div>
         )
     }
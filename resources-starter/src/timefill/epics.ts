@@ -1,12 +1,26 @@
 import * as actions from './actions'
 
-import { AllActions, ChoiceTrackSelection } from './types'
+import {
+    AllActions,
+    Choice,
+    ChoiceTrackSelection,
+    TimefillSelector,
+} from './types'
 import { Epic, combineEpics } from 'redux-observable'
 import { List, Map, Seq, Set } from 'immutable'
 import { RemoteError, TrackId } from '../types'
-import { catchError, filter, map, switchMap } from 'rxjs/operators'
-import { from, of } from 'rxjs'
+import { EMPTY, Observable, from, of } from 'rxjs'
+import {
+    catchError,
+    concatMap,
+    expand,
+    filter,
+    finalize,
+    map,
+    switchMap,
+} from 'rxjs/operators'
 
+import { Lens } from 'monocle-ts'
 import { isActionOf } from 'typesafe-actions'
 import { postJSON } from '../funcs'
 
@@ -47,24 +61,67 @@ function buildData(
     return ret
 }
 
+function fetchJSON(input: string, init?: RequestInit): Promise<any> {
+    return fetch(input, init).then((resp) =>
+        resp.json().then((json) => {
+            if (resp.status !== 200) {
+                throw new RemoteError(resp, json)
+            }
+            return json
+        }),
+    )
+}
+
+function isActive(job: any): boolean {
+    return job.status === 'queued' || job.status === 'running'
+}
+
+// Start a search job, reporting its progress from the long-polling progress
+// endpoint, then fetch its results once it's done. Unsubscribing early (e.g.
+// because a newer search was requested) cancels the job.
+function runSearchJob(
+    data: any,
+    replace?: Lens<TimefillSelector, Choice>,
+): Observable<AllActions> {
+    return from(fetchJSON('/_api/search-jobs', postJSON(data))).pipe(
+        switchMap((created) => {
+            const url = `/_api/search-jobs/${created.id}`
+            const progress = (seen: number) =>
+                from(fetchJSON(`${url}/progress?seen=${seen}`))
+            let finished = false
+            return progress(-1).pipe(
+                expand((job) => (isActive(job) ? progress(job.n) : EMPTY)),
+                concatMap((job) => {
+                    if (isActive(job)) {
+                        return of(actions.timefillProgress({ progress: job }))
+                    }
+                    finished = true
+                    if (job.status !== 'done') {
+                        throw new Error(`search job ${job.status}`)
+                    }
+                    return from(fetchJSON(url)).pipe(
+                        map((json) =>
+                            actions.runTimefill.success({ json, replace }),
+                        ),
+                    )
+                }),
+                finalize(() => {
+                    if (!finished) {
+                        fetch(url, { method: 'DELETE' })
+                    }
+                }),
+            )
+        }),
+    )
+}
+
 const runTimefillEpic: Epic<AllActions, AllActions> = (action$) =>
     action$.pipe(
         filter(isActionOf(actions.runTimefill.request)),
         switchMap((action) => {
             const { criteria, selections, type, replace } = action.payload
             const data = buildData(criteria, selections, type)
-            return from(
-                fetch('/_api/timefill-criteria', postJSON(data)).then((resp) =>
-                    resp.json().then((json) => ({ resp, json })),
-                ),
-            ).pipe(
-                map(({ resp, json }) => {
-                    if (resp.status !== 200) {
-                        throw new RemoteError(resp, json)
-                    } else {
-                        return actions.runTimefill.success({ json, replace })
-                    }
-                }),
+            return runSearchJob(data, replace).pipe(
                 catchError((err) => of(actions.runTimefill.failure(err))),
             )
         }),
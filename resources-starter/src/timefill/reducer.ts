@@ -89,10 +89,15 @@ export default function timefillReducer(
         }
 
         case getType(actions.runTimefill.success):
-            return state.withTimefillResponse(
-                action.payload.json,
-                action.payload.replace,
-            )
+            return state
+                .withTimefillResponse(action.payload.json, action.payload.replace)
+                .set('searchProgress', undefined)
+
+        case getType(actions.runTimefill.failure):
+            return state.set('searchProgress', undefined)
+
+        case getType(actions.timefillProgress):
+            return state.set('searchProgress', action.payload.progress)
 
         case getType(actions.modifyPlaylists.request):
             return state.set('savingPlaylists', true)
@@ -55,6 +55,12 @@ export const isoTag = {
 export const NO_TAGS = isoTag.wrap('no tags')
 export const NO_TAGS_SET = Set([NO_TAGS])
 
+export interface SearchProgress {
+    n: number
+    of_n: number
+    best_score: string | null
+}
+
 export class OldChoice extends Record({
     name: '',
     segments: [] as string[],
@@ -155,6 +161,7 @@ export class TimefillSelector extends Record({
     ambientSelected: Map<TrackId, ChoiceTrackSelection>(),
     currentSelection: undefined as ChoiceTrackSelection | undefined,
     savingPlaylists: false,
+    searchProgress: undefined as SearchProgress | undefined,
 }) {
     condensedSelection(): Map<TrackId, ChoiceTrackSelection> {
         const pairs = this.choices
@@ -0,0 +1,136 @@
+import dataset
+import gzip
+import pytest
+
+from playlistgen._discogs_dump import Catalog, LocalResult, fts_query, iter_records
+
+MASTERS = """<?xml version="1.0" encoding="UTF-8"?>
+<masters>
+  <master id="100">
+    <main_release>1000</main_release>
+    <artists>
+      <artist><id>7</id><name>Boards Of Canada</name><anv></anv><join></join></artist>
+    </artists>
+    <genres><genre>Electronic</genre></genres>
+    <styles><style>IDM</style><style>Downtempo</style></styles>
+    <year>1998</year>
+    <title>Music Has The Right To Children</title>
+    <data_quality>Correct</data_quality>
+    <tracklist>
+      <track><position>1</position><title>Wildlife Analysis</title><duration>1:17</duration></track>
+      <track><position>2</position><title>An Eagle In Your Mind</title><duration>6:23</duration></track>
+    </tracklist>
+  </master>
+  <master id="101">
+    <main_release>1010</main_release>
+    <artists>
+      <artist><id>8</id><name>Björk</name><anv></anv><join>&amp;</join></artist>
+      <artist><id>9</id><name>Thom Yorke</name><anv>Thom</anv><join></join></artist>
+    </artists>
+    <year>2000</year>
+    <title>I've Seen It All</title>
+  </master>
+</masters>
+"""
+
+RELEASES = """<?xml version="1.0" encoding="UTF-8"?>
+<releases>
+  <release id="1000" status="Accepted">
+    <artists>
+      <artist><id>7</id><name>Boards Of Canada</name><anv></anv><join></join></artist>
+    </artists>
+    <title>Music Has The Right To Children</title>
+    <labels><label name="Warp Records" catno="WARPCD55" id="23528"/></labels>
+    <formats>
+      <format name="CD" qty="1"><descriptions><description>Album</description></descriptions></format>
+    </formats>
+    <country>UK</country>
+    <released>1998-04-20</released>
+    <master_id is_main_release="true">100</master_id>
+  </release>
+</releases>
+"""
+
+ARTISTS = """<?xml version="1.0" encoding="UTF-8"?>
+<artists>
+  <artist>
+    <id>7</id>
+    <name>Boards Of Canada</name>
+    <realname>Michael Sandison &amp; Marcus Eoin</realname>
+    <namevariations><name>BOC</name></namevariations>
+    <aliases><name id="12">Hell Interface</name></aliases>
+  </artist>
+</artists>
+"""
+
+
+@pytest.fixture
+def dumps(tmp_path):
+    ret = {}
+    for name, xml in [('masters', MASTERS), ('releases', RELEASES), ('artists', ARTISTS)]:
+        path = ret[name] = tmp_path / 'discogs_{}.xml.gz'.format(name)
+        with gzip.open(path, 'wt', encoding='utf-8') as outfile:
+            outfile.write(xml)
+    return ret
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    ret = Catalog(dataset.connect('sqlite:///{}'.format(tmp_path / 'catalog.db')))
+    ret.ensure_tables()
+    return ret
+
+
+def test_iter_records(dumps):
+    records = [(tag, elem.get('id')) for tag, elem in iter_records(dumps['masters'])]
+    assert records == [('masters', '100'), ('masters', '101')]
+
+
+def test_load_counts_records_once(catalog, dumps):
+    assert catalog.load(dumps['masters']) == 2
+    assert catalog.load(dumps['masters']) == 0
+    assert catalog.load(dumps['releases']) == 1
+    assert catalog.load(dumps['artists']) == 1
+
+
+def test_load_rejects_other_xml(catalog, tmp_path):
+    path = tmp_path / 'other.xml'
+    path.write_text('<labels><label><id>1</id></label></labels>')
+    with pytest.raises(ValueError):
+        catalog.load(path)
+
+
+def test_search_masters(catalog, dumps):
+    catalog.load(dumps['masters'])
+    [result] = catalog.search('right children', type='master')
+    assert isinstance(result, LocalResult)
+    assert result.id == 100
+    assert result.data['year'] == 1998
+    assert result.data['styles'] == ['IDM', 'Downtempo']
+    assert [t['title'] for t in result.data['tracklist']] == [
+        'Wildlife Analysis', 'An Eagle In Your Mind']
+    assert result.data['resource_url'] == 'https://api.discogs.com/masters/100'
+
+
+def test_search_by_artist_field(catalog, dumps):
+    catalog.load(dumps['masters'])
+    [result] = catalog.search(type='master', artist='bjork')
+    assert result.id == 101
+    assert catalog.search(type='master', title='bjork') == []
+
+
+def test_search_releases_and_artists(catalog, dumps):
+    catalog.load(dumps['releases'])
+    catalog.load(dumps['artists'])
+    [release] = catalog.search('music right', type='release')
+    assert release.data['master_id'] == 100
+    assert release.data['year'] == 1998
+    assert release.data['labels'][0]['catno'] == 'WARPCD55'
+    [artist] = catalog.search('boc', type='artist')
+    assert artist.data['realname'] == 'Michael Sandison & Marcus Eoin'
+
+
+def test_search_with_nothing_to_match(catalog, dumps):
+    catalog.load(dumps['masters'])
+    assert fts_query('  ') is None
+    assert catalog.search('', type='master') == []
@@ -0,0 +1,24 @@
+from playlistgen._event_log import MessageLog
+
+
+def log_of(*types):
+    ret = MessageLog()
+    for t in types:
+        ret.write({'message_type': t})
+    return ret
+
+
+def test_stream_starts_with_its_cursor():
+    log = log_of('a', 'a')
+    stream = log.event_stream(log.cursor, duration=0.2, keepalive=0.1)
+    assert next(stream) == b'retry: 1000\nid: 2\n\n'
+    log.write({'message_type': 'b'})
+    assert next(stream) == b'id: 3\ndata: [{"message_type": "b"}]\n\n'
+
+
+def test_stream_moves_past_other_types():
+    log = log_of('a')
+    stream = log.event_stream(0, types={'b'}, duration=0.2, keepalive=0.1)
+    assert next(stream) == b'retry: 1000\nid: 0\n\n'
+    assert next(stream) == b'id: 1\n\n'
+    assert next(stream) == b': keepalive\n\n'
@@ -0,0 +1,112 @@
+import dataset
+import datetime
+import pytest
+
+from playlistgen._history import DEFAULT_BACKEND, SelectionHistory
+
+
+@pytest.fixture
+def history():
+    return SelectionHistory.from_url('sqlite:///:memory:')
+
+
+def days_ago(n):
+    return datetime.datetime(2020, 6, 30) - datetime.timedelta(days=n)
+
+
+def test_record_makes_a_current_selection(history):
+    id = history.record('single=mix', ('mix',), 'abc', ['1', '2'], saved_at=days_ago(1))
+    [selection] = history.current_selections('single=mix')
+    assert selection.id == id
+    assert selection.name == ('mix',)
+    assert selection.playlist_id == 'abc'
+    assert selection.saved_at == days_ago(1)
+    assert history.current_track_pids('single=mix') == {'1', '2'}
+
+
+def test_record_replaces_a_selection_of_the_same_name(history):
+    history.record('single=mix', ('mix',), 'abc', ['1', '2'], saved_at=days_ago(2))
+    history.record('single=mix', ('mix',), 'def', ['3'], saved_at=days_ago(1))
+    assert [s.playlist_id for s in history.current_selections('single=mix')] == ['def']
+    assert history.current_track_pids('single=mix') == {'3'}
+
+
+def test_previous_track_pids_across_selections(history):
+    a = history.record('dated=mix %Y', ('mix 2018',), 'a', ['1', '2'], saved_at=days_ago(3))
+    history.record('dated=mix %Y', ('mix 2019',), 'b', ['2', '3'], saved_at=days_ago(2))
+    history.record('single=other', ('other',), 'c', ['4'], saved_at=days_ago(1))
+    assert [s.name for s in history.current_selections('dated=mix %Y')] == [
+        ('mix 2018',), ('mix 2019',)]
+    assert history.current_track_pids('dated=mix %Y') == {'1', '2', '3'}
+    assert history.current_track_pids('dated=mix %Y', exclude=[a]) == {'2', '3'}
+
+
+def test_forget(history):
+    history.record('dated=mix %Y', ('mix 2018',), 'a', ['1'], saved_at=days_ago(2))
+    history.record('dated=mix %Y', ('mix 2019',), 'b', ['2'], saved_at=days_ago(1))
+    old, _ = history.current_selections('dated=mix %Y')
+    history.forget([old])
+    assert [s.playlist_id for s in history.current_selections('dated=mix %Y')] == ['b']
+    assert history.current_track_pids('dated=mix %Y') == {'2'}
+
+
+def test_has_destination(history):
+    assert not history.has_destination('single=mix')
+    history.add_destination('single=mix')
+    assert history.has_destination('single=mix')
+    assert not history.has_destination('single=mix', 'file:m3u8:/tmp')
+    history.record('single=mix', ('mix',), 'mix.m3u8', [], backend='file:m3u8:/tmp')
+    assert history.has_destination('single=mix', 'file:m3u8:/tmp')
+
+
+def test_backends_are_kept_apart(history):
+    history.record('single=mix', ('mix',), 'abc', ['1'])
+    history.record('single=mix', ('mix',), 'mix.m3u8', ['2'], backend='file:m3u8:/tmp')
+    assert [s.playlist_id for s in history.current_selections('single=mix')] == ['abc']
+    assert history.current_track_pids('single=mix', 'file:m3u8:/tmp') == {'2'}
+
+
+def test_migrates_history_from_before_backends(tmp_path):
+    url = 'sqlite:///{}'.format(tmp_path / 'history.db')
+    db = dataset.connect(url)
+    db.query('create table destinations (destination text primary key)')
+    db.query("""
+        create table selections (
+            id integer primary key,
+            destination text not null,
+            playlist_name text not null,
+            playlist_id text,
+            saved_at text not null,
+            current boolean not null default true
+        )
+    """)
+    db.query("""
+        create index selections_destination_idx
+        on selections (destination, current, saved_at)
+    """)
+    db.query("""
+        create table selection_tracks (
+            selection_id integer not null references selections (id),
+            position integer not null,
+            track_pid text not null
+        )
+    """)
+    db.query("insert into destinations (destination) values ('single=mix')")
+    db.query("""
+        insert into selections (id, destination, playlist_name, playlist_id, saved_at)
+        values (1, 'single=mix', 'mix', 'abc', :saved_at)
+    """, saved_at=days_ago(1).isoformat())
+    db.query("insert into selection_tracks values (1, 0, '1'), (1, 1, '2')")
+    db.close()
+
+    history = SelectionHistory.from_url(url)
+    assert history.has_destination('single=mix', DEFAULT_BACKEND)
+    assert not history.has_destination('single=mix', 'file:m3u8:/tmp')
+    assert [s.playlist_id for s in history.current_selections('single=mix')] == ['abc']
+    assert history.current_track_pids('single=mix') == {'1', '2'}
+    assert history.current_track_pids('single=mix', 'file:m3u8:/tmp') == set()
+
+    history.record('single=mix', ('mix',), 'def', ['3'])
+    assert history.current_track_pids('single=mix') == {'3'}
+    # and opening it again doesn't migrate twice
+    assert SelectionHistory.from_url(url).current_track_pids('single=mix') == {'3'}
@@ -0,0 +1,55 @@
+import attr
+import threading
+
+from playlistgen._lazy import forgetting, locked_reify
+
+
+@attr.s
+class Slow:
+    started = attr.ib(factory=threading.Event)
+    release = attr.ib(factory=threading.Event)
+    calls = attr.ib(default=0)
+
+    @locked_reify
+    def value(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return self.calls
+
+
+def test_computed_once_across_threads():
+    slow = Slow()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(slow.value)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    slow.started.wait(5)
+    slow.release.set()
+    for t in threads:
+        t.join(5)
+    assert results == [1] * 4
+    assert slow.calls == 1
+
+
+def test_copies_dont_share_locks():
+    slow = Slow()
+    thread = threading.Thread(target=lambda: slow.value)
+    thread.start()
+    slow.started.wait(5)
+    try:
+        copy = attr.evolve(
+            slow, started=threading.Event(), release=threading.Event(), calls=0)
+        copy.release.set()
+        # neither waits for slow's lock, still held by the thread computing it
+        other = threading.Thread(target=lambda: copy.value)
+        other.start()
+        other.join(1)
+        assert not other.is_alive()
+        with forgetting(copy, ['value']):
+            assert 'value' not in copy.__dict__
+    finally:
+        slow.release.set()
+        thread.join(5)
+    assert slow.value == 1
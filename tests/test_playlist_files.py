@@ -0,0 +1,113 @@
+import attr
+import os
+import pathlib
+import pytest
+
+from playlistgen._playlist_files import FileBackend, PlaylistEntry
+from playlistgen._playlist_sync import AddTracks, CreatePlaylist, RemoveTracks, RenameTracks
+
+
+@attr.s
+class Named:
+    _name = attr.ib()
+
+    def name(self):
+        return self._name
+
+    def title(self):
+        return self._name
+
+
+@attr.s
+class Location:
+    path = attr.ib()
+
+    def fileSystemRepresentation(self):
+        return os.fsencode(self.path)
+
+
+@attr.s
+class FakeTrack:
+    """
+    The parts of an ITLibMediaItem that playlist files are made from.
+    """
+
+    pid = attr.ib()
+    has_file = attr.ib(default=True)
+
+    def persistentID(self):
+        return int(self.pid, 16)
+
+    def location(self):
+        if self.has_file:
+            return Location('/music/{}.m4a'.format(self.pid))
+
+    def totalTime(self):
+        return 180000
+
+    def title(self):
+        return 'Title {}'.format(self.pid)
+
+    def artist(self):
+        return Named('Artist')
+
+    def album(self):
+        return Named('Album')
+
+
+def entry(pid):
+    return PlaylistEntry(
+        path=pathlib.Path('/music/{}.m4a'.format(pid)), seconds=180,
+        title='Title {}'.format(pid), artist='Artist', album='Album', pid=pid)
+
+
+def backend(tmp_path, format, pids=()):
+    tracks_by_id = {pid: FakeTrack(pid) for pid in 'abcd'}
+    tracks_by_id['e'] = FakeTrack('e', has_file=False)
+    ret = FileBackend(tmp_path, format, tracks_by_id=lambda: tracks_by_id)
+    if pids:
+        ret.write_playlist(('Folder', 'List'), [tracks_by_id[pid] for pid in pids])
+    return ret
+
+
+@pytest.mark.parametrize('format', ['m3u8', 'xspf'])
+def test_entries_round_trip(tmp_path, format):
+    b = backend(tmp_path, format, 'abc')
+    assert b.read_entries(b.playlist_id(('Folder', 'List'))) == [
+        entry(pid) for pid in 'abc']
+
+
+@pytest.mark.parametrize('format', ['m3u8', 'xspf'])
+def test_tracks_without_files_are_skipped(tmp_path, format):
+    b = backend(tmp_path, format, 'aeb')
+    assert [e.pid for e in b.read_entries(b.playlist_id(('Folder', 'List')))] == ['a', 'b']
+    assert b.skipped == 1
+
+
+@pytest.mark.parametrize('format', ['m3u8', 'xspf'])
+def test_batch_edits_files(tmp_path, format):
+    b = backend(tmp_path, format, 'abc')
+    playlist_id = b.playlist_id(('Folder', 'List'))
+    results = b.run_batch([
+        RemoveTracks(playlist_id, ['b']),
+        RenameTracks([('c', 'Renamed')]),
+        CreatePlaylist(['Folder', 'New']),
+        AddTracks(playlist_id, ['a', 'd']),
+        AddTracks(playlist_id, ['f']),
+    ])
+    assert [r.ok for r in results] == [True, True, True, True, False]
+    assert results[2].value == b.playlist_id(('Folder', 'New'))
+    assert b.read_entries(results[2].value) == []
+    entries = b.read_entries(playlist_id)
+    assert [e.pid for e in entries] == ['a', 'c', 'd']
+    assert entries[1].title == 'Renamed'
+
+
+@pytest.mark.parametrize('format', ['m3u8', 'xspf'])
+def test_batch_adds_dupes_only_when_asked(tmp_path, format):
+    b = backend(tmp_path, format, 'a')
+    playlist_id = b.playlist_id(('Folder', 'List'))
+    b.run_batch([AddTracks(playlist_id, ['a', 'b', 'b'])])
+    assert [e.pid for e in b.read_entries(playlist_id)] == ['a', 'b']
+    b.run_batch([AddTracks(playlist_id, ['a'], dupes=True)])
+    assert [e.pid for e in b.read_entries(playlist_id)] == ['a', 'b', 'a']
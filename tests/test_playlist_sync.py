@@ -0,0 +1,123 @@
+import pytest
+import random
+
+from playlistgen._playlist_sync import (
+    ChunkSizer, CreatePlaylist, Insert, Move, PlaylistBatch, RecordingBackend,
+    Remove, TimeoutBackend, append_diff, apply_operations, diff_tracks,
+    sync_playlist)
+
+
+def random_lists(seed, n=300):
+    rng = random.Random(seed)
+    for _ in range(n):
+        alphabet = 'abcdefghij'[:rng.randint(1, 10)]
+        current = [rng.choice(alphabet) for _ in range(rng.randint(0, 30))]
+        desired = [rng.choice(alphabet) for _ in range(rng.randint(0, 30))]
+        yield current, desired
+
+
+@pytest.mark.parametrize('diff', [diff_tracks, append_diff])
+def test_diff_applies_to_desired(diff):
+    for current, desired in random_lists(diff.__name__):
+        operations = diff(current, desired)
+        assert apply_operations(current, operations) == desired
+
+
+@pytest.mark.parametrize('diff', [diff_tracks, append_diff])
+def test_diff_of_equal_lists_is_empty(diff):
+    tracks = list('abcabc')
+    assert diff(tracks, list(tracks)) == []
+
+
+def test_diff_tracks_moves_instead_of_reinserting():
+    operations = diff_tracks(list('abcdef'), list('fabcde'))
+    assert operations == [Move(5, 0)]
+
+
+def test_append_diff_only_appends():
+    current = list('abcdef')
+    desired = list('acdxy')
+    operations = append_diff(current, desired)
+    assert not any(isinstance(op, Move) for op in operations)
+    end = len(current) - sum(isinstance(op, Remove) for op in operations)
+    inserts = [op for op in operations if isinstance(op, Insert)]
+    assert [op.index for op in inserts] == list(range(end, end + len(inserts)))
+
+
+def test_sync_playlist_with_recording_backend():
+    backend = RecordingBackend()
+    playlist_id = sync_playlist(backend, ['x'], list('abcd'))
+    assert backend.playlists[playlist_id] == list('abcd')
+    sync_playlist(backend, ['x'], list('abdce'))
+    assert backend.playlists[playlist_id] == list('abdce')
+
+
+def test_chunk_sizer_converges_on_target():
+    sizer = ChunkSizer(size=1, target_seconds=5.0)
+    for _ in range(20):
+        sizer.observe(sizer.size, sizer.size * 0.1)
+    assert sizer.size == 50
+
+
+def test_chunk_sizer_backs_off_when_slow():
+    sizer = ChunkSizer(size=400, target_seconds=5.0)
+    for _ in range(5):
+        sizer.observe(sizer.size, sizer.size * 0.1)
+    assert sizer.size == 50
+
+
+def test_chunk_sizer_ignores_short_last_chunk():
+    sizer = ChunkSizer(size=100)
+    sizer.observe(3, 0.01)
+    assert sizer.size == 100
+
+
+def test_chunk_sizer_stays_under_timed_out_size():
+    sizer = ChunkSizer(size=100)
+    sizer.timed_out(100)
+    assert sizer.size == 50
+    for _ in range(10):
+        sizer.observe(sizer.size, 0.001)
+    assert sizer.size <= 75
+
+
+def test_sync_playlist_resumes_after_timeouts():
+    backend = TimeoutBackend(RecordingBackend(), max_operations=7)
+    sizer = ChunkSizer(size=50)
+    desired = ['t{}'.format(n) for n in range(100)]
+    playlist_id = sync_playlist(backend, ['x'], desired, sizer=sizer, attempts=10)
+    assert backend.backend.playlists[playlist_id] == desired
+    assert backend.timeouts > 0
+    assert sizer.size <= 7
+
+
+def test_batch_runs_in_one_backend_call():
+    backend = RecordingBackend()
+    [create] = PlaylistBatch([CreatePlaylist(['x'])]).run(backend)
+    playlist_id = create.value
+    batch = PlaylistBatch()
+    batch.add(playlist_id, ['a', 'b', 'a'])
+    batch.add(playlist_id, ['b', 'c'])
+    batch.remove(playlist_id, ['a'])
+    batch.rename([('c', 'see')])
+    batch.add('nonexistent', ['a'])
+    results = batch.run(backend)
+    assert [c[0] for c in backend.calls].count('run_batch') == 2
+    assert [r.ok for r in results] == [True, True, True, True, False]
+    assert backend.playlists[playlist_id] == ['b', 'c']
+    assert backend.track_names == {'c': 'see'}
+
+
+def test_batch_add_with_dupes():
+    backend = RecordingBackend()
+    playlist_id, _ = backend.read_playlist(['x'])
+    batch = PlaylistBatch()
+    batch.add(playlist_id, ['a', 'a'], dupes=True)
+    batch.run(backend)
+    assert backend.playlists[playlist_id] == ['a', 'a']
+
+
+def test_empty_batch_makes_no_call():
+    backend = RecordingBackend()
+    assert PlaylistBatch().run(backend) == []
+    assert backend.calls == []
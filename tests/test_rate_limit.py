@@ -0,0 +1,167 @@
+import attr
+import contextlib
+import http.server
+import threading
+import time
+import pytest
+
+pytest.importorskip('iTunesLibrary')
+
+from playlistgen._discogs_match import (  # noqa: E402
+    HeaderFetcher, Matcher, RateLimiter, TokenBucket)
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    # (status, headers) to answer with, in order; the last one repeats
+    responses = []
+    requests = []
+    # (time, status) of each response, once it's been answered
+    answered = []
+    delay = 0
+
+    def do_GET(self):
+        self.requests.append((time.monotonic(), self.path))
+        responses = type(self).responses
+        status, headers = responses.pop(0) if len(responses) > 1 else responses[0]
+        time.sleep(self.delay)
+        body = b'{}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.answered.append((time.monotonic(), status))
+
+    def log_message(self, *a):
+        pass
+
+
+@contextlib.contextmanager
+def stub_server(responses, delay=0):
+    handler = type('Handler', (StubHandler,), {
+        'responses': list(responses), 'requests': [], 'answered': [], 'delay': delay})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:{}'.format(server.server_port)
+        yield url, handler.requests, handler.answered
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def limiter(bucket=None, backoff_seconds=25):
+    fetcher = HeaderFetcher('token')
+    # turns off the @backoff retry on discogs_client's Fetcher.request, which
+    # would otherwise retry 429s itself before RateLimiter saw them
+    fetcher.backoff_enabled = False
+    return RateLimiter(
+        fetcher, bucket=bucket or TokenBucket(), backoff_seconds=backoff_seconds)
+
+
+def test_bucket_waits_for_a_token():
+    bucket = TokenBucket(rate=600, tokens=0)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_bucket_spends_tokens_without_waiting():
+    bucket = TokenBucket(rate=60)
+    start = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.5
+    assert bucket.tokens < 51
+
+
+def test_bucket_observe_caps_tokens_at_remaining():
+    bucket = TokenBucket(rate=60, reserve=2)
+    bucket.observe(limit=25, remaining=5)
+    assert bucket.rate == 25
+    assert bucket.tokens <= 3
+
+
+def test_bucket_pause_holds_everyone():
+    bucket = TokenBucket(rate=6000)
+    bucket.pause(0.2)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.19
+
+
+def test_limiter_observes_rate_limit_headers():
+    headers = {'X-Discogs-Ratelimit': '25', 'X-Discogs-Ratelimit-Remaining': '10'}
+    with stub_server([(200, headers)]) as (url, requests, _):
+        l = limiter()
+        content, status_code = l.fetch(None, 'GET', url + '/releases/1')
+    assert status_code == 200
+    assert [path.partition('?')[0] for _, path in requests] == ['/releases/1']
+    assert l.rate_limit_remaining == 10
+    assert l.bucket.rate == 25
+    assert l.bucket.tokens <= 8
+
+
+def test_limiter_retries_after_429_as_told():
+    with stub_server([(429, {'Retry-After': '1'}), (200, {})]) as (url, requests, _):
+        content, status_code = limiter().fetch(None, 'GET', url + '/releases/1')
+    assert status_code == 200
+    assert len(requests) == 2
+    assert requests[1][0] - requests[0][0] >= 0.95
+
+
+def test_limiter_backs_off_without_retry_after():
+    with stub_server([(429, {}), (200, {})]) as (url, requests, _):
+        content, status_code = limiter(backoff_seconds=0.3).fetch(
+            None, 'GET', url + '/releases/1')
+    assert status_code == 200
+    assert requests[1][0] - requests[0][0] >= 0.25
+
+
+@attr.s
+class FakeTracks:
+    discogs_token = attr.ib(default='token')
+
+
+@attr.s
+class FakeBar:
+    n = attr.ib(default=0)
+
+    def update(self):
+        self.n += 1
+
+
+@attr.s
+class RecordingBucket(TokenBucket):
+    acquired = attr.ib(factory=list)
+    paused = attr.ib(factory=list)
+
+    def acquire(self):
+        super().acquire()
+        self.acquired.append(time.monotonic())
+
+    def pause(self, seconds):
+        self.paused.append(time.monotonic())
+        super().pause(seconds)
+
+
+def test_fetch_all_overlaps_and_pauses_everyone_on_429():
+    responses = [(429, {'Retry-After': '1'}), (200, {})]
+    with stub_server(responses, delay=0.2) as (url, requests, answered):
+        matcher = Matcher(FakeTracks(), db=None, base_url=url, concurrency=4)
+        bucket = matcher.rate_limiter.bucket = RecordingBucket()
+        bar = FakeBar()
+        results = dict(matcher.fetch_all(
+            range(8), lambda n: matcher.rate_limiter.fetch(
+                None, 'GET', '{}/releases/{}'.format(url, n)), bar))
+    assert results == {n: (b'{}', 200) for n in range(8)}
+    assert bar.n == 8
+    assert len(requests) == 9
+    # the first four were all sent before any was answered
+    assert sorted(when for when, _ in requests)[3] < min(when for when, _ in answered)
+    [paused_at] = bucket.paused
+    assert [when for when in bucket.acquired if paused_at < when < paused_at + 0.95] == []
+    # the 429 at least was retried after it
+    assert max(bucket.acquired) >= paused_at + 0.95
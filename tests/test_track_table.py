@@ -0,0 +1,139 @@
+import attr
+import numpy
+import random
+import pytest
+
+Foundation = pytest.importorskip('Foundation')
+pytest.importorskip('iTunesLibrary')
+
+from playlistgen import playlistgen  # noqa: E402
+from playlistgen._criteria_parser import Constructor  # noqa: E402
+from playlistgen._track_table import SearchPool, TrackTable  # noqa: E402
+
+
+@attr.s
+class Named:
+    _name = attr.ib()
+
+    def name(self):
+        return self._name
+
+
+@attr.s
+class FakeAlbum:
+    pid = attr.ib()
+    artist_name = attr.ib()
+
+    def persistentID(self):
+        return self.pid
+
+    def artist(self):
+        return Named(self.artist_name)
+
+
+@attr.s(eq=False)
+class FakeTrack:
+    """
+    The parts of an ITLibMediaItem that a TrackTable is made from.
+    """
+
+    pid = attr.ib()
+    seconds = attr.ib()
+    _album = attr.ib()
+    played = attr.ib()
+    skipped = attr.ib()
+    added = attr.ib()
+
+    def persistentID(self):
+        return self.pid
+
+    def totalTime(self):
+        return self.seconds * 1000
+
+    def album(self):
+        return self._album
+
+    def lastPlayedDate(self):
+        return date(self.played)
+
+    def skipDate(self):
+        return date(self.skipped)
+
+    def addedDate(self):
+        return date(self.added)
+
+
+@attr.s
+class FakeTracks:
+    tracklist = attr.ib()
+    rng = attr.ib()
+
+
+def date(interval):
+    if interval is not None:
+        return Foundation.NSDate.dateWithTimeIntervalSinceReferenceDate_(interval)
+
+
+def interval(date):
+    if date is not None:
+        return date.timeIntervalSinceReferenceDate()
+
+
+@pytest.fixture
+def tracklist():
+    rng = random.Random(0)
+    albums = [FakeAlbum(0x1000 + n, 'Artist {}'.format(n % 3)) for n in range(8)]
+    return [
+        FakeTrack(
+            pid=0xabc000 + n, seconds=rng.randrange(120, 420), album=albums[n % 8],
+            played=None if n % 4 == 0 else 6e8 + n, skipped=6.1e8 if n % 5 == 0 else None,
+            added=5e8 + n)
+        for n in range(40)]
+
+
+def test_table_round_trips_through_shared_memory(tracklist):
+    table = TrackTable.from_tracks(tracklist)
+    descriptor = table.share()
+    try:
+        attached = TrackTable.attach(descriptor)
+        try:
+            for name, column in table.columns.items():
+                numpy.testing.assert_array_equal(attached.columns[name], column)
+            for track, row in zip(tracklist, attached.rows()):
+                assert row.persistentID() == track.persistentID()
+                assert row.totalTime() == track.totalTime()
+                assert row.album().persistentID() == track.album().persistentID()
+                assert row.album().artist().name() == track.album().artist().name()
+                assert interval(row.lastPlayedDate()) == track.played
+                assert interval(row.skipDate()) == track.skipped
+                assert interval(row.addedDate()) == track.added
+            assert attached.pids_of([0, 39]) == ['abc000', 'abc027']
+        finally:
+            attached.close()
+    finally:
+        table.close(unlink=True)
+
+
+def test_pooled_search_matches_in_process_search(tracklist):
+    raw_criteria = [Constructor('uniform')] + [
+        playlistgen.parse_criterion(c) for c in ['time=1800', 'albums=many']]
+    params = {'iterations': 300}
+    # the pool seeds each search from its context's rng
+    seed = random.Random(7).getrandbits(64)
+    context = playlistgen.TrackContext(
+        source_playlists=(), dest_playlist=None, start_playing=False,
+        raw_criteria=raw_criteria, rng=random.Random(seed))
+    selections = playlistgen.search_criteria(
+        context, tracklist=tracklist, prepared=playlistgen.prepared_criteria_cache(),
+        **params)
+    expected = [{
+        'score': str(s.score),
+        'tracks': list(s.track_persistent_ids),
+        'explanations': [e.format() for e in s.explanations.collapsed()],
+    } for s in selections]
+
+    pool = SearchPool(FakeTracks(tracklist, random.Random(7)), max_workers=1)
+    try:
+        assert pool.search(raw_criteria, set(), params) == expected
+    finally:
+        pool.close()